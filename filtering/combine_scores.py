@@ -2,30 +2,39 @@
 
 import argparse
 import math
+import os
 import sys
 
+# the repository root, so that the masking package can be imported when run as a script
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from masking import textio
+
 def main(args):
     skipped = 0
     i = 0
-    for i, line in enumerate(sys.stdin, 1):
-        tokens = line.rstrip().split('\t')
-        if len(tokens) == 4:
-            score1, score2, source, target = tokens
-            score1 = float(score1)
-            score2 = float(score2)
-        elif len(tokens) == 2:
-            score1, score2 = map(float, tokens)
-            source = target = None
-        else:
-            print("Need either two or four fields!", file=sys.stderr)
-            sys.exit(1)
+    for lines in textio.read_batches(sys.stdin):
+        output = []
+        for line in lines:
+            tokens = line.rstrip().split('\t')
+            if len(tokens) == 4:
+                score1, score2, source, target = tokens
+                score1 = float(score1)
+                score2 = float(score2)
+            elif len(tokens) == 2:
+                score1, score2 = map(float, tokens)
+                source = target = None
+            else:
+                textio.write_lines(sys.stdout, output)
+                print("Need either two or four fields!", file=sys.stderr)
+                sys.exit(1)
 
-        score = math.exp(-(abs(score1 - score2) + 0.5 * (score1 + score2)))
+            score = math.exp(-(abs(score1 - score2) + 0.5 * (score1 + score2)))
 
-        if source is not None:
-            print(score, source, target, sep='\t', flush=True)
-        else:
-            print(score, flush=True)
+            if source is not None:
+                output.append('{}\t{}\t{}'.format(score, source, target))
+            else:
+                output.append(str(score))
+        textio.write_lines(sys.stdout, output)
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
@@ -2,21 +2,31 @@
 
 import argparse
 import langid
+import os
 import sys
 
+# the repository root, so that the masking package can be imported when run as a script
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from masking import textio
+
 def main(args):
     skipped_source = skipped_target = 0
-    for i, line in enumerate(sys.stdin, 1):
-        fields = line.rstrip().split('\t')
-        src_line = fields[args.source_field]
-        trg_line = fields[args.target_field]
-        if langid.classify(src_line)[0] != args.source_lang:
-            skipped_source += 1
-            continue
-        elif langid.classify(trg_line)[0] != args.target_lang:
-            skipped_target += 1
-            continue
-        print(line.rstrip())
+    i = 0
+    for lines in textio.read_batches(sys.stdin):
+        output = []
+        for line in lines:
+            i += 1
+            fields = line.rstrip().split('\t')
+            src_line = fields[args.source_field]
+            trg_line = fields[args.target_field]
+            if langid.classify(src_line)[0] != args.source_lang:
+                skipped_source += 1
+                continue
+            elif langid.classify(trg_line)[0] != args.target_lang:
+                skipped_target += 1
+                continue
+            output.append(line.rstrip())
+        textio.write_lines(sys.stdout, output)
 
     print('Skipped {} / {} lines (source {} and target {})'.format(skipped_source + skipped_target, i,
                                                                    skipped_source, skipped_target), 
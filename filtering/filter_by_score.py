@@ -6,20 +6,29 @@
 
 import argparse
 import math
+import os
 import sys
 
+# the repository root, so that the masking package can be imported when run as a script
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from masking import textio
+
 def main(args):
     skipped = 0
     i = 0
-    for i, line in enumerate(sys.stdin, 1):
-        combined_score, source, target = line.rstrip().split('\t')
-        combined_score = float(combined_score)
+    for lines in textio.read_batches(sys.stdin):
+        output = []
+        for line in lines:
+            i += 1
+            combined_score, source, target = line.rstrip().split('\t')
+            combined_score = float(combined_score)
 
-        if args.threshold != None and combined_score < args.threshold:
-            skipped += 1
-            continue
+            if args.threshold != None and combined_score < args.threshold:
+                skipped += 1
+                continue
 
-        print(combined_score, source, target, sep='\t', flush=True)
+            output.append('{}\t{}\t{}'.format(combined_score, source, target))
+        textio.write_lines(sys.stdout, output)
 
     if args.threshold != None:
         print('Skipped {} / {} lines at threshold {}'.format(skipped, i, args.threshold))
@@ -1,29 +1,32 @@
 #!/usr/bin/env python3
 
 import argparse
-import json
+import os
+import queue
+import subprocess
 import sys
-from collections import defaultdict
+import threading
+from collections import defaultdict, deque
 
+import numpy
 import pexpect
 from tqdm import tqdm
 
+# the repository root, so that the masking package can be imported when run as a script
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from masking import attention, fast_align, jsonio, symmetrize, textio
+
 '''
 Add alignment "attention" to JSON object using force_align
 
-usage: python add_attention.py fwd_lex fwd_err rev_lex rev_err < input.json
+usage: python add_attention.py fwd_lex fwd_err rev_lex rev_err [--encoding dense|float16|sparse] [--window N] < input.json
 '''
 
 class Aligner:
     # from force_align.py
 
     def __init__(self, fwd_params, fwd_err, rev_params, rev_err, heuristic='grow-diag-final-and'):
-        (fwd_T, fwd_m) = self.read_err(fwd_err)
-        (rev_T, rev_m) = self.read_err(rev_err)
-
-        fwd_cmd = ['fast_align', '-i', '-', '-d', '-T', fwd_T, '-m', fwd_m, '-f', fwd_params]
-        rev_cmd = ['fast_align', '-i', '-', '-d', '-T', rev_T, '-m', rev_m, '-f', rev_params, '-r']
-        tools_cmd = ['atools', '-i', '-', '-j', '-', '-c', heuristic]
+        fwd_cmd, rev_cmd, tools_cmd = self.commands(fwd_params, fwd_err, rev_params, rev_err, heuristic)
 
         self.fwd_align = pexpect.spawn(' '.join(fwd_cmd))
         self.rev_align = pexpect.spawn(' '.join(rev_cmd))
@@ -66,16 +69,132 @@ def close(self):
         self.rev_align.close()
         self.tools.close()
 
+    def commands(self, fwd_params, fwd_err, rev_params, rev_err, heuristic):
+        (fwd_T, fwd_m) = self.read_err(fwd_err)
+        (rev_T, rev_m) = self.read_err(rev_err)
+
+        fwd_cmd = ['fast_align', '-i', '-', '-d', '-T', fwd_T, '-m', fwd_m, '-f', fwd_params]
+        rev_cmd = ['fast_align', '-i', '-', '-d', '-T', rev_T, '-m', rev_m, '-f', rev_params, '-r']
+        tools_cmd = ['atools', '-i', '-', '-j', '-', '-c', heuristic]
+        return fwd_cmd, rev_cmd, tools_cmd
+
     def read_err(self, err):
-        (T, m) = ('', '')
-        for line in open(err):
-            # expected target length = source length * N
-            if 'expected target length' in line:
-                m = line.split()[-1]
-            # final tension: N
-            elif 'final tension' in line:
-                T = line.split()[-1]
-        return (T, m)
+        return fast_align.read_err(err)
+
+
+class StreamingAligner(Aligner):
+    """
+    Runs the forward and reverse aligners and atools as pipelines rather than in lockstep.
+
+    A writer thread feeds each line to both aligners at once and a joiner thread passes their
+    links on to atools, so all three processes work at the same time on different lines.
+    At most `window` lines are in flight; results come back in input order.
+    Since the aligners' input is closed at the end of the stream, `align_stream()` can only be called once.
+    """
+
+    def __init__(self, fwd_params, fwd_err, rev_params, rev_err, heuristic='grow-diag-final-and', window=64):
+        fwd_cmd, rev_cmd, tools_cmd = self.commands(fwd_params, fwd_err, rev_params, rev_err, heuristic)
+
+        def spawn(cmd):
+            return subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                    universal_newlines=True, encoding='utf-8', bufsize=1)
+
+        self.fwd_align = spawn(fwd_cmd)
+        self.rev_align = spawn(rev_cmd)
+        self.tools = spawn(tools_cmd)
+        self.window = window
+
+    def align_stream(self, lines):
+        """
+        Aligns a stream of "source ||| target" lines, yielding the symmetrized links
+        (or "bad") for each, in order.
+        """
+        slots = threading.Semaphore(self.window)
+        pending = queue.Queue()  # for each line, whether atools has an answer for it
+        errors = []
+
+        def write():
+            try:
+                for line in lines:
+                    slots.acquire()
+                    for aligner in (self.fwd_align, self.rev_align):
+                        aligner.stdin.write(line + '\n')
+                        aligner.stdin.flush()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                for aligner in (self.fwd_align, self.rev_align):
+                    aligner.stdin.close()
+
+        def join():
+            try:
+                while True:
+                    fwd_line = self.fwd_align.stdout.readline()
+                    rev_line = self.rev_align.stdout.readline()
+                    if not fwd_line and not rev_line:
+                        break
+
+                    # f words ||| e words ||| links ||| score
+                    fwd_arr = fwd_line.rstrip().split('|||')
+                    rev_arr = rev_line.rstrip().split('|||')
+                    if len(fwd_arr) == len(rev_arr) == 4:
+                        self.tools.stdin.write(fwd_arr[2].strip() + '\n' + rev_arr[2].strip() + '\n')
+                        self.tools.stdin.flush()
+                        pending.put(True)
+                    else:  # bad alignment
+                        pending.put(False)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                self.tools.stdin.close()
+                pending.put(None)
+
+        threads = [threading.Thread(target=write, daemon=True), threading.Thread(target=join, daemon=True)]
+        for thread in threads:
+            thread.start()
+
+        while True:
+            aligned = pending.get()
+            if aligned is None:
+                break
+            yield self.tools.stdout.readline().rstrip() if aligned else "bad"
+            slots.release()
+
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        for process in (self.fwd_align, self.rev_align, self.tools):
+            for stream in (process.stdin, process.stdout):
+                if not stream.closed:
+                    stream.close()
+            process.wait()
+
+
+class InProcessAligner(Aligner):
+    """
+    Aligns with fast_align's parameters (see fast_align.py) and symmetrizes the links
+    (see symmetrize.py) in-process, without running fast_align or atools.
+    """
+
+    def __init__(self, fwd_params, fwd_err, rev_params, rev_err, heuristic='grow-diag-final-and'):
+        self.fwd_model = fast_align.FastAlignModel.from_err(fwd_params, fwd_err)
+        self.rev_model = fast_align.FastAlignModel.from_err(rev_params, rev_err, reverse=True)
+        self.heuristic = heuristic
+
+    def align(self, line):
+        source, _, target = line.partition(' ||| ')
+        source, target = source.split(), target.split()
+        fwd_links, _ = self.fwd_model.align(source, target)
+        rev_links, _ = self.rev_model.align(source, target)
+        links = symmetrize.symmetrize(numpy.array(fwd_links, dtype=numpy.int64).reshape(-1, 2),
+                                      numpy.array(rev_links, dtype=numpy.int64).reshape(-1, 2), self.heuristic)
+        return symmetrize.format_links(links)
+
+    def close(self):
+        pass
 
 
 def parse_alignments(align):
@@ -103,6 +222,14 @@ def parseargs():
     parser.add_argument('fwd_err')
     parser.add_argument('rev_params')
     parser.add_argument('rev_err')
+    parser.add_argument('--encoding', choices=attention.ENCODINGS, default='dense',
+                        help='How to write the alignment matrix (see attention.py). Default: %(default)s.')
+    parser.add_argument('--heuristic', choices=symmetrize.HEURISTICS, default='grow-diag-final-and',
+                        help='How to symmetrize the forward and reverse alignments. Default: %(default)s.')
+    parser.add_argument('--in-process', action='store_true',
+                        help='Align and symmetrize in-process rather than with fast_align and atools subprocesses')
+    parser.add_argument('--window', type=int, default=0,
+                        help='Number of lines to keep in flight through the aligners (e.g., 64), or 0 to align one line at a time. Default: %(default)s.')
     return parser.parse_args()
 
 
@@ -117,13 +244,29 @@ def make_bitext(jobj):
 def main():
     args = parseargs()
 
-    aligner = Aligner(args.fwd_params, args.fwd_err, args.rev_params, args.rev_err, 'grow-diag-final-and')
+    if args.in_process:
+        aligner = InProcessAligner(args.fwd_params, args.fwd_err, args.rev_params, args.rev_err, args.heuristic)
+    elif args.window > 0:
+        aligner = StreamingAligner(args.fwd_params, args.fwd_err, args.rev_params, args.rev_err, args.heuristic, window=args.window)
+    else:
+        aligner = Aligner(args.fwd_params, args.fwd_err, args.rev_params, args.rev_err, args.heuristic)
+
+    # JSON objects whose lines are in flight in the aligner, oldest first
+    jobjs = deque()
+
+    def bitext_lines():
+        for line in textio.read_lines(sys.stdin):
+            jobj = jsonio.loads(line)
+            jobjs.append(jobj)
+            yield make_bitext(jobj)
+
+    if isinstance(aligner, StreamingAligner):
+        aligned = aligner.align_stream(bitext_lines())
+    else:
+        aligned = map(aligner.align, bitext_lines())
 
-    for line in tqdm(sys.stdin):
-        jobj = json.loads(line)
-        bitext_line = make_bitext(jobj)
-        # print('bitext line', bitext_line)
-        alignments = aligner.align(bitext_line)
+    for alignments in tqdm(aligned):
+        jobj = jobjs.popleft()
         # print('alignments', alignments)
         t2s = parse_alignments(alignments)
         # print('t2s', t2s)
@@ -131,14 +274,13 @@ def main():
         src, trg = get_source_target(jobj)
         src_words = src.split()
         tgt_words = trg.split()
-        attention = []
+        alignment = numpy.zeros((len(tgt_words), len(src_words)))
 
         for i, _word in enumerate(tgt_words):
-            att = distribution(len(src_words), t2s.get(i, []))
-            attention.append(att)
+            alignment[i] = distribution(len(src_words), t2s.get(i, []))
 
-        jobj['alignment'] = attention
-        print(json.dumps(jobj, ensure_ascii=False), flush=True)
+        jobj['alignment'] = attention.encode(alignment, args.encoding)
+        textio.write_lines(sys.stdout, [jsonio.dumps(jobj)])
 
     aligner.close()
 
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+"""
+Reads and writes versioned binary artifacts made of a JSON header and named array sections.
+
+Layout:
+
+    MAGIC (8 bytes) | version (uint32) | header length (uint32) | header (UTF-8 JSON) | sections
+
+Each section is a flat `array.array`, aligned to 8 bytes. The header records the offset, type code
+and length of every section, along with any metadata the writer adds. Reading memory-maps the file
+and returns the sections as typed memoryviews, so nothing is parsed or copied at load time and
+processes that load the same file share one physical copy of it.
+
+MAGIC identifies compiled maskers; other kinds of artifact pass their own.
+"""
+
+import array
+import json
+import mmap
+import struct
+import sys
+
+from typing import Dict, Tuple
+
+MAGIC = b'SSMASKER'
+VERSION = 1
+ALIGNMENT = 8
+
+PREAMBLE = struct.Struct('<8sII')
+
+
+def write_artifact(path: str,
+                   metadata: Dict,
+                   sections: Dict[str, array.array],
+                   magic: bytes = MAGIC) -> None:
+    """
+    Writes `metadata` and the array `sections` to `path`.
+    """
+    layout = {}
+    offset = 0
+    for name, values in sections.items():
+        nbytes = len(values) * values.itemsize
+        layout[name] = {'offset': offset, 'typecode': values.typecode, 'itemsize': values.itemsize, 'length': len(values)}
+        offset += nbytes + (-nbytes % ALIGNMENT)
+
+    header = json.dumps({'byteorder': sys.byteorder, 'sections': layout, 'metadata': metadata}, ensure_ascii=False).encode('utf-8')
+    header += b' ' * (-(PREAMBLE.size + len(header)) % ALIGNMENT)
+
+    with open(path, 'wb') as outfh:
+        outfh.write(PREAMBLE.pack(magic, VERSION, len(header)))
+        outfh.write(header)
+        for name, values in sections.items():
+            data = values.tobytes()
+            outfh.write(data)
+            outfh.write(b'\0' * (-len(data) % ALIGNMENT))
+
+
+def read_artifact(path: str, magic: bytes = MAGIC) -> Tuple[Dict, Dict[str, memoryview]]:
+    """
+    Memory-maps the artifact at `path`.
+
+    :return: The metadata and a dictionary of sections as typed memoryviews.
+    """
+    with open(path, 'rb') as infh:
+        buffer = mmap.mmap(infh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    view = memoryview(buffer)
+    file_magic, version, header_length = PREAMBLE.unpack_from(view)
+    if file_magic != magic:
+        raise Exception('{} is not a {} artifact'.format(path, magic.decode('ascii')))
+    if version != VERSION:
+        raise Exception('{} has version {}, but only version {} is supported; please recompile it'.format(path, version, VERSION))
+
+    header = json.loads(bytes(view[PREAMBLE.size:PREAMBLE.size + header_length]).decode('utf-8'))
+    if header['byteorder'] != sys.byteorder:
+        raise Exception('{} was compiled on a {}-endian machine'.format(path, header['byteorder']))
+
+    base = PREAMBLE.size + header_length
+    sections = {}
+    for name, section in header['sections'].items():
+        if array.array(section['typecode']).itemsize != section['itemsize']:
+            raise Exception('{}: incompatible item size for section "{}"'.format(path, name))
+        start = base + section['offset']
+        sections[name] = view[start:start + section['length'] * section['itemsize']].cast(section['typecode'])
+
+    return header['metadata'], sections
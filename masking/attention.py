@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compact encodings of the attention and alignment matrices carried in the JSON stream.
+
+A matrix has one row per target token and one column per source token. It is written either as
+nested lists (`dense`, the default), or as an object naming its encoding:
+
+    {"encoding": "float16", "shape": [rows, cols], "data": BASE64}
+        the values as little-endian float16, row by row
+
+    {"encoding": "sparse", "shape": [rows, cols], "rows": [...], "cols": [...], "values": [...]}
+        the nonzero values only; "values" may be left out if each row's weight is spread
+        evenly over its nonzero columns, as with alignments
+
+Consumers read all of them with `decode()` or, for a few rows and columns, `select()`.
+"""
+
+import base64
+
+from typing import Dict, List, Sequence, Union
+
+import numpy
+
+ENCODINGS = ['dense', 'float16', 'sparse']
+
+Matrix = Union[List[List[float]], Dict]
+
+
+def encode(matrix, encoding: str = 'dense') -> Matrix:
+    """
+    Encodes a (target, source) matrix, given as a numpy array or nested lists.
+    """
+    if encoding == 'dense':
+        return matrix.tolist() if isinstance(matrix, numpy.ndarray) else matrix
+
+    matrix = numpy.asarray(matrix, dtype=numpy.float64).reshape(len(matrix), -1)
+    shape = list(matrix.shape)
+    if encoding == 'float16':
+        data = matrix.astype('<f2').tobytes()
+        return {'encoding': 'float16', 'shape': shape, 'data': base64.b64encode(data).decode('ascii')}
+    elif encoding == 'sparse':
+        rows, cols = numpy.nonzero(matrix)
+        encoded = {'encoding': 'sparse', 'shape': shape, 'rows': rows.tolist(), 'cols': cols.tolist()}
+        values = matrix[rows, cols]
+        if not numpy.array_equal(values, 1.0 / numpy.bincount(rows, minlength=shape[0])[rows]):
+            encoded['values'] = values.tolist()
+        return encoded
+
+    raise ValueError('Unknown matrix encoding "{}"'.format(encoding))
+
+
+def decode(value: Matrix) -> numpy.ndarray:
+    """
+    Decodes a matrix written in any of the encodings.
+    """
+    if isinstance(value, list):
+        return numpy.array(value, dtype=numpy.float64).reshape(len(value), -1)
+
+    encoding = value.get('encoding')
+    shape = tuple(value['shape'])
+    if encoding == 'float16':
+        data = base64.b64decode(value['data'])
+        return numpy.frombuffer(data, dtype='<f2').reshape(shape).astype(numpy.float64)
+    elif encoding == 'sparse':
+        matrix = numpy.zeros(shape, dtype=numpy.float64)
+        rows = numpy.array(value['rows'], dtype=numpy.intp)
+        cols = numpy.array(value['cols'], dtype=numpy.intp)
+        if 'values' in value:
+            matrix[rows, cols] = value['values']
+        elif len(rows):
+            matrix[rows, cols] = 1.0 / numpy.bincount(rows, minlength=shape[0])[rows]
+        return matrix
+
+    raise ValueError('Unknown matrix encoding "{}"'.format(encoding))
+
+
+def select(value: Matrix, rows: Sequence[int], cols: Sequence[int]) -> numpy.ndarray:
+    """
+    Returns the given rows and columns of an encoded matrix, as a (len(rows), len(cols)) array.
+    Nested lists are indexed directly rather than converted as a whole.
+    """
+    if isinstance(value, list):
+        return numpy.array([[value[i][j] for j in cols] for i in rows], dtype=numpy.float64).reshape(len(rows), len(cols))
+    return decode(value)[numpy.ix_(rows, cols)]
@@ -16,16 +16,35 @@
 - `translation`
 - `masks`
 
+`attention` (or `alignment`) may be nested lists or any of the compact encodings in attention.py.
 It then uses the `attention` values to compute an alignment between `subword_text` and `translation`.
 This alignment is in turn used to unmask the masked input.
 The unmasked string is added to the JSON object as `unmasked_translation`.
+
+Can also be imported, e.g.,
+
+    from bipar import unmask_batch
+    objs = unmask_batch(objs)
+
+Only the attention rows and columns of masks are read. Each kind of mask is then matched by a
+bipartite assignment between its source and target occurrences, with no solver needed where a
+kind occurs only once on either side.
 """
 
-from munkres import Munkres, print_matrix
-import json
+import argparse
+import itertools
 import numpy
+import os
 import sys
 
+from collections import defaultdict
+from scipy.optimize import linear_sum_assignment
+from typing import Dict, Iterable, List, Tuple
+
+# the repository root, so that the masking package can be imported when run as a script
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from masking import attention, jsonio, textio
+
 # this is a test
 # lines = ["""{"masked_text": "Vendu au plus offrant après avoir passé __NUMBER__ mois sur le banc.", "masks": [{"maskstr": "__NUMBER__", "matched": "5", "replacement": "5"}], "raw_text": "Vendu au plus offrant après avoir passé 5 mois sur le banc.", "score": 0.510886013507843, "sentence_id": 16, "subword_method": "bpe", "subword_text": "V@@ endu au plus offrant après avoir passé __NUMBER__ mois sur le ban@@ c .", "text": "Lendu at the highest bidder after 5 months on the bench.", "tok_text": "Vendu au plus offrant après avoir passé __NUMBER__ mois sur le banc .", "translation": "L@@ endu at the highest bi@@ d@@ der after __NUMBER__ months on the b@@ ench .", "merged_text": "Lendu at the highest bidder after __NUMBER__ months on the bench .", "detok_translation": "Lendu at the highest bidder after __NUMBER__ months on the bench.", "unmasked_translation": "Lendu at the highest bidder after 5 months on the bench.", "attention": [[0.36, 0.87, 0.52, 0.65, 0.97, 0.75, 0.94, 0.92, 0.58, 0.25, 0.68, 0.02, 0.57, 0.72, 0.42, 0.54], [0.19, 0.66, 0.15, 0.04, 0.13, 0.84, 0.52, 0.32, 0.76, 0.46, 0.25, 0.94, 0.44, 0.18, 0.06, 0.86], [0.8, 0.44, 0.93, 0.27, 0.17, 0.73, 0.92, 0.18, 0.97, 0.06, 0.89, 0.47, 0.79, 0.02, 0.96, 0.45], [0.8, 0.44, 0.04, 0.16, 0.0, 0.03, 0.17, 0.49, 0.25, 0.97, 0.59, 0.68, 0.75, 0.15, 0.6, 0.84], [0.73, 0.12, 0.06, 0.67, 0.77, 0.49, 0.16, 0.29, 0.01, 0.36, 0.87, 0.6, 0.15, 0.4, 0.64, 0.85], [0.56, 0.03, 0.36, 0.71, 0.55, 0.53, 0.45, 0.82, 0.96, 0.09, 0.57, 0.06, 0.35, 0.68, 0.61, 0.4], [0.35, 1.0, 0.49, 0.91, 0.05, 0.16, 0.16, 0.94, 0.92, 0.83, 0.34, 0.02, 0.66, 0.04, 0.58, 0.75], [0.7, 0.27, 0.5, 0.72, 0.58, 0.93, 0.44, 0.29, 0.21, 0.44, 0.98, 0.11, 0.15, 0.47, 0.37, 0.27], [0.73, 0.21, 0.74, 0.07, 0.25, 0.93, 0.32, 0.38, 0.75, 0.61, 0.39, 0.45, 0.69, 0.75, 0.65, 0.11], [0.91, 0.16, 0.89, 0.59, 0.01, 0.86, 0.32, 0.6, 0.34, 0.64, 0.7, 0.47, 0.02, 0.36, 0.49, 0.48], [0.06, 0.56, 0.28, 0.85, 0.11, 0.46, 0.28, 0.75, 0.59, 0.74, 0.66, 0.63, 0.71, 0.89, 0.84, 0.92], [0.77, 0.21, 0.56, 0.52, 0.97, 0.08, 0.52, 0.01, 0.48, 0.44, 0.58, 0.0, 0.81, 0.9, 0.77, 0.04], [0.71, 0.46, 0.56, 0.26, 0.29, 0.34, 0.15, 0.34, 0.9, 0.72, 0.67, 0.3, 0.02, 0.13, 0.91, 0.99], [0.11, 0.91, 0.23, 0.15, 0.18, 0.95, 0.64, 0.52, 0.34, 0.66, 0.71, 0.09, 0.37, 0.08, 0.68, 0.17], [0.81, 0.41, 0.09, 0.16, 0.55, 0.48, 0.42, 0.06, 0.92, 0.74, 0.92, 0.28, 0.09, 0.19, 0.87, 0.72]]}
 # """,
@@ -39,40 +58,67 @@ def is_mask(tok):
         return False
 
 
-m = Munkres()
-for lineno, line in enumerate(sys.stdin, 1):
-# for line in lines:
-    obj = json.loads(line)
-    
+def mask_attention(obj: Dict, source_indexes: List[int], target_indexes: List[int]) -> numpy.ndarray:
+    """
+    Returns the attention between the given source and target tokens as a (source, target) matrix,
+    reading only the rows and columns needed.
+    """
+    matrix = obj["alignment"] if "alignment" in obj else obj["attention"]
+    return attention.select(matrix, target_indexes, source_indexes).transpose()
+
+
+def assign(attention: numpy.ndarray) -> List[Tuple[int, int]]:
+    """
+    Matches the rows and columns of an attention matrix so that the total attention is highest.
+    """
+    if attention.shape[0] == 1:
+        return [(0, int(attention[0].argmax()))]
+    if attention.shape[1] == 1:
+        return [(int(attention[:, 0].argmax()), 0)]
+    rows, cols = linear_sum_assignment(attention, maximize=True)
+    return list(zip(rows.tolist(), cols.tolist()))
+
+
+def unmask(obj: Dict) -> Dict:
+    """
+    Replaces the masks in the translation of a JSON object with what they masked in its source,
+    adding the result as `unmasked_translation` (and `text`).
+    """
     if 'alignment' in obj:
         # attention is on the token level, so we need the merged text
         source_toks = obj["tok_text"].strip().split()
         target_masked_toks = obj["merged_translation"].strip().split()
-        attention = -numpy.array(obj['alignment']).transpose()
     elif 'attention' in obj:
         # attention is on bpe-level, so we need the raw output
         source_toks = obj["subword_text"].strip().split()
         target_masked_toks = obj["translation"].strip().split()
-        attention = -numpy.array(obj["attention"]).transpose()
-    target_mask_index_str = { j: target_masked_toks[j] for j in range(len(target_masked_toks)) if is_mask(target_masked_toks[j]) }
-    target_mask_str_index = {}
-    for key, value in target_mask_index_str.items():
-        target_mask_str_index.setdefault(value, list()).append(key)
-    masks = obj["masks"]
+    else:
+        raise ValueError("Can't unmask a line with neither `alignment` nor `attention`")
+
+    target_mask_str_index = defaultdict(list)
+    for j, tok in enumerate(target_masked_toks):
+        if is_mask(tok):
+            target_mask_str_index[tok].append(j)
+
+    source_mask_str_index = defaultdict(list)
+    for i, tok in enumerate(source_toks):
+        if tok in target_mask_str_index:
+            source_mask_str_index[tok].append(i)
+
+    # masks are listed in the order they were found; the offsets recorded by mask_terms.py
+    # put them in source order, so the i-th mask of a kind is its i-th occurrence in the source
+    masks = sorted(obj["masks"], key=lambda mask: mask.get("masked_token", 0))
 
     # for each identical mask
-    for key in target_mask_str_index.keys():
-        source_mask_indexes = numpy.array(sorted([ i for i in range(len(source_toks)) if source_toks[i] == key ]))
-        target_mask_indexes = numpy.array(target_mask_str_index[key])
-        effective_attention = attention[source_mask_indexes, :][:, target_mask_indexes]
-        # Munkres has shape requirements, so fool it if needed
-        transpose = effective_attention.shape[0] > effective_attention.shape[1]
-        if transpose:
-            effective_attention = effective_attention.transpose()
-        # compute bipartite matching
-        matches = m.compute(effective_attention)
-        if transpose:
-            matches = [ (j, i) for i, j in matches ]
+    for key, target_mask_indexes in target_mask_str_index.items():
+        source_mask_indexes = source_mask_str_index[key]
+        if not source_mask_indexes:
+            continue
+
+        if len(source_mask_indexes) == 1 and len(target_mask_indexes) == 1:
+            matches = [(0, 0)]
+        else:
+            matches = assign(mask_attention(obj, source_mask_indexes, target_mask_indexes))
 
         source_mask_replacements = [ mask["replacement"] for mask in masks if mask["maskstr"] == key ]
         for i, j in matches:
@@ -80,5 +126,29 @@ def is_mask(tok):
 
     obj["unmasked_translation"] = " ".join(target_masked_toks)
     obj['text'] = obj['unmasked_translation']
-    print(json.dumps(obj, ensure_ascii=False), flush=True)
-    
+    return obj
+
+
+def unmask_batch(objs: Iterable[Dict]) -> List[Dict]:
+    """
+    Unmasks a batch of JSON objects (see `unmask()`).
+    """
+    return [unmask(obj) for obj in objs]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='Number of lines to read and unmask at once. Default: %(default)s.')
+    args = parser.parse_args()
+
+    lines = textio.read_lines(sys.stdin)
+    batch = list(itertools.islice(lines, args.batch_size))
+    while batch:
+        objs = unmask_batch(jsonio.loads(line) for line in batch)
+        textio.write_lines(sys.stdout, (jsonio.dumps(obj) for obj in objs))
+        batch = list(itertools.islice(lines, args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
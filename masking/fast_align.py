@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+"""
+Forced alignment with fast_align parameters, in-process.
+
+Loads the lexical table written by `fast_align -p` and aligns sentence pairs the way
+`fast_align -i - -d -T TENSION -m MULTIPLIER -f PARAMS [-r]` does: each target word is linked to the
+source word (or NULL) with the highest translation probability times a diagonal-favoring prior.
+Output lines have the same "source ||| target ||| links ||| score" format.
+
+Usage:
+
+    model = FastAlignModel.from_err(fwd_params, fwd_err)
+    links, score = model.align(source_words, target_words)
+"""
+
+import functools
+import math
+
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy
+
+NULL = '<eps>'
+UNKNOWN_PROB = 1e-9
+
+
+def read_err(err: str) -> Tuple[float, float]:
+    """
+    Reads the diagonal tension and the mean source length multiplier from fast_align's training log.
+    """
+    (T, m) = ('', '')
+    for line in open(err):
+        # expected target length = source length * N
+        if 'expected target length' in line:
+            m = line.split()[-1]
+        # final tension: N
+        elif 'final tension' in line:
+            T = line.split()[-1]
+    return (T, m)
+
+
+def log_poisson(x: int, rate: float) -> float:
+    return math.log(rate) * x - math.lgamma(x + 1) - rate
+
+
+class FastAlignModel:
+    """
+    A fast_align lexical table with its diagonal tension. With `reverse`, source and target
+    are swapped as with `fast_align -r`, and links are still written source-target.
+
+    The table is kept as a sorted array of (source id, target id) keys with their probabilities,
+    so that all pairs of a sentence are looked up at once.
+    """
+
+    def __init__(self,
+                 params: str,
+                 tension: float,
+                 mean_srclen_multiplier: float,
+                 reverse: bool = False,
+                 prob_align_null: float = 0.08) -> None:
+        self.tension = float(tension)
+        self.mean_srclen_multiplier = float(mean_srclen_multiplier)
+        self.reverse = reverse
+        self.prob_align_null = prob_align_null
+
+        self.vocab = {NULL: 0}  # type: Dict[str, int]
+        entries = {}
+        with open(params, encoding='UTF-8') as infh:
+            for line in infh:
+                fields = line.split()
+                if len(fields) != 3:
+                    continue
+                source, target, logprob = fields
+                source_id = self.vocab.setdefault(source, len(self.vocab))
+                target_id = self.vocab.setdefault(target, len(self.vocab))
+                entries[source_id, target_id] = math.exp(float(logprob))
+
+        self.size = len(self.vocab)
+        keys = numpy.array([source_id * self.size + target_id for source_id, target_id in entries], dtype=numpy.int64)
+        probs = numpy.array(list(entries.values()), dtype=numpy.float64)
+        order = numpy.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.probs = probs[order]
+
+    @classmethod
+    def from_err(cls, params: str, err: str, reverse: bool = False) -> 'FastAlignModel':
+        """
+        Loads a model with the tension and length multiplier logged when it was trained.
+        """
+        tension, mean_srclen_multiplier = read_err(err)
+        return cls(params, tension, mean_srclen_multiplier, reverse=reverse)
+
+    def word_ids(self, words: Sequence[str]) -> numpy.ndarray:
+        return numpy.array([self.vocab.get(word, -1) for word in words], dtype=numpy.int64)
+
+    def lookup(self, source_ids: numpy.ndarray, target_ids: numpy.ndarray) -> numpy.ndarray:
+        """
+        Returns the (target, source) matrix of translation probabilities, with UNKNOWN_PROB for
+        pairs not in the table.
+        """
+        queries = target_ids[:, None] + source_ids[None, :] * self.size
+        if not len(self.keys):
+            return numpy.full(queries.shape, UNKNOWN_PROB)
+        positions = numpy.searchsorted(self.keys, queries).clip(max=len(self.keys) - 1)
+        found = (self.keys[positions] == queries) & (source_ids[None, :] >= 0) & (target_ids[:, None] >= 0)
+        return numpy.where(found, self.probs[positions], UNKNOWN_PROB)
+
+    def align(self, source: Sequence[str], target: Sequence[str]) -> Tuple[List[Tuple[int, int]], float]:
+        """
+        Aligns a sentence pair, returning its (source position, target position) links and its log probability.
+        """
+        if self.reverse:
+            source, target = target, source
+        if not source or not target:
+            return [], 0.0
+
+        source_ids = numpy.concatenate(([self.vocab[NULL]], self.word_ids(source)))
+        probs = self.lookup(source_ids, self.word_ids(target)) * diagonal_prior(len(target), len(source), self.tension, self.prob_align_null)
+
+        best = probs.argmax(axis=1)
+        if self.reverse:
+            links = [(j, i - 1) for j, i in enumerate(best.tolist()) if i > 0]
+        else:
+            links = [(i - 1, j) for j, i in enumerate(best.tolist()) if i > 0]
+
+        score = log_poisson(len(target), 0.05 + len(source) * self.mean_srclen_multiplier)
+        score += float(numpy.log(probs.sum(axis=1)).sum())
+        return links, score
+
+    def align_line(self, line: str) -> str:
+        """
+        Aligns a "source ||| target" line, returning the line with its links and score added, as fast_align does.
+        """
+        source, _, target = line.partition(' ||| ')
+        links, score = self.align(source.split(), target.split())
+        return '{} ||| {} ||| {:g}'.format(line, ' '.join('{}-{}'.format(i, j) for i, j in links), score)
+
+    def align_batch(self, lines: Iterable[str]) -> List[str]:
+        return [self.align_line(line) for line in lines]
+
+
+@functools.lru_cache(maxsize=4096)
+def diagonal_prior(m: int, n: int, tension: float, prob_align_null: float) -> numpy.ndarray:
+    """
+    Returns fast_align's alignment prior for a target of length `m` and a source of length `n`, as an
+    (m, n + 1) matrix whose first column is NULL. It is computed with the same scalar operations as
+    fast_align, so that ties in the Viterbi choice break the same way.
+    """
+    prior = numpy.empty((m, n + 1))
+    prior[:, 0] = prob_align_null
+    prob_align_not_null = 1.0 - prob_align_null
+    for j in range(1, m + 1):
+        az = diagonal_z(j, m, n, tension) / prob_align_not_null
+        for i in range(1, n + 1):
+            prior[j - 1, i] = unnormalized_prob(j, i, m, n, tension) / az
+    prior.setflags(write=False)
+    return prior
+
+
+def unnormalized_prob(i: int, j: int, m: int, n: int, alpha: float) -> float:
+    return math.exp(-abs(j / n - i / m) * alpha)
+
+
+def diagonal_z(i: int, m: int, n: int, alpha: float) -> float:
+    split = i * n / m
+    floor = int(split)
+    ceil = floor + 1
+    ratio = math.exp(-alpha / n)
+    num_top = n - floor
+    ezt = 0.0
+    ezb = 0.0
+    if num_top:
+        ezt = unnormalized_prob(i, ceil, m, n, alpha) * (1.0 - ratio ** num_top) / (1.0 - ratio)
+    if floor:
+        ezb = unnormalized_prob(i, floor, m, n, alpha) * (1.0 - ratio ** floor) / (1.0 - ratio)
+    return ezb + ezt
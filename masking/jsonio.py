@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+"""
+Decodes and encodes the JSON objects passed between pipeline stages.
+
+`loads()` and `dumps()` use the standard library's json module, and write the same bytes as
+`json.dumps(obj, ensure_ascii=False)`. Set the environment variable SOCKEYE_JSON=orjson to use
+orjson instead, which is faster but writes compact JSON, without spaces after separators, and
+writes NaN and infinities as null.
+
+With SOCKEYE_JSON_LAZY=1, `loads()` returns objects as `LazyObject`s, which only decode a field
+when it is read. Fields that are never read nor set keep the raw text they were read from, which
+`dumps()` writes back out as is, so a stage that only looks at `text` does not decode and re-encode
+big fields such as `attention`. Untouched fields are not validated. This pays off with the
+standard library, or with orjson on objects with big fields; orjson decodes short lines faster in full.
+
+Usage:
+
+    jobj = jsonio.loads(line)
+    jobj['text'] = jobj['text'].lower()
+    print(jsonio.dumps(jobj))
+"""
+
+import json
+import os
+import re
+
+from collections.abc import MutableMapping
+from typing import Any, Dict, Iterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CODEC = os.environ.get('SOCKEYE_JSON', 'json')
+if CODEC not in ('orjson', 'json'):
+    raise Exception('Unknown JSON codec "{}" in SOCKEYE_JSON; expected orjson or json'.format(CODEC))
+if CODEC == 'orjson' and orjson is None:
+    raise Exception('SOCKEYE_JSON=orjson, but orjson is not installed')
+
+LAZY = os.environ.get('SOCKEYE_JSON_LAZY', '') not in ('', '0')
+
+# how dumps() separates fields, and keys from values
+SEPARATORS = (',', ':') if CODEC == 'orjson' else (', ', ': ')
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+BRACKET_OR_QUOTE = re.compile(r'[\[\]{}"]')
+SCALAR = re.compile(r'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?|true|false|null|NaN|-?Infinity')
+
+
+class RawValue:
+    """
+    The undecoded JSON text of a field.
+    """
+    __slots__ = ('text',)
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+
+
+def skip_array(s: str, i: int) -> int:
+    """
+    Finds the end of an array without strings, such as a (dense) attention matrix, by matching
+    brackets with str.find() and str.count(). Returns -1 if the array contains a string.
+    """
+    depth = 1
+    j = i + 1
+    while depth:
+        k = s.find(']', j)
+        if k < 0:
+            return -1
+        depth += s.count('[', j, k) - 1
+        j = k + 1
+    return j if s.find('"', i, j) < 0 else -1
+
+
+def skip_nested(s: str, i: int) -> int:
+    """
+    Finds the end of an array or object, skipping over strings.
+    """
+    depth = 0
+    j = i
+    while True:
+        match = BRACKET_OR_QUOTE.search(s, j)
+        if match is None:
+            return -1
+        c = match.group()
+        if c == '"':
+            string = STRING.match(s, match.start())
+            if string is None:
+                return -1
+            j = string.end()
+            continue
+        j = match.end()
+        if c == '[' or c == '{':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return j
+
+
+def skip_value(s: str, i: int) -> int:
+    """
+    Returns the position just past the JSON value starting at position `i` of `s`, without decoding it.
+    """
+    c = s[i:i + 1]
+    end = -1
+    if c == '"':
+        match = STRING.match(s, i)
+        end = match.end() if match is not None else -1
+    elif c == '[' or c == '{':
+        if c == '[':
+            end = skip_array(s, i)
+        if end < 0:
+            end = skip_nested(s, i)
+    else:
+        match = SCALAR.match(s, i)
+        end = match.end() if match is not None else -1
+    if end < 0:
+        raise json.JSONDecodeError('Expecting value', s, i)
+    return end
+
+
+def scan_object(s: str) -> Dict[str, RawValue]:
+    """
+    Splits the JSON object in `s` into its keys and the raw text of their values.
+    """
+    i = WHITESPACE.match(s, 0).end()
+    if s[i:i + 1] != '{':
+        raise json.JSONDecodeError('Expecting object', s, i)
+    fields = {}
+    i = WHITESPACE.match(s, i + 1).end()
+    if s[i:i + 1] != '}':
+        while True:
+            if s[i:i + 1] != '"':
+                raise json.JSONDecodeError('Expecting property name enclosed in double quotes', s, i)
+            key, i = json.decoder.scanstring(s, i + 1)
+            i = WHITESPACE.match(s, i).end()
+            if s[i:i + 1] != ':':
+                raise json.JSONDecodeError("Expecting ':' delimiter", s, i)
+            i = WHITESPACE.match(s, i + 1).end()
+            end = skip_value(s, i)
+            fields[key] = RawValue(s[i:end])
+            i = WHITESPACE.match(s, end).end()
+            if s[i:i + 1] == ',':
+                i = WHITESPACE.match(s, i + 1).end()
+            elif s[i:i + 1] == '}':
+                break
+            else:
+                raise json.JSONDecodeError("Expecting ',' delimiter", s, i)
+    i = WHITESPACE.match(s, i + 1).end()
+    if i != len(s):
+        raise json.JSONDecodeError('Extra data', s, i)
+    return fields
+
+
+class LazyObject(MutableMapping):
+    """
+    A JSON object whose fields are decoded when they are first read.
+    """
+
+    def __init__(self, text: str) -> None:
+        self.fields = scan_object(text)
+
+    def __getitem__(self, key: str) -> Any:
+        value = self.fields[key]
+        if isinstance(value, RawValue):
+            # once read, a value may be changed in place, so it is encoded again on output
+            value = self.fields[key] = decode(value.text)
+        return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self.fields[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        del self.fields[key]
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.fields
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.fields)
+
+    def __len__(self) -> int:
+        return len(self.fields)
+
+    def __repr__(self) -> str:
+        return 'LazyObject({})'.format(dumps(self))
+
+
+def decode(text: str) -> Any:
+    if orjson is not None and CODEC == 'orjson':
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            # e.g., NaN, which orjson does not read; otherwise, this raises json's own error
+            pass
+    return json.loads(text)
+
+
+def loads(text: str, lazy: bool = LAZY) -> Any:
+    """
+    Decodes a line of JSON; with `lazy`, an object is decoded field by field as a LazyObject.
+    """
+    if lazy and text.lstrip().startswith('{'):
+        return LazyObject(text)
+    return decode(text)
+
+
+def encode(obj: Any, ensure_ascii: bool = False) -> str:
+    if CODEC == 'orjson' and not ensure_ascii:
+        try:
+            return orjson.dumps(obj).decode('utf-8')
+        except TypeError:
+            # e.g., integers beyond 64 bits, which orjson does not write
+            pass
+    return json.dumps(obj, ensure_ascii=ensure_ascii, separators=SEPARATORS)
+
+
+def dumps(obj: Any, ensure_ascii: bool = False) -> str:
+    """
+    Encodes `obj` as a line of JSON. The untouched fields of a LazyObject are copied as they were read
+    (unless they need escaping for `ensure_ascii`).
+    """
+    if not isinstance(obj, LazyObject):
+        return encode(obj, ensure_ascii)
+
+    item_separator, key_separator = SEPARATORS
+    items = []
+    for key, value in obj.fields.items():
+        if isinstance(value, RawValue):
+            if ensure_ascii and not value.text.isascii():
+                value = encode(decode(value.text), ensure_ascii)
+            else:
+                value = value.text
+        else:
+            value = encode(value, ensure_ascii)
+        items.append(encode(key, ensure_ascii) + key_separator + value)
+    return '{' + item_separator.join(items) + '}'
@@ -1,19 +1,28 @@
 #!/usr/bin/env python3
 import argparse
+import array
+import bisect
+import functools
+import itertools
 import json
 import logging
 import os
 import random
 import regex as re
 import sys
+import time
 
-from collections import defaultdict, namedtuple
-from typing import List, Optional, Tuple, Dict
+from collections import Counter, defaultdict, deque, namedtuple
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 from operator import itemgetter
 
+# the repository root, so that the masking package can be imported when run as a script
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from masking import artifact, jsonio, textio, urls
+
 
 def is_comment_or_empty(s: str) -> str:
-    return s.startswith('#') or re.search(r'^\s*$', s)
+    return s.startswith('#') or not s.strip()
 
 
 def singlespace(s: str) -> str:
@@ -22,20 +31,667 @@ def singlespace(s: str) -> str:
     return s
 
 
+def scope_inline_flags(pattern: str) -> str:
+    """
+    Turns leading global inline flags, e.g., `(?i)`, into a scoped group, so that they only
+    apply to this pattern once it is combined with others.
+    """
+    match = re.match(r'\(\?([aiLmsux]+)\)', pattern)
+    if match is not None:
+        pattern = '(?{}:{})'.format(match.group(1), pattern[match.end():])
+    return pattern
+
+
+def find_class_end(pattern: str, i: int) -> Optional[int]:
+    """
+    Returns the index just past the character class that opens at `pattern[i]`, or None if it is not closed.
+    """
+    j = i + 1
+    if pattern.startswith('^', j):
+        j += 1
+    if pattern.startswith(']', j):
+        j += 1
+    while j < len(pattern):
+        if pattern[j] == '\\':
+            j += 2
+        elif pattern.startswith('[:', j):
+            end = pattern.find(':]', j + 2)
+            if end == -1:
+                return None
+            j = end + 2
+        elif pattern[j] == ']':
+            return j + 1
+        else:
+            j += 1
+    return None
+
+
+GROUP_REFERENCE = re.compile(r'\\(?:([1-9][0-9]?)|g<([0-9]+)>)|\(\?\(([0-9]+)\)')
+
+
+def shift_group_references(pattern: str, offset: int, groups: int) -> str:
+    """
+    Rewrites the references to numbered groups in `pattern` (`\\1`, `\\g<1>` and `(?(1)...)`), which has
+    `groups` groups of its own, so that they still refer to them once `offset` groups come before them.
+    """
+    if not offset:
+        return pattern
+
+    pieces = []
+    last = 0
+    i = 0
+    while i < len(pattern):
+        match = GROUP_REFERENCE.match(pattern, i)
+        if match is not None:
+            number = int(match.group(1) or match.group(2) or match.group(3))
+            if number <= groups:
+                reference = '\\g<{}>' if match.group(3) is None else '(?({})'
+                pieces.append(pattern[last:i])
+                pieces.append(reference.format(number + offset))
+                last = match.end()
+            i = match.end()
+        elif pattern[i] == '\\':
+            i += 2
+        elif pattern[i] == '[':
+            end = find_class_end(pattern, i)
+            i = end if end is not None else len(pattern)
+        else:
+            i += 1
+    pieces.append(pattern[last:])
+    return ''.join(pieces)
+
+
+def find_group_end(pattern: str, i: int) -> Optional[int]:
+    """
+    Returns the index just past the group that opens at `pattern[i]`, or None if it is not closed.
+    """
+    depth = 0
+    j = i
+    while j < len(pattern):
+        if pattern[j] == '\\':
+            j += 2
+            continue
+        elif pattern[j] == '[':
+            j = find_class_end(pattern, j)
+            if j is None:
+                return None
+            continue
+        elif pattern[j] == '(':
+            depth += 1
+        elif pattern[j] == ')':
+            depth -= 1
+            if depth == 0:
+                return j + 1
+        j += 1
+    return None
+
+
+def required_conditions(pattern: str) -> List[Tuple]:
+    """
+    Works out what any match of `pattern` must contain by walking its top-level atoms.
+    Each literal or character class (e.g., `\\@` or `\\d`) that is not optional or inside a group
+    becomes a requirement, represented as a one-element tuple holding the literal character or the
+    compiled class. An empty list means that no requirement could be established.
+    """
+    if re.search(r'\(\?[aiLmsux-]+\)', pattern):
+        # global inline flags (e.g., case-insensitivity) change what literals match
+        return []
+
+    requirements = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '|':
+            return []
+        elif char == '\\':
+            escaped = pattern[i + 1:i + 2]
+            if escaped in ('d', 'w', 's', 'D', 'W', 'S'):
+                atom = re.compile('\\' + escaped)
+            elif escaped in ('b', 'B', 'A', 'Z'):
+                atom = None
+            elif escaped and not escaped.isalnum():
+                atom = escaped
+            else:
+                return []
+            i += 2
+        elif char == '[':
+            end = find_class_end(pattern, i)
+            if end is None:
+                return []
+            atom = re.compile(pattern[i:end])
+            i = end
+        elif char == '(':
+            end = find_group_end(pattern, i)
+            if end is None:
+                return []
+            atom = None
+            i = end
+        elif char in '.^$':
+            atom = None
+            i += 1
+        else:
+            atom = char
+            i += 1
+
+        optional = False
+        if pattern.startswith(('?', '*'), i):
+            optional = True
+            i += 1
+        elif pattern.startswith('+', i):
+            i += 1
+        elif pattern.startswith('{', i):
+            quantifier = re.match(r'\{(\d*)(,\d*)?\}', pattern[i:])
+            if quantifier is not None:
+                optional = quantifier.group(1) in ('', '0')
+                i += quantifier.end()
+        if pattern.startswith(('?', '+'), i):
+            # lazy or possessive quantifier
+            i += 1
+
+        if atom is not None and not optional:
+            requirements.append((atom,))
+
+    return requirements
+
+
+def requirement_holds(requirement: Tuple, source: str, cache: Dict) -> bool:
+    """
+    Checks whether any alternative of a requirement (a literal string or a compiled character class) occurs in `source`.
+    Results are memoized in `cache`, since many patterns share requirements.
+    """
+    if requirement not in cache:
+        cache[requirement] = any(item in source if isinstance(item, str) else item.search(source) is not None
+                                 for item in requirement)
+    return cache[requirement]
+
+
+def apply_mods(text: str, mod_list: List[Tuple[int, int, str]]) -> str:
+    """
+    Applies a list of (position, matched length, replacement) modifications to `text`,
+    building the new string in a single pass.
+    Positions refer to the unmodified text and the list must be sorted by position.
+    """
+    if not mod_list:
+        return text
+
+    pieces = []
+    prev = 0
+    for i, matched_len, mask in mod_list:
+        pieces.append(text[prev:i])
+        pieces.append(mask)
+        prev = i + matched_len
+    pieces.append(text[prev:])
+    return ''.join(pieces)
+
+
+class OffsetMap:
+    """
+    Maps character offsets between a string and the string `apply_mods()` rewrote it into,
+    given the (start, end) span of each rewritten piece on both sides.
+    Offsets inside a rewritten piece map to the start of the piece on the other side, or to its end for end offsets.
+    """
+    def __init__(self, spans: Iterable[Tuple[int, int, int, int]]) -> None:
+        spans = sorted(spans)
+        self.before = [(start, end) for start, end, _, _ in spans]
+        self.after = [(start, end) for _, _, start, end in spans]
+
+    @staticmethod
+    def map(offset: int, source: List[Tuple[int, int]], dest: List[Tuple[int, int]], is_end: bool) -> int:
+        i = bisect.bisect_right(source, (offset, sys.maxsize)) - 1
+        if i < 0:
+            return offset
+        start, end = source[i]
+        if offset >= end:
+            return offset + dest[i][1] - end
+        if offset == start or not is_end:
+            return dest[i][0]
+        return dest[i][1]
+
+    def forward(self, offset: int, is_end: bool = False) -> int:
+        return self.map(offset, self.before, self.after, is_end)
+
+    def backward(self, offset: int, is_end: bool = False) -> int:
+        return self.map(offset, self.after, self.before, is_end)
+
+    @classmethod
+    def from_masks(cls, masks: List[Dict]) -> 'OffsetMap':
+        return cls((mask["start"], mask["end"], mask["masked_start"], mask["masked_end"]) for mask in masks)
+
+
+TOKEN = re.compile(r'[^ ]+')
+
+
+def split_tokens(text: str) -> List[str]:
+    """
+    Splits a sentence into tokens on single spaces, once stripped, so that repeated spaces give empty tokens.
+    The token offsets recorded on masks refer to these tokens.
+    """
+    return text.strip().split(' ')
+
+
+def token_offsets(text: str) -> Tuple[List[int], List[int]]:
+    """
+    Returns the start and end character offsets in `text` of the tokens of `split_tokens(text)`.
+    """
+    starts, ends = [], []
+    start = len(text) - len(text.lstrip())
+    for token in split_tokens(text):
+        starts.append(start)
+        ends.append(start + len(token))
+        start += len(token) + 1
+    return starts, ends
+
+
+WORD_BOUNDARY = re.compile(r'\b')
+
+COMPILED_MASKER_VERSION = 2
+
+# With a line timeout, the share of it the combined pattern scan may use
+COMBINED_SCAN_SHARE = 0.5
+
+# Checks on named groups in patterns: a match whose group fails its check is discarded
+MATCH_CHECKS = {
+    'tld': urls.is_tld,
+}
+GROUP_NAME = re.compile(r'\(\?P<(\w+)>')
+
+
+def leftmost_longest(candidates: List[Tuple[int, int, int]]) -> List[Tuple[int, int, int]]:
+    """
+    Selects non-overlapping (start, end, id) candidates, preferring the leftmost and then the longest.
+    """
+    candidates.sort(key=lambda candidate: (candidate[0], -candidate[1]))
+    matches = []
+    last_end = -1
+    for start, end, term_id in candidates:
+        if start >= last_end:
+            matches.append((start, end, term_id))
+            last_end = end
+
+    return matches
+
+
+class TermStore:
+    """
+    Compact storage for dictionary entries, indexed by term id (the order in which they were loaded).
+    Terms and replacements are each kept as UTF-8 in a single buffer with an array of offsets, and
+    labels are interned, with an array of label ids into a short list of labels.
+
+    The arrays can also be memoryviews into a compiled masker, in which case the store is read-only
+    and every process mapping the same file shares a single physical copy of it.
+    """
+    def __init__(self,
+                 sections: Optional[Dict] = None,
+                 labels: Optional[List[str]] = None) -> None:
+        if sections is None:
+            sections = {
+                'terms': array.array('B'),
+                'term_offsets': array.array('q', [0]),
+                'replacements': array.array('B'),
+                'replacement_offsets': array.array('q', [0]),
+                'label_ids': array.array('i'),
+            }
+        self.terms = sections['terms']
+        self.term_offsets = sections['term_offsets']
+        self.replacements = sections['replacements']
+        self.replacement_offsets = sections['replacement_offsets']
+        self.label_ids = sections['label_ids']
+        self.labels = list(labels) if labels is not None else []
+        self.label_index = {label: i for i, label in enumerate(self.labels)}
+
+    def __len__(self) -> int:
+        return len(self.label_ids)
+
+    @property
+    def read_only(self) -> bool:
+        return not isinstance(self.label_ids, array.array)
+
+    def append(self, term: str, replacement: str, label: str) -> int:
+        """
+        Adds an entry and returns its term id.
+        """
+        if self.read_only:
+            raise Exception('Cannot add terms to a compiled masker')
+
+        self.terms.frombytes(term.encode('utf-8'))
+        self.term_offsets.append(len(self.terms))
+        self.replacements.frombytes(replacement.encode('utf-8'))
+        self.replacement_offsets.append(len(self.replacements))
+        if label not in self.label_index:
+            self.label_index[label] = len(self.labels)
+            self.labels.append(label)
+        self.label_ids.append(self.label_index[label])
+
+        return len(self.label_ids) - 1
+
+    def term(self, term_id: int) -> str:
+        return str(self.terms[self.term_offsets[term_id]:self.term_offsets[term_id + 1]], 'utf-8')
+
+    def __getitem__(self, term_id: int) -> Tuple[str, str]:
+        """
+        Returns the (replacement, label) pair of a term.
+        """
+        start, end = self.replacement_offsets[term_id], self.replacement_offsets[term_id + 1]
+        return str(self.replacements[start:end], 'utf-8'), self.labels[self.label_ids[term_id]]
+
+    def to_arrays(self) -> Dict:
+        return {
+            'terms': self.terms,
+            'term_offsets': self.term_offsets,
+            'replacements': self.replacements,
+            'replacement_offsets': self.replacement_offsets,
+            'label_ids': self.label_ids,
+        }
+
+
+class TermIndex:
+    """
+    An Aho-Corasick automaton over dictionary terms.
+    It finds every term occurring in a sentence in a single left-to-right scan, so the cost
+    of matching depends on the sentence length rather than on the size of the dictionary.
+
+    Like the `\\b...\\b` regexes it replaces, a match must begin and end on a word boundary.
+    Overlapping matches are resolved leftmost-longest.
+
+    The automaton is stored in flat arrays: per-state failure links, output links and terminal
+    term ids, and each state's outgoing edges as a slice of edge arrays sorted by character,
+    which are searched by bisection. The arrays are either built with `build()` or are
+    memoryviews into a compiled masker.
+    """
+    SECTIONS = ('fail', 'terminal', 'output_link', 'edge_offsets', 'edge_chars', 'edge_targets', 'key_lengths')
+
+    def __init__(self, sections: Dict) -> None:
+        self.fail = sections['fail']
+        self.terminal = sections['terminal']
+        self.output_link = sections['output_link']
+        self.edge_offsets = sections['edge_offsets']
+        self.edge_chars = sections['edge_chars']
+        self.edge_targets = sections['edge_targets']
+        self.key_lengths = sections['key_lengths']
+
+    def __len__(self) -> int:
+        return len(self.key_lengths)
+
+    @classmethod
+    def build(cls, store: TermStore) -> 'TermIndex':
+        """
+        Builds the automaton over the terms in `store`.
+        The trie is built from the sorted terms, so that each state's edges are created in character
+        order, and the failure and output links are then computed with a breadth-first traversal.
+        If a term occurs more than once, the first one wins.
+        """
+        keys = [store.term(term_id) for term_id in range(len(store))]
+
+        terminal = array.array('i', [-1])
+        edge_parents = array.array('i')
+        edge_chars = array.array('I')
+        edge_targets = array.array('i')
+        path = [0]
+        prev = None
+        for term_id in sorted(range(len(keys)), key=keys.__getitem__):
+            key = keys[term_id]
+            if key == prev:
+                continue
+
+            common = 0
+            if prev is not None:
+                limit = min(len(key), len(prev))
+                while common < limit and key[common] == prev[common]:
+                    common += 1
+            del path[common + 1:]
+            for char in key[common:]:
+                state = len(terminal)
+                terminal.append(-1)
+                edge_parents.append(path[-1])
+                edge_chars.append(ord(char))
+                edge_targets.append(state)
+                path.append(state)
+            terminal[path[-1]] = term_id
+            prev = key
+
+        # group the edges by parent state (a stable counting sort, so they stay sorted by character)
+        num_states = len(terminal)
+        edge_offsets = array.array('i', [0]) * (num_states + 1)
+        for parent in edge_parents:
+            edge_offsets[parent + 1] += 1
+        for state in range(num_states):
+            edge_offsets[state + 1] += edge_offsets[state]
+        positions = edge_offsets[:-1]
+        sorted_chars = array.array('I', [0]) * len(edge_chars)
+        sorted_targets = array.array('i', [0]) * len(edge_targets)
+        for parent, char, target in zip(edge_parents, edge_chars, edge_targets):
+            sorted_chars[positions[parent]] = char
+            sorted_targets[positions[parent]] = target
+            positions[parent] += 1
+
+        index = cls({
+            'fail': array.array('i', [0]) * num_states,
+            'terminal': terminal,
+            'output_link': array.array('i', [0]) * num_states,
+            'edge_offsets': edge_offsets,
+            'edge_chars': sorted_chars,
+            'edge_targets': sorted_targets,
+            'key_lengths': array.array('i', map(len, keys)),
+        })
+
+        fail, output_link = index.fail, index.output_link
+        queue = deque(sorted_targets[edge_offsets[0]:edge_offsets[1]])
+        while queue:
+            state = queue.popleft()
+            for i in range(edge_offsets[state], edge_offsets[state + 1]):
+                code, next_state = sorted_chars[i], sorted_targets[i]
+                queue.append(next_state)
+                fallback = fail[state]
+                following = index.next_state(fallback, code)
+                while following < 0 and fallback:
+                    fallback = fail[fallback]
+                    following = index.next_state(fallback, code)
+                link = max(following, 0)
+                fail[next_state] = link
+                output_link[next_state] = link if terminal[link] >= 0 else output_link[link]
+
+        return index
+
+    def next_state(self, state: int, code: int) -> int:
+        """
+        Follows the edge labeled with character `code` out of `state`, returning -1 if there is none.
+        """
+        lo, hi = self.edge_offsets[state], self.edge_offsets[state + 1]
+        i = bisect.bisect_left(self.edge_chars, code, lo, hi)
+        return self.edge_targets[i] if i < hi and self.edge_chars[i] == code else -1
+
+    def find(self, text: str) -> List[Tuple[int, int, int]]:
+        """
+        Finds all non-overlapping term matches in `text`, preferring the leftmost and then the longest.
+
+        :return: A list of (start, end, term id) triples, sorted by position.
+        """
+        return leftmost_longest(self.find_all(text))
+
+    def find_all(self, text: str) -> List[Tuple[int, int, int]]:
+        """
+        Finds all term matches on word boundaries in `text`, including overlapping ones.
+
+        :return: A list of (start, end, term id) triples, in the order of their ends.
+        """
+        if not len(self):
+            return []
+
+        boundaries = {match.start() for match in WORD_BOUNDARY.finditer(text)}
+        next_state, fail, terminal, output_link, key_lengths = self.next_state, self.fail, self.terminal, self.output_link, self.key_lengths
+
+        candidates = []
+        state = 0
+        for end, char in enumerate(text, 1):
+            code = ord(char)
+            following = next_state(state, code)
+            while following < 0 and state:
+                state = fail[state]
+                following = next_state(state, code)
+            state = max(following, 0)
+            if end not in boundaries:
+                continue
+
+            match = state if terminal[state] >= 0 else output_link[state]
+            while match:
+                term_id = terminal[match]
+                start = end - key_lengths[term_id]
+                if start in boundaries:
+                    candidates.append((start, end, term_id))
+                match = output_link[match]
+
+        return candidates
+
+    def get(self, term: str) -> Optional[int]:
+        """
+        Returns the id of `term`, or None if it is not in the index.
+        """
+        state = 0
+        for char in term:
+            state = self.next_state(state, ord(char))
+            if state < 0:
+                return None
+        return self.terminal[state] if self.terminal[state] >= 0 else None
+
+    def to_arrays(self) -> Dict:
+        return {name: getattr(self, name) for name in self.SECTIONS}
+
+
+@functools.lru_cache(maxsize=65536)
+def first_word_piece(text: str) -> str:
+    """
+    Returns the prefix of `text` up to its first internal word boundary (or all of `text` if it has none).
+    """
+    match = WORD_BOUNDARY.search(text, 1)
+    return text[:match.start()] if match is not None else text
+
+
+class TargetIndex:
+    """
+    An index over a target sentence, built once per sentence pair, that finds whole-word occurrences
+    of replacement strings (as `\\b...\\b` would) without compiling a regex or rescanning the target.
+
+    The target is cut into pieces at its word boundaries. Any occurrence of a string on word boundaries
+    begins with a piece equal to the string's first piece, so a lookup only verifies the few offsets
+    stored under that piece. Occurrences that have been masked are claimed and not returned again.
+    """
+    def __init__(self, target: str) -> None:
+        self.target = target
+        boundaries = [match.start() for match in WORD_BOUNDARY.finditer(target)]
+        self.boundaries = set(boundaries)
+        self.offsets = defaultdict(list)
+        for start, end in zip(boundaries, boundaries[1:]):
+            self.offsets[target[start:end]].append(start)
+        self.masked = bytearray(len(target))
+
+    def find(self, text: str) -> Optional[Tuple[int, int]]:
+        """
+        Finds the first unmasked whole-word occurrence of `text`.
+
+        :return: The (start, end) span of the occurrence, or None.
+        """
+        if not text:
+            return None
+
+        for start in self.offsets.get(first_word_piece(text), ()):
+            end = start + len(text)
+            if end in self.boundaries and self.target.startswith(text, start) and self.masked.find(1, start, end) == -1:
+                return start, end
+        return None
+
+    def claim(self, start: int, end: int) -> None:
+        """
+        Marks a span as masked.
+        """
+        self.masked[start:end] = b'\x01' * (end - start)
+
+
+class MaskerStats:
+    """
+    Wall time and hit counts per pattern and per dictionary file, aggregated over every line masked.
+
+    Since all patterns are matched in one combined scan, each active pattern is also timed on its own
+    so that the cost of individual patterns can be compared; this roughly doubles the pattern matching time.
+    Dictionary terms are all found by a single automaton scan, whose time is reported once,
+    with the time to load each dictionary file reported per file.
+    """
+    def __init__(self) -> None:
+        self.lines = 0
+        self.term_time = 0.0
+        self.pattern_time = 0.0
+        self.patterns = defaultdict(Counter)
+        self.dictionaries = defaultdict(Counter)
+
+    def record(self, origin: Tuple[str, int], key: str, value=1) -> None:
+        kind, i = origin
+        stats = self.patterns if kind == 'pattern' else self.dictionaries
+        stats[i][key] += value
+
+    def report(self, masker: 'TermMasker') -> Dict:
+        """
+        Returns the aggregated statistics as a JSON-serializable dict.
+        """
+        def fields(counter, keys):
+            return {key: counter[key] for key in keys}
+
+        patterns = []
+        for i, (pattern, label) in enumerate(masker.patterns):
+            entry = {'pattern': pattern, 'label': label}
+            entry.update(fields(self.patterns[i], ['time', 'lines_scanned', 'lines_skipped', 'matches', 'masked', 'missed', 'timeouts']))
+            patterns.append(entry)
+
+        dictionaries = []
+        for i, file in enumerate(masker.dict_files):
+            entry = {'file': file, 'terms': masker.dict_sizes[i]}
+            entry.update(fields(self.dictionaries[i], ['load_time', 'matches', 'masked', 'missed']))
+            dictionaries.append(entry)
+
+        return {
+            'lines': self.lines,
+            'pattern_time': self.pattern_time,
+            'term_time': self.term_time,
+            'lines_timed_out': masker.lines_timed_out,
+            'patterns': patterns,
+            'dictionaries': dictionaries,
+        }
+
+
 class TermMasker:
     def __init__(self,
                  pattern_files: List[str],
                  dict_files: List[str],
                  add_index: Optional[bool] = False,
                  plabel_override: Optional[str] = None,
-                 dlabel_override: Optional[str] = None) -> None:
+                 dlabel_override: Optional[str] = None,
+                 single_pass: Optional[bool] = False,
+                 stats: Optional[bool] = False,
+                 pattern_timeout: Optional[float] = None,
+                 line_timeout: Optional[float] = None) -> None:
 
         self.patterns = []
-        self.terms = {}
+        self.pattern_requirements = []
+        self.pattern_regex = None
+        self.pattern_regexes = {}
+        self.pattern_groups = []
+        self.pattern_checks = []
+        self.term_store = TermStore()
+        self.term_index = TermIndex.build(self.term_store)
+        self.dict_files = []
+        self.dict_starts = []
+        self.dict_sizes = []
 
         self.default_label = "TERM"
 
         self.add_index = add_index
+        self.single_pass = single_pass
+        self.stats = MaskerStats() if stats else None
+
+        # Time budgets (in seconds) for a single pattern and for all patterns on a line;
+        # patterns running out of time are skipped and counted here
+        self.pattern_timeout = pattern_timeout
+        self.line_timeout = line_timeout
+        self.timeouts = defaultdict(int)
+        self.lines_timed_out = 0
 
         for file in pattern_files:
             self.load_patterns(file, plabel_override)
@@ -50,6 +706,57 @@ def reset_counts(self):
         self.counts = defaultdict(int)
         self.counts_missed = defaultdict(int)
 
+    def save(self, path: str) -> None:
+        """
+        Compiles the loaded patterns, labels and term index into a versioned binary artifact
+        that `TermMasker.load()` memory-maps.
+        """
+        sections = self.term_index.to_arrays()
+        sections.update(self.term_store.to_arrays())
+
+        metadata = {
+            'version': COMPILED_MASKER_VERSION,
+            'patterns': self.patterns,
+            'pattern_requirements': [[[['literal', item] if isinstance(item, str) else ['class', item.pattern] for item in requirement]
+                                      for requirement in requirements]
+                                     for requirements in self.pattern_requirements],
+            'labels': self.term_store.labels,
+            'dict_files': [[file, start, size] for file, start, size in zip(self.dict_files, self.dict_starts, self.dict_sizes)],
+        }
+        artifact.write_artifact(path, metadata, sections)
+
+    @classmethod
+    def load(cls,
+             path: str,
+             add_index: Optional[bool] = False,
+             single_pass: Optional[bool] = False,
+             stats: Optional[bool] = False,
+             pattern_timeout: Optional[float] = None,
+             line_timeout: Optional[float] = None) -> 'TermMasker':
+        """
+        Loads a masker compiled with `save()`. The term index is memory-mapped rather than read,
+        so loading takes the same time whatever the dictionary size.
+        """
+        metadata, sections = artifact.read_artifact(path)
+        if metadata.get('version', 1) != COMPILED_MASKER_VERSION:
+            raise Exception('{} was compiled by an older version of mask_terms.py; please recompile it'.format(path))
+
+        masker = cls([], [], add_index=add_index, single_pass=single_pass, stats=stats,
+                     pattern_timeout=pattern_timeout, line_timeout=line_timeout)
+        masker.patterns = [tuple(pattern) for pattern in metadata['patterns']]
+        masker.pattern_requirements = [[tuple(item if kind == 'literal' else re.compile(item) for kind, item in requirement)
+                                        for requirement in requirements]
+                                       for requirements in metadata['pattern_requirements']]
+        masker.compile_patterns()
+        masker.term_index = TermIndex(sections)
+        masker.term_store = TermStore(sections, metadata['labels'])
+        for file, start, size in metadata.get('dict_files', []):
+            masker.dict_files.append(file)
+            masker.dict_starts.append(start)
+            masker.dict_sizes.append(size)
+
+        return masker
+
     def load_dictionary(self, file: str, label_override: Optional[str] = None):
         """
         Loads dictionary terms from a file.
@@ -59,7 +766,11 @@ def load_dictionary(self, file: str, label_override: Optional[str] = None):
         Their format is
 
         source TAB target TAB label
+
+        Entries are added to `self.term_store`, and `self.term_index` is rebuilt once the file is read.
         """
+        start_time = time.perf_counter()
+        first_term = len(self.term_store)
 
         with open(file, encoding='UTF-8') as infh:
             for line in infh:
@@ -79,9 +790,17 @@ def load_dictionary(self, file: str, label_override: Optional[str] = None):
                     label = label_override
 
                 # TODO: Deal with multiple translations
-                #   We have no way to tell which one to pick now, so just go with the first
-                if term not in self.terms:
-                    self.terms[term] = (replacement, label)
+                #   We have no way to tell which one to pick now, so the index goes with the first
+                if term:
+                    self.term_store.append(term, replacement, label)
+
+        self.term_index = TermIndex.build(self.term_store)
+
+        self.dict_files.append(file)
+        self.dict_starts.append(first_term)
+        self.dict_sizes.append(len(self.term_store) - first_term)
+        if self.stats is not None:
+            self.stats.dictionaries[len(self.dict_files) - 1]['load_time'] += time.perf_counter() - start_time
 
     def load_patterns(self,
                       file: str,
@@ -90,11 +809,19 @@ def load_patterns(self,
         Loads patterns from a file.
         Patterns are of the form
 
-            PATTERN ||| MASK
+            PATTERN ||| MASK [||| REQUIRES]
 
         where PATTERN is a regular expression (matching anywhere in the string) and MASK
         the mask to replace it with.
         If `label_override` is defined, it will be used as the mask always.
+
+        Before any regex work, a pattern is only tried on sentences meeting its requirements.
+        These are worked out from the pattern's top-level literals and character classes, or given
+        explicitly in the optional REQUIRES field as a space-separated list of strings, at least one
+        of which must occur in the sentence (e.g., `. ://`).
+
+        A named group in PATTERN whose name is in MATCH_CHECKS must also pass that check; e.g., the
+        text of a `(?P<tld>...)` group must be a known top-level domain (see urls.py).
         """
         with open(file, encoding='UTF-8') as infh:
             for line in infh:
@@ -106,11 +833,148 @@ def load_patterns(self,
                     raise Exception('Invalid pattern file: all lines must have a label')
                 pattern = elements[0].strip()
                 label = label_override if label_override else elements[1].strip()
+                if len(elements) > 2 and elements[2].strip():
+                    requirements = [tuple(elements[2].split())]
+                else:
+                    requirements = required_conditions(pattern)
 
                 # Boundary checking also needs to be handled in the patterns themselves
                 # because the behavior is different with word/non-word characters
                 # on the edges!
                 self.patterns.append((pattern, label))
+                self.pattern_requirements.append(requirements)
+
+        self.compile_patterns()
+
+    def compile_patterns(self) -> None:
+        """
+        Compiles all patterns into a single alternation with one named group per pattern,
+        so that a sentence is searched for every pattern in a single scan.
+        Where matches of several patterns start at the same position, the earliest pattern wins.
+        References to numbered groups are shifted to where the groups end up in the combined regex.
+        """
+        self.pattern_regexes = {}
+        self.pattern_groups = [re.compile(scope_inline_flags(pattern)).groups for pattern, _ in self.patterns]
+        self.pattern_checks = [[name for name in GROUP_NAME.findall(pattern) if name in MATCH_CHECKS]
+                               for pattern, _ in self.patterns]
+        self.pattern_regex = self.get_pattern_regex(tuple(range(len(self.patterns))))
+
+    def get_pattern_regex(self, pattern_ids: Tuple[int, ...]):
+        """
+        Returns the combined regex for a subset of the patterns, compiling it on first use.
+        """
+        if not pattern_ids:
+            return None
+
+        if pattern_ids not in self.pattern_regexes:
+            alternatives = []
+            offset = 0
+            for i in pattern_ids:
+                # the pattern's groups come after those of the patterns before it and its own named group
+                offset += 1
+                pattern = shift_group_references(scope_inline_flags(self.patterns[i][0]), offset, self.pattern_groups[i])
+                alternatives.append('(?P<p{}>{})'.format(i, pattern))
+                offset += self.pattern_groups[i]
+            self.pattern_regexes[pattern_ids] = re.compile('|'.join(alternatives))
+        return self.pattern_regexes[pattern_ids]
+
+    def failed_check(self, match) -> Optional[str]:
+        """
+        The first of the named groups of the match's pattern that fails its check, if any.
+        """
+        for name in self.pattern_checks[int(match.lastgroup[1:])]:
+            value = match.group(name)
+            if value is not None and not MATCH_CHECKS[name](value):
+                return name
+        return None
+
+    def passes_checks(self, match) -> bool:
+        """
+        Whether a match of the combined regex passes the checks on its pattern's named groups.
+        """
+        return self.failed_check(match) is None
+
+    def match_shorter(self, source: str, match, timeout: Optional[float] = None):
+        """
+        Retries the pattern of a match that failed its checks at the same position, ending before the
+        failed group, until a match passes; e.g., the host "foo.com" of "foo.com.docx", whose
+        `tld` group "docx" is not a top-level domain. Returns None if no shorter match passes.
+        """
+        pattern_regex = self.get_pattern_regex((int(match.lastgroup[1:]),))
+        start = match.start()
+        while match is not None:
+            name = self.failed_check(match)
+            if name is None:
+                return match
+            match = pattern_regex.match(source, start, match.start(name), timeout=timeout)
+        return None
+
+    def scan(self,
+             source: str,
+             pattern_ids: Tuple[int, ...],
+             timeout: Optional[float] = None,
+             pos: int = 0,
+             stop: Optional[int] = None) -> List[Tuple[int, int, int]]:
+        """
+        Scans `source` from `pos` with the combined regex of `pattern_ids`, within `timeout` seconds,
+        for matches starting before `stop` (if given).
+        Where a match fails its checks, a shorter match of the same pattern, and then the other patterns,
+        are tried at the same position before moving on.
+
+        :return: A list of (pattern_id, start, end) tuples, in the order found.
+        """
+        pattern_regex = self.get_pattern_regex(pattern_ids)
+        if pattern_regex is None:
+            return []
+        if stop is None:
+            stop = len(source) + 1
+        if not any(self.pattern_checks[pattern_id] for pattern_id in pattern_ids):
+            found = []
+            for match in pattern_regex.finditer(source, pos, timeout=timeout):
+                if match.start() >= stop:
+                    break
+                found.append((int(match.lastgroup[1:]), match.start(), match.end()))
+            return found
+
+        deadline = time.perf_counter() + timeout if timeout is not None else None
+
+        def remaining():
+            if deadline is None:
+                return None
+            left = deadline - time.perf_counter()
+            if left <= 0:
+                raise TimeoutError()
+            return left
+
+        found = []
+        while pos <= len(source):
+            match = pattern_regex.search(source, pos, timeout=remaining())
+            if match is None or match.start() >= stop:
+                break
+            start = match.start()
+            candidates = pattern_ids
+            while match is not None and not self.passes_checks(match):
+                shorter = self.match_shorter(source, match, timeout=remaining())
+                if shorter is not None:
+                    match = shorter
+                    break
+                candidates = tuple(pattern_id for pattern_id in candidates if pattern_id != int(match.lastgroup[1:]))
+                retry_regex = self.get_pattern_regex(candidates)
+                match = retry_regex.match(source, start, timeout=remaining()) if retry_regex is not None else None
+            if match is None:
+                pos = start + 1
+                continue
+            found.append((int(match.lastgroup[1:]), start, match.end()))
+            pos = max(match.end(), start + 1)
+        return found
+
+    def active_patterns(self, source: str) -> Tuple[int, ...]:
+        """
+        Returns the ids of the patterns whose requirements are all met by `source`.
+        """
+        cache = {}
+        return tuple(pattern_id for pattern_id, requirements in enumerate(self.pattern_requirements)
+                     if all(requirement_holds(requirement, source, cache) for requirement in requirements))
 
     def get_mask_string(self,
                         label: str,
@@ -128,76 +992,324 @@ def unmask(self, output, masks):
         Removes masks.
 
         """
-        unmasked = ' {} '.format(output)
-        for mask in masks:
-            maskstr = mask["maskstr"]
-            replacement = mask["replacement"]
-            unmasked = unmasked.replace(maskstr, " " + replacement + " ")
+        return self.unmask_batch([(output, masks)])[0]
+
+    def unmask_batch(self, batch: List[Tuple[str, List[Dict]]]) -> List[str]:
+        """
+        Removes masks from a batch of (output, masks) pairs.
+        One regex matching every mask string in the batch is compiled, and each output is rewritten
+        in a single pass using its own substitution map. If several masks share a mask string
+        (i.e., without --add-index), the first one's replacement is used.
+        """
+        maskstrs = {mask["maskstr"] for _, masks in batch for mask in masks}
+        if not maskstrs:
+            return [singlespace(output) for output, _ in batch]
 
-        return singlespace(unmasked)
+        mask_regex = re.compile('|'.join(re.escape(maskstr) for maskstr in sorted(maskstrs, key=len, reverse=True)))
+
+        unmasked = []
+        for output, masks in batch:
+            replacements = {}
+            for mask in masks:
+                replacements.setdefault(mask["maskstr"], " " + mask["replacement"] + " ")
+            unmasked.append(singlespace(mask_regex.sub(lambda match: replacements.get(match.group(), match.group()), output)))
+
+        return unmasked
 
     def mask(self, orig_source, orig_target: Optional[str] = None, prob = 1.0):
-        masked_source, masked_target, term_masks = self.mask_by_term(orig_source, orig_target, prob)
-        masked_source, masked_target, pattern_masks = self.mask_by_pattern(masked_source, masked_target, prob)
-        term_masks.extend(pattern_masks)
-        return singlespace(masked_source), singlespace(masked_target), term_masks
-
-    def get_label_masks(self,
-                        label,
-                        source_pattern,
-                        translation,
-                        source,
-                        target: Optional[str] = None,
-                        prob: float = 1.0) -> Tuple[str, str, Dict]:
-        """
-        Search for `source_pattern` in `source`.
-        If `target` is None, replace the matched text with `label`.
-        If `target` is not None, replace the matched text with `label` only if `translation` can be found in `target`.
-        If `translation` is None, the matched text is used to match against `target` instead.
+        """
+        Masks dictionary terms and patterns in `orig_source` (and, if given, `orig_target`).
+
+        Each mask records where it came from: `start` and `end` are the character offsets of the
+        matched text in `orig_source`, `token_start` and `token_end` the span of the tokens of
+        `split_tokens(orig_source)` it covers, and `masked_token` the index of the mask among the tokens of the masked source.
+        """
+        if self.stats is not None:
+            self.stats.lines += 1
+
+        if self.single_pass:
+            masked_source, masked_target, masks = self.mask_by_span(orig_source, orig_target, prob)
+        else:
+            masked_source, masked_target, masks = self.mask_by_term(orig_source, orig_target, prob)
+            term_offsets = OffsetMap.from_masks(masks)
+            masked_source, masked_target, pattern_masks = self.mask_by_pattern(masked_source, masked_target, prob)
+            pattern_offsets = OffsetMap.from_masks(pattern_masks)
+
+            # Term offsets are moved to the final masked source, and pattern offsets back to the original one
+            for mask in masks:
+                mask["masked_start"] = pattern_offsets.forward(mask["masked_start"])
+                mask["masked_end"] = pattern_offsets.forward(mask["masked_end"], is_end=True)
+            for mask in pattern_masks:
+                mask["start"] = term_offsets.backward(mask["start"])
+                mask["end"] = term_offsets.backward(mask["end"], is_end=True)
+            masks.extend(pattern_masks)
+
+        self.add_token_offsets(orig_source, masked_source, masks)
+
+        return singlespace(masked_source), singlespace(masked_target), masks
+
+    @staticmethod
+    def add_token_offsets(source: str, masked_source: str, masks: List[Dict]) -> None:
+        """
+        Turns the character offsets of masks in the source and the (not yet single-spaced) masked source into token offsets.
+        """
+        starts, ends = token_offsets(source)
+        # the masked source is single-spaced on output, so its tokens are its runs of non-spaces
+        masked_starts = [match.start() for match in TOKEN.finditer(masked_source)]
+        for mask in masks:
+            mask["token_start"] = bisect.bisect_right(ends, mask["start"])
+            mask["token_end"] = bisect.bisect_left(starts, mask["end"])
+            mask["masked_token"] = bisect.bisect_left(masked_starts, mask.pop("masked_start") + 1)
+            del mask["masked_end"]
+
+    def mask_matches(self,
+                     source: str,
+                     matches: List[Tuple[int, int, str, Optional[str], Tuple[str, int]]],
+                     target: Optional[str] = None,
+                     prob: float = 1.0,
+                     retry: Optional[Callable[[Tuple], List[Tuple]]] = None) -> Tuple[str, Optional[str], List[Dict]]:
+        """
+        Masks a list of non-overlapping (start, end, label, translation, origin) matches found in `source`,
+        where `origin` is the ('pattern', pattern id) or ('dictionary', file id) the match came from.
+        Masks are numbered in the order the matches are given. Each records the `start` and `end` of its match in
+        `source`, and the `masked_start` and `masked_end` of its mask string in the masked source.
+
+        If `target` is not None, a match is only masked if `translation` (or, if `translation` is None,
+        the matched text) can be found in `target`, and then only with probability `prob`.
+        A match that is not masked is passed to `retry`, if given, which returns the other matches to try
+        on its span; these are tried next, and skipped if they overlap a span that has been masked.
+        The source and target are each rebuilt once, after all spans are known.
         """
         masks = []
         source_mods = []
         target_mods = []
-        for source_match in re.finditer(source_pattern, source):
-            matched_text = source_match.group()
-            source_match_position = source_match.start()
+        target_index = TargetIndex(target) if target is not None else None
+        masked = bytearray(len(source)) if retry is not None else None
+        tried = set()
+        pending = list(reversed(matches))
+        while pending:
+            match = pending.pop()
+            start, end, label, translation, origin = match
+            if masked is not None:
+                if match in tried or masked.find(1, start, end) != -1:
+                    continue
+                tried.add(match)
+
+            matched_text = source[start:end]
             replacement_text = translation if translation is not None else matched_text
-            loc_in_target = -1
+            if self.stats is not None:
+                self.stats.record(origin, 'matches')
+            if target_index is not None:
+                target_span = target_index.find(replacement_text)
+                if target_span is None:
+                    self.counts_missed[label] += 1
+                    if self.stats is not None:
+                        self.stats.record(origin, 'missed')
+                    if retry is not None:
+                        pending.extend(reversed(retry(match)))
+                    continue
+
+            self.counts[label] += 1
+            labelstr = self.get_mask_string(label, self.counts[label])
+
+            # Always apply at test time
             if target is not None:
-                match = re.search(r'\b{}\b'.format(re.escape(replacement_text)), target)
-                if match is not None:
-                    loc_in_target = match.start()
-
-            if target is None or loc_in_target != -1:
-                self.counts[label] += 1
-                labelstr = self.get_mask_string(label, self.counts[label])
-                mask = { "maskstr" : labelstr.strip(), "matched" : matched_text, "replacement" : replacement_text }
-
-                if target is not None:
-                    if random.random() < prob:
-                        source_mods.append((source_match_position, len(matched_text), labelstr))
-                        target = target[0:loc_in_target] + labelstr + target[loc_in_target+len(matched_text):]
-                        masks.append(mask)
-                else:
-                    # Always apply at test time
-                    source_mods.append((source_match_position, len(matched_text), labelstr))
-                    masks.append(mask)
-            else:
-                self.counts_missed[label] += 1
+                if random.random() >= prob:
+                    if retry is not None:
+                        pending.extend(reversed(retry(match)))
+                    continue
+                target_index.claim(*target_span)
+                target_mods.append((target_span[0], target_span[1] - target_span[0], labelstr))
+
+            source_mods.append((start, end - start, labelstr))
+            if masked is not None:
+                masked[start:end] = b'\x01' * (end - start)
+            if self.stats is not None:
+                self.stats.record(origin, 'masked')
+            masks.append({ "maskstr" : labelstr.strip(), "matched" : matched_text, "replacement" : replacement_text,
+                           "start" : start, "end" : end })
 
-        def apply_mods(text, mod_list):
-            if mod_list:
-                offset = 0
-                for i, matched_len, mask in mod_list:
-                    i += offset
-                    text = text[0:i] + mask + text[i + matched_len:]
-                    offset += len(mask) - matched_len
-            return text
+        shift = 0
+        for i in sorted(range(len(source_mods)), key=source_mods.__getitem__):
+            start, matched_len, labelstr = source_mods[i]
+            masks[i]["masked_start"] = start + shift
+            masks[i]["masked_end"] = start + shift + len(labelstr)
+            shift += len(labelstr) - matched_len
 
-        source = apply_mods(source, source_mods)
+        source = apply_mods(source, sorted(source_mods))
+        if target is not None:
+            target = apply_mods(target, sorted(target_mods))
 
         return source, target, masks
 
+    def find_term_matches(self,
+                          source: str,
+                          candidates: Optional[List[Tuple[int, int, int]]] = None) -> List[Tuple[int, int, str, Optional[str], Tuple[str, int]]]:
+        """
+        Finds dictionary matches in `source` as (start, end, label, translation, origin) tuples, choosing
+        the leftmost and then the longest among `candidates` (see `find_term_candidates()`), if given.
+        They are ordered by dictionary order, then by position, as if each term were searched for in turn.
+        """
+        if candidates is None:
+            candidates = self.find_term_candidates(source)
+
+        matches = []
+        for start, end, term_id in sorted(leftmost_longest(candidates), key=lambda match: (match[2], match[0])):
+            translation, label = self.term_store[term_id]
+            matches.append((start, end, label, translation, ('dictionary', bisect.bisect_right(self.dict_starts, term_id) - 1)))
+        return matches
+
+    def find_term_candidates(self, source: str) -> List[Tuple[int, int, int]]:
+        """
+        Finds every occurrence of a dictionary term in `source`, overlapping or not, as (start, end, term id) triples.
+        """
+        start_time = time.perf_counter()
+        candidates = self.term_index.find_all(source)
+        if self.stats is not None:
+            self.stats.term_time += time.perf_counter() - start_time
+        return candidates
+
+    def term_retry(self, source: str, candidates: List[Tuple[int, int, int]]) -> Callable[[Tuple], List[Tuple]]:
+        """
+        Returns the `retry` function of `mask_matches()` for dictionary matches in `source`: when a match
+        is not masked, e.g. because the translation of the longest term is not in the target, the other
+        `candidates` starting in its span are tried instead, the leftmost and then the longest first.
+        """
+        candidates = sorted(candidates)
+        starts = [start for start, _, _ in candidates]
+        rejected = set()
+
+        def retry(match: Tuple) -> List[Tuple]:
+            start, end = match[0], match[1]
+            rejected.add((start, end))
+            alternatives = [candidate for candidate in candidates[bisect.bisect_left(starts, start):bisect.bisect_left(starts, end)]
+                            if candidate[:2] not in rejected]
+            return self.find_term_matches(source, alternatives)
+
+        return retry
+
+    def find_pattern_matches(self, source: str) -> List[Tuple[int, int, str, Optional[str], Tuple[str, int]]]:
+        """
+        Finds pattern matches in `source` as (start, end, label, None, origin) tuples.
+        They are ordered by pattern order, then by position, as if each pattern were applied in turn.
+
+        If the combined scan runs out of time, each pattern is retried on its own within its budget
+        (see `find_pattern_matches_guarded()`).
+        """
+        pattern_ids = self.active_patterns(source)
+        if self.stats is not None:
+            self.time_patterns(source, pattern_ids)
+
+        if not pattern_ids:
+            return []
+
+        start_time = time.perf_counter()
+        deadline = start_time + self.line_timeout if self.line_timeout is not None else None
+        try:
+            timeout = self.pattern_timeout
+            if deadline is not None:
+                # the rest of the line's budget is left for the per-pattern fallback
+                combined_timeout = self.line_timeout * COMBINED_SCAN_SHARE
+                timeout = combined_timeout if timeout is None else min(timeout, combined_timeout)
+            found = sorted(self.scan(source, pattern_ids, timeout))
+        except TimeoutError:
+            found = self.find_pattern_matches_guarded(source, pattern_ids, deadline)
+        if self.stats is not None:
+            self.stats.pattern_time += time.perf_counter() - start_time
+
+        return [(start, end, self.patterns[pattern_id][1], None, ('pattern', pattern_id)) for pattern_id, start, end in found]
+
+    def find_pattern_matches_guarded(self,
+                                     source: str,
+                                     pattern_ids: Tuple[int, ...],
+                                     deadline: Optional[float] = None) -> List[Tuple[int, int, int]]:
+        """
+        Scans `source` with each pattern on its own, within `self.pattern_timeout` and an equal share of
+        whatever is left before `deadline`, so that a slow pattern does not use up the time of the cheap
+        ones after it. Patterns that run out of time are skipped and counted in `self.timeouts`, and
+        the line in `self.lines_timed_out` if one ran out of its share of the line's time.
+        Overlaps are then resolved as in the combined scan: leftmost match first and, for matches
+        starting at the same position, the earliest pattern.
+
+        :return: A list of (pattern_id, start, end) tuples, sorted.
+        """
+        candidates = []
+        line_timed_out = False
+        for i, pattern_id in enumerate(pattern_ids):
+            timeout = self.pattern_timeout
+            line_bound = False
+            if deadline is not None:
+                share = (deadline - time.perf_counter()) / (len(pattern_ids) - i)
+                line_bound = timeout is None or share < timeout
+                timeout = share if line_bound else timeout
+            try:
+                if timeout is not None and timeout <= 0:
+                    raise TimeoutError()
+                candidates.extend((start, pattern_id, end) for _, start, end in self.scan(source, (pattern_id,), timeout))
+            except TimeoutError:
+                logging.warning('Skipping pattern %d (%s) after it ran out of time on a line of length %d',
+                                pattern_id, self.patterns[pattern_id][1], len(source))
+                self.timeouts[pattern_id] += 1
+                if self.stats is not None:
+                    self.stats.patterns[pattern_id]['timeouts'] += 1
+                line_timed_out = line_timed_out or line_bound
+
+        if line_timed_out:
+            self.lines_timed_out += 1
+
+        found = []
+        last_end = 0
+        for start, pattern_id, end in sorted(candidates):
+            if start >= last_end:
+                found.append((pattern_id, start, end))
+                last_end = end
+        return sorted(found)
+
+    def pattern_retry(self, source: str) -> Callable[[Tuple], List[Tuple]]:
+        """
+        Returns the `retry` function of `mask_matches()` for pattern matches in `source`: when a match
+        is not masked, the patterns not yet tried on its span are scanned for matches starting in it,
+        as if each pattern were applied in turn to what the earlier ones left unmasked.
+        """
+        pattern_ids = self.active_patterns(source)
+        # for each match found by a retry, the patterns already tried on its span
+        excluded = {}
+
+        def retry(match: Tuple) -> List[Tuple]:
+            start, end, _, _, (_, pattern_id) = match
+            skip = excluded.get(match, frozenset()) | {pattern_id}
+            remaining = tuple(i for i in pattern_ids if i not in skip)
+            try:
+                found = sorted(self.scan(source, remaining, self.pattern_timeout, start, end))
+            except TimeoutError:
+                logging.warning('Skipping the retry of patterns on a line of length %d after it ran out of time', len(source))
+                return []
+            alternatives = [(start, end, self.patterns[i][1], None, ('pattern', i)) for i, start, end in found]
+            excluded.update((alternative, skip) for alternative in alternatives)
+            return alternatives
+
+        return retry
+
+    def time_patterns(self, source: str, pattern_ids: Tuple[int, ...]) -> None:
+        """
+        Records, for stats, which patterns were skipped on `source` by their requirements, and times
+        each of the others scanning it on its own.
+        """
+        active = set(pattern_ids)
+        for pattern_id in range(len(self.patterns)):
+            stats = self.stats.patterns[pattern_id]
+            if pattern_id not in active:
+                stats['lines_skipped'] += 1
+                continue
+
+            start_time = time.perf_counter()
+            try:
+                self.scan(source, (pattern_id,), self.pattern_timeout)
+            except TimeoutError:
+                pass
+            stats['time'] += time.perf_counter() - start_time
+            stats['lines_scanned'] += 1
+
     def mask_by_term(self,
                      orig_source,
                      orig_target: Optional[str] = None,
@@ -205,30 +1317,67 @@ def mask_by_term(self,
         """
         Masks using dictionary entries.
         """
-
-        source_masks = []
-        source = orig_source
-        target = orig_target
-        for term, (translation, label) in self.terms.items():
-            if term in source:
-                pattern = r'\b{}\b'.format(re.escape(term))
-                source, target, term_masks = self.get_label_masks(label, pattern, translation, source, target, prob)
-                source_masks.extend(term_masks)
-
-        return source, target, source_masks
+        candidates = self.find_term_candidates(orig_source)
+        retry = self.term_retry(orig_source, candidates) if orig_target is not None else None
+        return self.mask_matches(orig_source, self.find_term_matches(orig_source, candidates), orig_target, prob, retry)
 
     def mask_by_pattern(self, orig_source, orig_target: Optional[str] = None, prob = 1.0):
         """
         Masks using regex patterns.
         """
-        source_masks = []
-        source = orig_source
-        target = orig_target
-        for pattern, label in self.patterns:
-            translation = None
-            source, target, pattern_masks = self.get_label_masks(label, pattern, translation, source, target, prob)
-            source_masks.extend(pattern_masks)
-        return source, target, source_masks
+        retry = self.pattern_retry(orig_source) if orig_target is not None else None
+        return self.mask_matches(orig_source, self.find_pattern_matches(orig_source), orig_target, prob, retry)
+
+    def mask_by_span(self, orig_source, orig_target: Optional[str] = None, prob = 1.0):
+        """
+        Masks using dictionary entries and regex patterns in a single pass.
+        Both are matched against the original source, pattern matches overlapping a masked dictionary match are dropped,
+        and the masked source and target are then built once.
+        """
+        term_candidates = self.find_term_candidates(orig_source)
+        term_matches = self.find_term_matches(orig_source, term_candidates)
+        pattern_matches = self.find_pattern_matches(orig_source)
+
+        if orig_target is None:
+            term_spans = sorted((start, end) for start, end, _, _, _ in term_matches)
+            term_starts = [start for start, _ in term_spans]
+
+            def overlaps_term(start, end):
+                i = bisect.bisect_right(term_starts, start) - 1
+                if i >= 0 and term_spans[i][1] > start:
+                    return True
+                return i + 1 < len(term_spans) and term_spans[i + 1][0] < end
+
+            pattern_matches = [match for match in pattern_matches if not overlaps_term(match[0], match[1])]
+            return self.mask_matches(orig_source, term_matches + pattern_matches)
+
+        # dictionary matches may not all be masked, so pattern matches overlapping them are left to mask_matches()
+        term_retry = self.term_retry(orig_source, term_candidates)
+        pattern_retry = self.pattern_retry(orig_source)
+
+        def retry(match):
+            return pattern_retry(match) if match[4][0] == 'pattern' else term_retry(match)
+
+        return self.mask_matches(orig_source, term_matches + pattern_matches, orig_target, prob, retry)
+
+def batches(stream: Iterable[str], size: int) -> Iterator[List[str]]:
+    """
+    Groups the lines of a stream into lists of (at most) `size` lines.
+    """
+    stream = iter(stream)
+    batch = list(itertools.islice(stream, size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(stream, size))
+
+
+def compile_masker(args):
+    """
+    Loads the pattern and dictionary files and writes them out as a compiled masker.
+    """
+    masker = TermMasker(args.pattern_files, args.dict_files, plabel_override=args.pattern_label, dlabel_override=args.dict_label)
+    masker.save(args.output)
+
 
 def main(args):
 
@@ -236,28 +1385,60 @@ def main(args):
         print("Can't add constraints with --json", file=sys.stderr)
         sys.exit(1)
 
-    masker = TermMasker(args.pattern_files, args.dict_files, add_index=args.add_index, plabel_override=args.pattern_label, dlabel_override=args.dict_label)
+    if args.masker:
+        if args.pattern_files or args.dict_files:
+            print("Can't add pattern or dictionary files to a compiled masker", file=sys.stderr)
+            sys.exit(1)
+        masker = TermMasker.load(args.masker, add_index=args.add_index, single_pass=args.single_pass, stats=args.stats is not None,
+                                 pattern_timeout=args.pattern_timeout, line_timeout=args.line_timeout)
+    else:
+        masker = TermMasker(args.pattern_files, args.dict_files, add_index=args.add_index, plabel_override=args.pattern_label, dlabel_override=args.dict_label,
+                            single_pass=args.single_pass, stats=args.stats is not None,
+                            pattern_timeout=args.pattern_timeout, line_timeout=args.line_timeout)
+
+    try:
+        mask_stream(masker, args)
+    finally:
+        if masker.timeouts:
+            print('Skipped patterns {} times after they ran out of time; {} lines ran out of their time budget'.format(
+                sum(masker.timeouts.values()), masker.lines_timed_out), file=sys.stderr)
+        if masker.stats is not None:
+            report = json.dumps(masker.stats.report(masker), ensure_ascii=False, indent=2)
+            if args.stats == '-':
+                print(report, file=sys.stderr)
+            else:
+                with open(args.stats, 'w', encoding='UTF-8') as outfh:
+                    print(report, file=outfh)
 
-    for lineno, line in enumerate(sys.stdin, 1):
-        jobj = None
-        if args.json:
-            jobj = json.loads(line)
-            line = jobj['text']
-        else:
-            line = line.rstrip('\n')
 
-        if args.unmask:
-            if not args.json:
-                raise Exception('Unmasking requires json format')
+def mask_stream(masker, args):
+    """
+    Masks (or, with --unmask, unmasks) STDIN line by line, writing the results to STDOUT.
+    Lines are read and written a block at a time (see textio.py).
+    """
 
+    if args.unmask:
+        if not args.json:
+            raise Exception('Unmasking requires json format')
+
+        for batch in batches(textio.read_lines(sys.stdin), args.batch_size):
             # get the output from the last step, plus the masks, and unmask
-            output = jobj['text']
-            masks = jobj['masks']
-            unmasked = masker.unmask(output, masks)
-            jobj['unmasked_translation'] = jobj['text'] = unmasked
-            print(json.dumps(jobj), flush=True)
+            jobjs = [jsonio.loads(line) for line in batch]
+            unmasked = masker.unmask_batch([(jobj['text'], jobj['masks']) for jobj in jobjs])
+            for jobj, unmasked_text in zip(jobjs, unmasked):
+                jobj['unmasked_translation'] = jobj['text'] = unmasked_text
+            textio.write_lines(sys.stdout, (jsonio.dumps(jobj, ensure_ascii=True) for jobj in jobjs))
+        return
+
+    for lines in textio.read_batches(sys.stdin):
+        output = []
+        dumped_masks = []
+        for line in lines:
+            jobj = None
+            if args.json:
+                jobj = jsonio.loads(line)
+                line = jobj['text']
 
-        else:
             masker.reset_counts()
             if '\t' in line:
                 orig_source, orig_target = line.split('\t', 1)
@@ -275,32 +1456,38 @@ def main(args):
                     if args.constrain:
                         jobj['constraints'] = [mask['maskstr'] for mask in masks]
 
-                    print(json.dumps(jobj, ensure_ascii=False), flush=True)
+                    output.append(jsonio.dumps(jobj))
                 else:
-                    print(masked_source, flush=True)
+                    output.append(masked_source)
             else:
-                print(masked_source, masked_target, sep='\t', flush=True)
+                output.append('{}\t{}'.format(masked_source, masked_target))
 
             if args.dump_masks:
-                if len(masks) > 0:
-                    print(json.dumps({'masks': masks}, ensure_ascii=False), flush=True, file=args.dump_masks)
-                else:
-                    print(file=args.dump_masks)
+                dumped_masks.append(jsonio.dumps({'masks': masks}) if len(masks) > 0 else '')
+
+        textio.write_lines(sys.stdout, output)
+        if args.dump_masks:
+            textio.write_lines(args.dump_masks, dumped_masks)
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--pattern-files', '-p', nargs='+', type=str,
+    inputs = argparse.ArgumentParser(add_help=False)
+    inputs.add_argument('--pattern-files', '-p', nargs='+', type=str,
                         default=[],
                         help='List of files with patterns')
-    parser.add_argument('--dict-files', '-d', nargs='+', type=str,
+    inputs.add_argument('--dict-files', '-d', nargs='+', type=str,
                         default=[],
                         help='List of files with terminology')
-    parser.add_argument('--pattern-label', '-l', type=str,
+    inputs.add_argument('--pattern-label', '-l', type=str,
                         default=None,
                         help='Override labels in pattern files with this label')
-    parser.add_argument('--dict-label', '-t', type=str,
+    inputs.add_argument('--dict-label', '-t', type=str,
                         default=None,
                         help='Override labels in dictionary files with this label')
+
+    parser = argparse.ArgumentParser(parents=[inputs])
+    parser.add_argument('--masker', '-m', type=str,
+                        default=None,
+                        help='Compiled masker to load instead of pattern and dictionary files')
     parser.add_argument('--json', '-j', action='store_true',
                         help='JSON input and output')
     parser.add_argument('--add-index', '-i', action='store_true',
@@ -315,7 +1502,27 @@ def main(args):
                         help='File to write mask JSON object to.')
     parser.add_argument('--prob', type=float, default=1.0,
                         help='Mask with specified probability. Default: %(default)s.')
-    parser.set_defaults(func=lambda _: parser.print_help())
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='Number of lines to unmask at once with --unmask. Default: %(default)s.')
+    parser.add_argument('--single-pass', action='store_true',
+                        help='Match dictionary terms and patterns against the original text and mask them in one pass')
+    parser.add_argument('--pattern-timeout', type=float, default=None,
+                        help='Skip a pattern on a line once it has run for this many seconds. Default: no limit.')
+    parser.add_argument('--line-timeout', type=float, default=None,
+                        help='Bound the time spent on patterns per line, in seconds. The combined scan gets half of it; if it runs out, '
+                        'each pattern is retried on its own with an equal share of the rest, and skipped if it runs out of that. Default: no limit.')
+    parser.add_argument('--stats', nargs='?', const='-', default=None,
+                        help='Collect timing and hit counts per pattern and per dictionary file, and write them as JSON '
+                             'to this file (default: STDERR) at exit')
+    parser.set_defaults(func=main)
+
+    subparsers = parser.add_subparsers()
+    compile_parser = subparsers.add_parser('compile', parents=[inputs],
+                                           help='Compile pattern and dictionary files into a masker that loads with --masker')
+    compile_parser.add_argument('--output', '-o', type=str, required=True,
+                                help='File to write the compiled masker to')
+    compile_parser.set_defaults(func=compile_masker)
+
     args = parser.parse_args()
 
-    main(args)
+    args.func(args)
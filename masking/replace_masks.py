@@ -3,9 +3,22 @@
 """
 Takes a source, masked source, and target, and a fast_align model.
 It runs fast_align to recover the alignments
+
+If the masks dumped by `mask_terms.py --dump-masks` are given, the source tokens behind each mask
+are read from their token offsets; otherwise they are guessed from the source and masked source.
 """
 
 import argparse
+import os
+import sys
+
+from contextlib import ExitStack
+
+# the repository root, so that the masking package can be imported when run as a script
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from masking import jsonio, symmetrize, textio
+from masking.mask_terms import split_tokens
+
 
 def parse_alignments(align):
     t2s = {}
@@ -19,12 +32,28 @@ def ismask(word):
     return word.startswith('__')
 
 
-def replace_masks(source, maskedsource, target, alignments, output):
-    with open(source) as fsrc, open(maskedsource) as fmsrc, open(target) as ftgt, open(alignments) as falign, open(output, 'w') as fout:
+def read_masks(line):
+    """
+    Reads a line of --dump-masks output, which is empty for sentences without masks.
+    """
+    line = line.strip()
+    return jsonio.loads(line)['masks'] if line else []
+
+
+def replace_masks(source, maskedsource, target, alignments, output, masks=None, rev_alignments=None, heuristic='grow-diag-final-and'):
+    with ExitStack() as stack:
+        fsrc, ftgt, falign = (stack.enter_context(textio.open_file(file)) for file in (source, target, alignments))
+        if rev_alignments is not None:
+            # symmetrize forward and reverse alignments on the fly
+            frev = stack.enter_context(textio.open_file(rev_alignments))
+            falign = (symmetrize.symmetrize_line(fwd, rev, heuristic) for fwd, rev in zip(falign, frev))
+        # with masks, their offsets stand in for the masked source
+        fmsrc = stack.enter_context(textio.open_file(masks if masks is not None else maskedsource))
+        fout = stack.enter_context(textio.open_file(output, 'w'))
+
         for src, msrc, tgt, align in zip(fsrc, fmsrc, ftgt, falign):
-            src = src.strip().split(' ')
-            msrc = msrc.strip().split(' ')
-            tgt = tgt.strip().split(' ')
+            src = split_tokens(src)
+            tgt = split_tokens(tgt)
 
             align = align.strip()
             if align == '':
@@ -33,18 +62,17 @@ def replace_masks(source, maskedsource, target, alignments, output):
                 continue
 
             align = parse_alignments(align.strip())
-            masked2orig = align_masked(src, msrc)
-
-            try:
-                output = tgt
-                for t in align:
-                    if ismask(tgt[t]):
-                        output[t] = src[masked2orig[align[t]]]
-            except:
-                print(src)
-                print(msrc)
-                print(align)
-                print(masked2orig)
+            if masks is not None:
+                # each masked source token that is a mask, mapped to the source tokens it replaced
+                masked2orig = {mask['masked_token']: (mask['token_start'], mask['token_end']) for mask in read_masks(msrc)}
+            else:
+                masked2orig = {i: (j, j + 1) for i, j in align_masked(src, split_tokens(msrc)).items()}
+
+            output = tgt
+            for t in align:
+                if ismask(tgt[t]) and align[t] in masked2orig:
+                    start, end = masked2orig[align[t]]
+                    output[t] = ' '.join(src[start:end])
 
             print(' '.join(output), file=fout)
 
@@ -74,10 +102,18 @@ def main():
     parser.add_argument('--maskedsource', '-ms')
     parser.add_argument('--target', '-mt', help='masked output from MT system')
     parser.add_argument('--alignments', '-a', help='alignments from fast_align')
+    parser.add_argument('--rev-alignments', '-r', help='reverse alignments from fast_align, to symmetrize with --alignments')
+    parser.add_argument('--heuristic', choices=symmetrize.HEURISTICS, default='grow-diag-final-and',
+                        help='symmetrization heuristic for --rev-alignments (default: %(default)s)')
     parser.add_argument('--output', '-o')
+    parser.add_argument('--masks', '-m', help='masks written by mask_terms.py --dump-masks (replaces --maskedsource)')
     args = parser.parse_args()
 
-    replace_masks(args.source, args.maskedsource, args.target, args.alignments, args.output)
+    if args.masks is None and args.maskedsource is None:
+        parser.error('one of --masks or --maskedsource is required')
+
+    replace_masks(args.source, args.maskedsource, args.target, args.alignments, args.output, args.masks,
+                  args.rev_alignments, args.heuristic)
 
 if __name__ == '__main__':
     # print(align_masked("a 1-2 b c".split(), "a __NUMBER__ - __NUMBER__ b c".split()))
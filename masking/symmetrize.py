@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+"""
+Symmetrizes forward and reverse word alignments, as `atools -c HEURISTIC` does.
+
+Links are (source, target) integer arrays of shape (n, 2) rather than "i-j" strings;
+`parse_links()` and `format_links()` convert between the two. The result is ordered by source
+position, then target position, like atools' output.
+
+Usage:
+
+    links = symmetrize(parse_links(fwd), parse_links(rev), 'grow-diag-final-and')
+"""
+
+from typing import Sequence
+
+import numpy
+
+HEURISTICS = ['intersect', 'union', 'grow-diag', 'grow-diag-final', 'grow-diag-final-and']
+
+NEIGHBORS = [(-1, 0), (0, -1), (1, 0), (0, 1)]
+DIAGONAL_NEIGHBORS = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+
+
+def parse_links(links: str) -> numpy.ndarray:
+    """
+    Parses "i-j" links into an (n, 2) array.
+    """
+    pairs = [link.split('-') for link in links.split()]
+    return numpy.array(pairs, dtype=numpy.int64).reshape(len(pairs), 2)
+
+
+def format_links(links: numpy.ndarray) -> str:
+    return ' '.join('{}-{}'.format(i, j) for i, j in links.tolist())
+
+
+def grid(links: numpy.ndarray, shape: Sequence[int]) -> numpy.ndarray:
+    matrix = numpy.zeros(shape, dtype=bool)
+    matrix[links[:, 0], links[:, 1]] = True
+    return matrix
+
+
+def symmetrize(fwd: numpy.ndarray, rev: numpy.ndarray, heuristic: str = 'grow-diag-final-and') -> numpy.ndarray:
+    """
+    Combines forward and reverse (source, target) links with one of the HEURISTICS.
+    """
+    if heuristic not in HEURISTICS:
+        raise ValueError('Unknown symmetrization heuristic "{}"'.format(heuristic))
+
+    links = numpy.concatenate((fwd, rev))
+    shape = tuple(links.max(axis=0) + 1) if len(links) else (0, 0)
+    a = grid(fwd, shape)
+    b = grid(rev, shape)
+    union = a | b
+
+    if heuristic == 'union':
+        res = union
+    elif heuristic == 'intersect':
+        res = a & b
+    else:
+        res = grow(a & b, union, NEIGHBORS + DIAGONAL_NEIGHBORS,
+                   final=[a, b] if 'final' in heuristic else [], final_and=heuristic.endswith('-and'))
+
+    return numpy.argwhere(res)
+
+
+def grow(res: numpy.ndarray,
+         union: numpy.ndarray,
+         neighbors: Sequence[Sequence[int]],
+         final: Sequence[numpy.ndarray],
+         final_and: bool) -> numpy.ndarray:
+    """
+    Grows the intersection `res` into neighboring links of the union that align a still unaligned word,
+    scanning the grid in order and repeating until nothing is added. Then, for each of `final`,
+    adds its links that align an unaligned word (with `final_and`, two unaligned words).
+    """
+    res = res.copy()
+    source_aligned = res.any(axis=1)
+    target_aligned = res.any(axis=0)
+    width, height = res.shape
+
+    added = True
+    while added:
+        added = False
+        for i in range(width):
+            j = 0
+            while True:
+                # points added to this row ahead of j during the scan are visited too, as in atools
+                following = numpy.flatnonzero(res[i, j:])
+                if not len(following):
+                    break
+                j += int(following[0])
+                for di, dj in neighbors:
+                    i2, j2 = i + di, j + dj
+                    if 0 <= i2 < width and 0 <= j2 < height and not res[i2, j2] and union[i2, j2] \
+                            and (not source_aligned[i2] or not target_aligned[j2]):
+                        res[i2, j2] = True
+                        source_aligned[i2] = True
+                        target_aligned[j2] = True
+                        added = True
+                j += 1
+
+    for links in final:
+        for i, j in numpy.argwhere(links & ~res).tolist():
+            if final_and:
+                unaligned = not source_aligned[i] and not target_aligned[j]
+            else:
+                unaligned = not source_aligned[i] or not target_aligned[j]
+            if unaligned:
+                res[i, j] = True
+                source_aligned[i] = True
+                target_aligned[j] = True
+
+    return res
+
+
+def symmetrize_line(fwd: str, rev: str, heuristic: str = 'grow-diag-final-and') -> str:
+    """
+    Symmetrizes "i-j" link strings, returning an "i-j" string.
+    """
+    return format_links(symmetrize(parse_links(fwd), parse_links(rev), heuristic))
@@ -0,0 +1,27 @@
+#!/bin/bash
+# Regenerates the golden alignments that test_masking.py compares fast_align.py and symmetrize.py
+# against, with the real fast_align and atools (https://github.com/clab/fast_align) on the PATH.
+#
+# The committed files are a small fixture checked by hand instead: fwd.params and rev.params are
+# hand-written lexical tables (tension 4, length multiplier 1), and the alignments were worked out
+# from fast_align's forced alignment rule and atools' heuristics. Running this script replaces them
+# with the tools' own output for a model trained on corpus.txt.
+#
+# Usage: cd masking/test/data/align && ./make_golden.sh
+
+set -eu
+
+fast_align -i corpus.txt -d -o -v -p fwd.params > /dev/null 2> fwd.err
+fast_align -i corpus.txt -d -o -v -r -p rev.params > /dev/null 2> rev.err
+
+# forced alignment, as add_alignment.py runs it
+for dir in fwd rev; do
+    T=$(grep 'final tension' $dir.err | tail -1 | awk '{print $NF}')
+    m=$(grep 'expected target length' $dir.err | tail -1 | awk '{print $NF}')
+    flag=$([ $dir = rev ] && echo -r || true)
+    fast_align -i - -d -T $T -m $m -f $dir.params $flag < corpus.txt | awk -F ' \\|\\|\\| ' '{print $3}' > $dir.align
+done
+
+for heuristic in intersect union grow-diag grow-diag-final grow-diag-final-and; do
+    atools -i fwd.align -j rev.align -c $heuristic > $heuristic.align
+done
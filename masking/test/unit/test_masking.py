@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 
 import pytest
-from mask_terms import TermMasker
+from masking.mask_terms import TermMasker, split_tokens
+from masking import add_alignment, attention, fast_align, jsonio, replace_masks, symmetrize, textio, urls
 import json
+import os
+import sys
 
 TEST_PATTERNS_FILE = "patterns.txt"
 PATTERN_TEST_INPUT_FILE = "test/data/pattern_test.txt"
 PATTERN_TEST_OUTPUT_FILE = "test/data/intended_pattern_test_output_annotated.txt"
+PATTERN_BITEXT_TEST_OUTPUT_FILE = "test/data/intended_pattern_bitext_test_output.txt"
 DICT_TEST_DICT_FILE = "test/data/test_dict.txt"
 DICT_TEST_INPUT_FILE = "test/data/dict_test.txt"
 DICT_TEST_OUTPUT_FILE = "test/data/intended_dict_test_output_annotated.txt"
@@ -46,13 +50,14 @@ def test_term_mask(line, expected):
               ("patterns.txt", "test/data/test_dict.txt", "test/data/test_multiword.json"),
               ("", "dict.txt", "test/data/test_default_dict.json")
         ]
+@pytest.mark.parametrize("single_pass", [False, True])
 @pytest.mark.parametrize("pattern_file, dict_file, json_file", json_test_cases)
-def test_json(pattern_file, dict_file, json_file):
+def test_json(pattern_file, dict_file, json_file, single_pass):
     if pattern_file is "":
         pattern_files = []
     else:
         pattern_files = [pattern_file]
-    masker = TermMasker(pattern_files, [dict_file], add_index=True)
+    masker = TermMasker(pattern_files, [dict_file], add_index=True, single_pass=single_pass)
     with open (json_file, encoding='UTF-8') as jsonfile:
         jobj = json.load(jsonfile)
         orig_source = jobj['text']
@@ -64,3 +69,363 @@ def test_json(pattern_file, dict_file, json_file):
         unmasked = masker.unmask(output, masks)
 
         assert unmasked == jobj["expected_unmasked"]
+
+def test_term_longest_match(tmp_path):
+    dict_file = tmp_path / "dict.txt"
+    dict_file.write_text("Defence\tDefense\tNN\nMinistry of Defence\tDefense Department\tNNP\n", encoding='UTF-8')
+    masker = TermMasker([], [str(dict_file)], add_index=True)
+    masked_source, masked_target, masks = masker.mask("The Ministry of Defence and Defence-related matters")
+    assert masked_source == "The __NNP_1__ and __NN_1__ -related matters"
+    assert [mask["replacement"] for mask in masks] == ["Defense", "Defense Department"]
+
+@pytest.mark.parametrize("single_pass", [False, True])
+def test_term_longest_match_fallback(tmp_path, single_pass):
+    dict_file = tmp_path / "dict.txt"
+    dict_file.write_text("Defence\tDefense\tNN\nMinistry of Defence\tDefense Department\tNNP\n5 kg\t5 Kilo\tUNIT\n", encoding='UTF-8')
+    masker = TermMasker([TEST_PATTERNS_FILE], [str(dict_file)], add_index=True, single_pass=single_pass)
+    # the longest term's translation is not in the target, so the shorter one is masked
+    masked_source, masked_target, masks = masker.mask("The Ministry of Defence said", "Das Defense sagte")
+    assert masked_source == "The Ministry of __NN_1__ said"
+    assert masked_target == "Das __NN_1__ sagte"
+    # and patterns are tried where a term is not masked
+    masked_source, masked_target, masks = masker.mask("buy 5 kg", "kaufe 5 kg")
+    assert masked_source == "buy __NUMBER_1__ kg"
+    assert masked_target == "kaufe __NUMBER_1__ kg"
+
+def test_pattern_requirements(tmp_path):
+    pattern_file = tmp_path / "patterns.txt"
+    pattern_file.write_text("\\B\\@\\w+ ||| HANDLE\n\\b\\d+ ||| NUMBER\nfoo|bar ||| FOOBAR ||| foo bar\n", encoding='UTF-8')
+    masker = TermMasker([str(pattern_file)], [])
+    assert masker.active_patterns("plain prose") == ()
+    assert masker.active_patterns("call @me at 5") == (0, 1)
+    assert masker.active_patterns("a bar") == (2,)
+    assert masker.mask("call @me at 5 or bar")[0] == "call __HANDLE__ at __NUMBER__ or __FOOBAR__"
+
+def test_pattern_backreferences(tmp_path):
+    pattern_file = tmp_path / "patterns.txt"
+    pattern_file.write_text("\\b\\d+ ||| NUM\n(\\w)\\1+ ||| REP\n(?P<q>['\"])(\\w+)(?P=q) ||| QUOTED\n", encoding='UTF-8')
+    masker = TermMasker([str(pattern_file)], [])
+    assert masker.mask("Hello 123 xyz aBC")[0] == "He __REP__ o __NUM__ xyz aBC"
+    assert masker.mask("say 'hi' and \"bye' now")[0] == "say __QUOTED__ and \"bye' now"
+
+@pytest.mark.parametrize("single_pass", [False, True])
+def test_bitext_mask(single_pass):
+    masker = TermMasker([TEST_PATTERNS_FILE], [DICT_TEST_DICT_FILE], add_index=True, single_pass=single_pass)
+    masked_source, masked_target, masks = masker.mask("buy 2 capsicum", "kaufe 2 bell pepper heute")
+    assert masked_source == "buy __NUMBER_1__ __NN_1__"
+    assert masked_target == "kaufe __NUMBER_1__ __NN_1__ heute"
+
+bitext_test_cases = [(line.rstrip('\n'), expected.rstrip('\n'))
+                     for line, expected in zip(open(PATTERN_TEST_INPUT_FILE, encoding='UTF-8'),
+                                               open(PATTERN_BITEXT_TEST_OUTPUT_FILE, encoding='UTF-8'))]
+
+@pytest.mark.parametrize("single_pass", [False, True])
+@pytest.mark.parametrize("line, expected", bitext_test_cases)
+def test_bitext_pattern_mask(line, expected, single_pass):
+    # each line is masked against itself; where a match is not found in the target
+    # (e.g. "-5.1e9", as "\b" does not hold before "-"), the remaining patterns are tried on its span
+    masker = TermMasker([TEST_PATTERNS_FILE], [], add_index=True, single_pass=single_pass)
+    masked_source, masked_target, masks = masker.mask(line, line)
+    assert masked_source + "\t" + masked_target == expected
+
+def test_bitext_prob_retry(tmp_path, monkeypatch):
+    pattern_file = tmp_path / "patterns.txt"
+    pattern_file.write_text("\\d+\\.\\d+ ||| DEC\n\\d+ ||| NUM\n", encoding='UTF-8')
+    masker = TermMasker([str(pattern_file)], [], add_index=True)
+    draws = iter([0.9, 0.1, 0.1])
+    monkeypatch.setattr("masking.mask_terms.random.random", lambda: next(draws))
+    masked_source, masked_target, masks = masker.mask("pi 3.14", "pi 3.14", prob=0.5)
+    assert masked_source == "pi __NUM_1__ . __NUM_2__"
+    assert masked_target == "pi __NUM_1__ . __NUM_2__"
+
+def test_unmask_batch():
+    masker = TermMasker([], [])
+    batch = [("see __URL__ and __URL__", [{"maskstr": "__URL__", "matched": "a.com", "replacement": "a.com"},
+                                         {"maskstr": "__URL__", "matched": "b.com", "replacement": "b.com"}]),
+             ("__NUMBER_1__ __NUMBER_10__ !", [{"maskstr": "__NUMBER_1__", "matched": "1", "replacement": "1"},
+                                               {"maskstr": "__NUMBER_10__", "matched": "10", "replacement": "10"}]),
+             ("no masks  here", [])]
+    assert masker.unmask_batch(batch) == ["see a.com and a.com", "1 10 !", "no masks here"]
+
+@pytest.mark.parametrize("pattern_file, dict_file, json_file", json_test_cases)
+def test_compiled_masker(pattern_file, dict_file, json_file, tmp_path):
+    pattern_files = [pattern_file] if pattern_file else []
+    compiled_file = str(tmp_path / "masker.bin")
+    TermMasker(pattern_files, [dict_file]).save(compiled_file)
+    masker = TermMasker.load(compiled_file, add_index=True)
+    with open(json_file, encoding='UTF-8') as jsonfile:
+        jobj = json.load(jsonfile)
+        masked_source, masked_target, masks = masker.mask(jobj['text'])
+        assert masked_source == jobj["expected_masked"]
+        assert masker.unmask(masked_source, masks) == jobj["expected_unmasked"]
+
+
+def test_stats(tmp_path):
+    pattern_file = tmp_path / "patterns.txt"
+    pattern_file.write_text("\\d+ ||| NUMBER\nhttps?://\\S+ ||| URL\n", encoding='UTF-8')
+    dict_file = tmp_path / "terms.txt"
+    dict_file.write_text("Sockeye\tSockeye\tTOOL\n", encoding='UTF-8')
+    masker = TermMasker([str(pattern_file)], [str(dict_file)], stats=True)
+    masker.mask("Sockeye 2 ran", "Sockeye lief")
+    masker.mask("no digits here")
+
+    report = masker.stats.report(masker)
+    assert report['lines'] == 2
+    number, url = report['patterns']
+    assert (number['lines_scanned'], number['matches'], number['masked'], number['missed']) == (1, 1, 0, 1)
+    assert (url['lines_scanned'], url['lines_skipped']) == (0, 2)
+    assert report['dictionaries'][0]['terms'] == 1
+    assert (report['dictionaries'][0]['matches'], report['dictionaries'][0]['masked']) == (1, 1)
+    json.dumps(report)
+
+
+def test_pattern_timeout(tmp_path):
+    pattern_file = tmp_path / "patterns.txt"
+    pattern_file.write_text("(a|aa)+b ||| SLOW\n\\d+ ||| NUMBER\n", encoding='UTF-8')
+    masker = TermMasker([str(pattern_file)], [], pattern_timeout=0.05)
+    masked_source, _, masks = masker.mask("a" * 40 + " 12 b")
+    assert masked_source == "a" * 40 + " __NUMBER__ b"
+    assert masker.timeouts == {0: 1}
+
+    # the slow pattern does not use up the line's time: the cheap one after it still matches
+    masker = TermMasker([str(pattern_file)], [], line_timeout=0.05)
+    masked_source, _, masks = masker.mask("a" * 40 + " 12 b")
+    assert masked_source == "a" * 40 + " __NUMBER__ b"
+    assert masker.timeouts == {0: 1}
+    assert masker.lines_timed_out == 1
+
+
+def test_tld_check(tmp_path):
+    pattern_file = tmp_path / "patterns.txt"
+    pattern_file.write_text("[a-z]+\\.(?P<tld>[a-z]+)\\b ||| URL\n\\w+\\.\\w+ ||| FILE\n", encoding='UTF-8')
+    masker = TermMasker([str(pattern_file)], [])
+    masked_source, _, masks = masker.mask("see report.docx at example.com")
+    assert masked_source == "see __FILE__ at __URL__"
+
+    masker = TermMasker([TEST_PATTERNS_FILE], [])
+    assert masker.mask("example.comma or example.com")[0] == "example.comma or __URL__"
+
+
+@pytest.mark.parametrize("single_pass", [False, True])
+def test_tld_backtracking(single_pass):
+    # an unknown top-level domain falls back to a shorter host that ends in a known one
+    masker = TermMasker([TEST_PATTERNS_FILE], [], single_pass=single_pass)
+    masked_source, _, masks = masker.mask("open foo.com.docx now")
+    assert masked_source == "open __URL__ .docx now"
+    assert masks[0]["matched"] == "foo.com"
+
+    assert urls.match_url("foo.com.docx").group() == "foo.com"
+    assert urls.is_url("foo.com.docx") and urls.is_url("www.foo.co.uk/path")
+    assert not urls.is_url("example.comma") and not urls.is_url("report.docx")
+
+
+@pytest.mark.parametrize("single_pass", [False, True])
+def test_mask_offsets(single_pass):
+    masker = TermMasker([TEST_PATTERNS_FILE], [DICT_TEST_DICT_FILE], add_index=True, single_pass=single_pass)
+    source = "Call  Nina at 555 about the capsicum-based, 12x recipe"
+    masked_source, _, masks = masker.mask(source)
+    masked_tokens = masked_source.split(' ')
+    for mask in masks:
+        assert source[mask["start"]:mask["end"]] == mask["matched"]
+        assert mask["matched"] in ' '.join(split_tokens(source)[mask["token_start"]:mask["token_end"]])
+        assert masked_tokens[mask["masked_token"]] == mask["maskstr"]
+
+
+def test_replace_masks_offsets(tmp_path):
+    # token offsets refer to the source split on single spaces, as replace_masks.py splits it,
+    # so repeated spaces give empty tokens
+    dict_file = tmp_path / "dict.txt"
+    dict_file.write_text("Nina  at\tNina bei\tNAME\n", encoding='UTF-8')
+    masker = TermMasker([TEST_PATTERNS_FILE], [str(dict_file)])
+    source = " Call  Nina  at 555 today"
+    masked_source, _, masks = masker.mask(source)
+    assert masked_source == "Call __NAME__ __NUMBER__ today"
+    tokens = split_tokens(source)
+    assert tokens == ["Call", "", "Nina", "", "at", "555", "today"]
+    assert [tokens[mask["token_start"]:mask["token_end"]] for mask in masks] == [["Nina", "", "at"], ["555"]]
+
+    # a translation of the masked source, with its alignment to it
+    files = {"source": source, "masks": json.dumps({"masks": masks}),
+             "target": "Ruf __NUMBER__ heute __NAME__ an", "align": "0-0 2-1 3-2 1-3"}
+    for name, text in files.items():
+        (tmp_path / name).write_text(text + "\n", encoding='UTF-8')
+    replace_masks.replace_masks(str(tmp_path / "source"), None, str(tmp_path / "target"), str(tmp_path / "align"),
+                                str(tmp_path / "output"), masks=str(tmp_path / "masks"))
+    assert (tmp_path / "output").read_text(encoding='UTF-8') == "Ruf 555 heute Nina  at an\n"
+
+
+def test_bipar_unmask():
+    pytest.importorskip("scipy")
+    from masking import bipar
+    masks = [{"maskstr": "__NUMBER__", "matched": "7", "replacement": "7", "masked_token": 3},
+             {"maskstr": "__NUMBER__", "matched": "5", "replacement": "5", "masked_token": 1},
+             {"maskstr": "__URL__", "matched": "a.com", "replacement": "a.com", "masked_token": 5}]
+    obj = {"subword_text": "from __NUMBER__ to __NUMBER__ at __URL__", "translation": "bei __URL__ bis __NUMBER__ von __NUMBER__",
+           "masks": masks,
+           # one row per target token
+           "attention": [[0.9, 0, 0, 0, 0, 0], [0, 0, 0, 0, 0.1, 0.9], [0, 0, 0.9, 0, 0, 0], [0, 0.2, 0, 0.8, 0, 0],
+                         [0.9, 0, 0, 0, 0, 0], [0, 0.7, 0, 0.3, 0, 0]]}
+    assert bipar.unmask_batch([obj])[0]["unmasked_translation"] == "bei a.com bis 7 von 5"
+
+    for encoding in ["float16", "sparse"]:
+        encoded = dict(obj, attention=attention.encode(obj["attention"], encoding))
+        assert bipar.unmask(encoded)["unmasked_translation"] == "bei a.com bis 7 von 5"
+
+
+@pytest.mark.parametrize("encoding", ["dense", "float16", "sparse"])
+def test_attention_encoding(encoding):
+    alignment = [[0.5, 0.5, 0.0], [0.0, 0.0, 0.0], [0.0, 0.0, 1.0], [1 / 3, 1 / 3, 1 / 3]]
+    encoded = json.loads(json.dumps(attention.encode(alignment, encoding)))
+    if encoding == "sparse":
+        assert "values" not in encoded
+    decoded = attention.decode(encoded)
+    assert decoded.shape == (4, 3)
+    assert abs(decoded - alignment).max() < 1e-3
+    assert attention.select(encoded, [3, 0], [1]).tolist() == decoded[[3, 0]][:, [1]].tolist()
+
+
+def test_streaming_aligner(tmp_path):
+    # stand-ins for fast_align (diagonal links, reversed with -r) and atools (the union of both)
+    fake_fast_align = tmp_path / "fast_align.py"
+    fake_fast_align.write_text(
+        "import sys\n"
+        "for line in sys.stdin:\n"
+        "    if 'BAD' in line:\n"
+        "        print('bad', flush=True)\n"
+        "        continue\n"
+        "    src, tgt = line.strip().split(' ||| ')\n"
+        "    n = min(len(src.split()), len(tgt.split()))\n"
+        "    links = ['{}-{}'.format(i, n - 1 - i if '-r' in sys.argv else i) for i in range(n)]\n"
+        "    print(src, '|||', tgt, '|||', ' '.join(links), '||| -1.0', flush=True)\n", encoding='UTF-8')
+    fake_atools = tmp_path / "atools.py"
+    fake_atools.write_text(
+        "import sys\n"
+        "for fwd in sys.stdin:\n"
+        "    rev = sys.stdin.readline()\n"
+        "    print(' '.join(sorted(set(fwd.split() + rev.split()))), flush=True)\n", encoding='UTF-8')
+
+    class FakeAligner(add_alignment.StreamingAligner):
+        def commands(self, *args):
+            return ([sys.executable, str(fake_fast_align)], [sys.executable, str(fake_fast_align), '-r'],
+                    [sys.executable, str(fake_atools)])
+
+    lines = ["a b ||| x y", "BAD ||| BAD", "a ||| x"] * 50
+    aligner = FakeAligner(None, None, None, None, window=4)
+    aligned = list(aligner.align_stream(iter(lines)))
+    aligner.close()
+    assert aligned == ["0-0 0-1 1-0 1-1", "bad", "0-0"] * 50
+
+
+def test_fast_align_model(tmp_path):
+    params = tmp_path / "fwd_params"
+    params.write_text("<eps>\tder\t-3.0\nthe\tdie\t-0.1\nthe\tder\t-2.0\nhouse\thaus\t-0.05\nsmall\tklein\t-0.2\n", encoding='UTF-8')
+
+    model = fast_align.FastAlignModel(str(params), tension=4.0, mean_srclen_multiplier=1.0)
+    links, score = model.align("the small house".split(), "das haus ist klein".split())
+    assert links == [(0, 0), (2, 1), (1, 2), (1, 3)]
+    assert score < 0
+
+    # unknown words fall back to the diagonal
+    assert model.align("a b c".split(), "x y z".split())[0] == [(0, 0), (1, 1), (2, 2)]
+
+    line = model.align_line("the house ||| die haus")
+    assert line.split(' ||| ')[:3] == ["the house", "die haus", "0-0 1-1"]
+
+    reverse = fast_align.FastAlignModel(str(params), tension=4.0, mean_srclen_multiplier=1.0, reverse=True)
+    assert reverse.align("die haus".split(), "the house".split())[0] == [(0, 0), (1, 1)]
+
+
+ALIGN_DATA = "test/data/align"
+
+
+def golden_path(name):
+    return os.path.join(ALIGN_DATA, name)
+
+
+def read_golden(name):
+    with open(golden_path(name), encoding='UTF-8') as infh:
+        return [line.rstrip('\n') for line in infh]
+
+
+@pytest.mark.parametrize("direction", ["fwd", "rev"])
+def test_fast_align_golden(direction):
+    expected = read_golden(direction + ".align")
+    model = fast_align.FastAlignModel.from_err(golden_path(direction + ".params"), golden_path(direction + ".err"),
+                                               reverse=direction == "rev")
+    corpus = read_golden("corpus.txt")
+    assert [model.align_line(line).split(' ||| ')[2] for line in corpus] == expected
+
+
+@pytest.mark.parametrize("heuristic", ["intersect", "union", "grow-diag", "grow-diag-final", "grow-diag-final-and"])
+def test_symmetrize_golden(heuristic):
+    expected = read_golden(heuristic + ".align")
+    pairs = zip(read_golden("fwd.align"), read_golden("rev.align"))
+    assert [symmetrize.symmetrize_line(fwd, rev, heuristic) for fwd, rev in pairs] == expected
+
+
+@pytest.mark.parametrize("fwd, rev, heuristic, expected", [
+    ("0-0 1-1 2-1", "0-0 1-1 1-2", "intersect", "0-0 1-1"),
+    ("0-0 1-1 2-1", "0-0 1-1 1-2", "union", "0-0 1-1 1-2 2-1"),
+    ("0-0 1-1 2-1", "0-0 1-1 1-2", "grow-diag-final-and", "0-0 1-1 1-2 2-1"),
+    ("0-0 1-1", "0-0 2-2", "grow-diag", "0-0 1-1 2-2"),
+    ("0-0 2-2", "0-0", "grow-diag", "0-0"),
+    ("0-0 2-2", "0-0", "grow-diag-final-and", "0-0 2-2"),
+    ("0-0 2-0", "0-0", "grow-diag-final-and", "0-0"),
+    ("0-0 2-0", "0-0", "grow-diag-final", "0-0 2-0"),
+    ("0-0 2-1", "0-0 1-1", "grow-diag-final-and", "0-0 1-1 2-1"),
+    ("", "", "grow-diag-final-and", ""),
+])
+def test_symmetrize(fwd, rev, heuristic, expected):
+    assert symmetrize.symmetrize_line(fwd, rev, heuristic) == expected
+
+
+@pytest.mark.parametrize("suffix", ["", ".gz", ".xz"])
+@pytest.mark.parametrize("external", [True, False])
+def test_textio(suffix, external, tmp_path):
+    lines = ["première ligne", "", "a\tb", "dernière"]
+    path = str(tmp_path / ("lines.txt" + suffix))
+    with textio.open_file(path, 'w', external=external) as outfh:
+        textio.write_lines(outfh, lines)
+
+    # a small buffer splits lines across blocks
+    assert list(textio.read_lines(path, buffer_size=5)) == lines
+    with textio.open_file(path, external=external) as infh:
+        assert infh.read() == ''.join(line + '\n' for line in lines)
+
+
+def test_textio_read_batches(tmp_path):
+    path = tmp_path / "lines.txt"
+    # CRLF line ends are dropped, even split across blocks, but a lone CR is kept
+    path.write_bytes(b"dos\r\nline\r\na\rb\n" + b"x" * 1000 + b"\nlast\r\n")
+    assert list(textio.read_lines(str(path), buffer_size=4)) == ["dos", "line", "a\rb", "x" * 1000, "last"]
+    path.write_bytes(b"no newline\r")
+    assert list(textio.read_lines(str(path), buffer_size=3)) == ["no newline"]
+
+
+def test_jsonio_lazy():
+    line = json.dumps({"text": "a b", "attention": [[0.5, 0.5], [1.0, 0.0]], "masks": [{"maskstr": "__URL__", "matched": "[x]\"é"}]},
+                      ensure_ascii=False)
+    jobj = jsonio.loads(line, lazy=True)
+    assert list(jobj) == ["text", "attention", "masks"]
+    jobj["text"] = jobj["text"].upper()
+    jobj["tok_text"] = "A B"
+
+    # untouched fields are copied as they were read
+    output = jsonio.dumps(jobj)
+    assert '[[0.5, 0.5], [1.0, 0.0]]' in output
+    assert json.loads(output) == dict(json.loads(line), text="A B", tok_text="A B")
+    assert jsonio.dumps(jobj, ensure_ascii=True).isascii()
+
+    with pytest.raises(ValueError):
+        jsonio.loads('{"text": [1, 2}', lazy=True)
+
+
+def test_jsonio_dumps():
+    if jsonio.CODEC != "json":
+        pytest.skip("SOCKEYE_JSON={} writes its own format".format(jsonio.CODEC))
+    obj = {"text": "Ça coûte 5 €", "masks": [{"maskstr": "__NUMBER__", "start": 9}], "scores": [1.5, float("nan"), -2],
+           "raw": None, "tok": True}
+    expected = json.dumps(obj, ensure_ascii=False)
+    assert jsonio.dumps(obj) == expected
+    assert jsonio.dumps(jsonio.loads(expected, lazy=True)) == expected
+    assert jsonio.dumps(obj, ensure_ascii=True) == json.dumps(obj)
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+"""
+Reads and writes plain and compressed text files for the command-line tools.
+
+`open_file()` opens a path ('-' for STDIN or STDOUT), compressed or not according to its
+suffix (.gz, .xz, .zst). Compression runs in an external process (pigz, xz, zstd) when one
+is on the PATH; otherwise, files are decompressed with Python's own modules in a helper thread,
+which works on the next block while the caller works on this one. `read_batches()` reads
+large binary blocks and decodes them all at once, and `write_lines()` writes a batch of lines
+with a single call.
+
+Usage:
+
+    with open_file('corpus.en.gz') as infh, open_file('-', 'w') as outfh:
+        for lines in read_batches(infh):
+            write_lines(outfh, [line.upper() for line in lines])
+
+Lines end in '\\n' or '\\r\\n', which is dropped as universal newlines would; unlike them, a
+lone '\\r' does not end a line. A read block is returned as soon as it holds a full line, so
+line-at-a-time pipelines are not held up waiting for a full buffer.
+"""
+
+import gzip
+import io
+import lzma
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import threading
+
+from typing import Callable, IO, Iterable, Iterator, List, NamedTuple, Optional, Union
+
+BUFFER_SIZE = 1 << 20
+ENCODING = 'utf-8'
+
+
+class Codec(NamedTuple):
+    # commands that decompress a file to STDOUT and compress STDIN to STDOUT, in order of preference
+    decompress: List[List[str]]
+    compress: List[List[str]]
+    # opens a binary file object in Python, for when none of the commands is available
+    open: Callable[[str, str], IO[bytes]]
+
+
+def zstd_open(path: str, mode: str) -> IO[bytes]:
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception('Reading or writing {} needs the zstd command or the zstandard module'.format(path))
+    return zstandard.open(path, mode)
+
+
+CODECS = {
+    '.gz': Codec([['pigz', '-dc'], ['gzip', '-dc']], [['pigz', '-c']], gzip.open),
+    '.xz': Codec([['xz', '-dc', '-T0']], [['xz', '-c', '-T0']], lzma.open),
+    '.zst': Codec([['zstd', '-dcq']], [['zstd', '-cq', '-T0']], zstd_open),
+}
+
+
+def codec(path: str) -> Optional[Codec]:
+    _, suffix = os.path.splitext(path)
+    return CODECS.get(suffix)
+
+
+def find_command(commands: List[List[str]]) -> Optional[List[str]]:
+    """
+    The first of `commands` whose program is on the PATH.
+    """
+    for command in commands:
+        if shutil.which(command[0]) is not None:
+            return command
+    return None
+
+
+class ProcessFile(io.RawIOBase):
+    """
+    The output (for reading) or input (for writing) of a (de)compression process.
+    Closing it waits for the process, and raises an exception if it failed.
+    """
+
+    def __init__(self, command: List[str], path: str, writing: bool = False) -> None:
+        self.command = command
+        if writing:
+            self.target = open(path, 'wb')
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=self.target, bufsize=0)
+            self.pipe = self.process.stdin
+        else:
+            self.target = None
+            self.process = subprocess.Popen(command + [path], stdout=subprocess.PIPE, bufsize=0)
+            self.pipe = self.process.stdout
+        self.writing = writing
+        self.finished = writing
+
+    def readable(self) -> bool:
+        return not self.writing
+
+    def writable(self) -> bool:
+        return self.writing
+
+    def readinto(self, buffer) -> int:
+        size = self.pipe.readinto(buffer)
+        if not size:
+            self.finished = True
+        return size
+
+    def write(self, data) -> int:
+        return self.pipe.write(data)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        super().close()
+        self.pipe.close()
+        if not self.finished:
+            # closed before the end of the output, which is no longer needed
+            self.process.terminate()
+        status = self.process.wait()
+        if self.target is not None:
+            self.target.close()
+        if self.finished and status != 0:
+            raise Exception('{} exited with status {}'.format(' '.join(self.command), status))
+
+
+class ThreadedReader(io.RawIOBase):
+    """
+    Reads blocks of a binary file object in a helper thread, at most `depth` blocks ahead.
+    This pays off for files that decompress in Python, since zlib and lzma release the GIL.
+    """
+
+    def __init__(self, infh: IO[bytes], block_size: int = BUFFER_SIZE, depth: int = 4) -> None:
+        self.infh = infh
+        self.block_size = block_size
+        self.blocks = queue.Queue(depth)
+        self.block = memoryview(b'')
+        self.error = None
+        self.thread = threading.Thread(target=self.fill, daemon=True)
+        self.thread.start()
+
+    def fill(self) -> None:
+        try:
+            while True:
+                block = self.infh.read(self.block_size)
+                self.blocks.put(block)
+                if not block:
+                    break
+        except Exception as e:
+            self.error = e
+            self.blocks.put(b'')
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if not self.block:
+            self.block = memoryview(self.blocks.get())
+            if not self.block:
+                # put the end back, so that further reads see it too
+                self.blocks.put(b'')
+                if self.error is not None:
+                    raise self.error
+                return 0
+        size = min(len(buffer), len(self.block))
+        buffer[:size] = self.block[:size]
+        self.block = self.block[size:]
+        return size
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        super().close()
+        # unblock the helper thread if it is waiting for room
+        while self.thread.is_alive():
+            try:
+                self.blocks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.infh.close()
+
+
+def open_binary(path: str, mode: str = 'r', external: bool = True) -> IO[bytes]:
+    """
+    Opens `path` for binary reading ('r') or writing ('w'), compressing according to its suffix.
+    With `external`, (de)compression runs in an external command if one is available.
+    """
+    writing = mode.startswith('w')
+    if path == '-':
+        stream = sys.stdout if writing else sys.stdin
+        return open(stream.fileno(), 'wb' if writing else 'rb', buffering=BUFFER_SIZE, closefd=False)
+
+    file_codec = codec(path)
+    if file_codec is None:
+        return open(path, 'wb' if writing else 'rb', buffering=BUFFER_SIZE)
+
+    command = find_command(file_codec.compress if writing else file_codec.decompress) if external else None
+    if command is not None:
+        raw = ProcessFile(command, path, writing)
+    elif writing:
+        return file_codec.open(path, 'wb')
+    else:
+        raw = ThreadedReader(file_codec.open(path, 'rb'))
+    return io.BufferedWriter(raw, BUFFER_SIZE) if writing else io.BufferedReader(raw, BUFFER_SIZE)
+
+
+def open_file(path: str, mode: str = 'rt', encoding: str = ENCODING, external: bool = True) -> IO:
+    """
+    Opens `path` ('-' for STDIN or STDOUT) like `open()`, decompressing it on reading or compressing
+    it on writing according to its suffix. Text mode (the default) uses `encoding`.
+    """
+    binary = open_binary(path, 'w' if mode[0] == 'w' else 'r', external)
+    if 'b' in mode:
+        return binary
+    return io.TextIOWrapper(binary, encoding=encoding, newline='\n' if mode[0] == 'w' else None,
+                            write_through=False)
+
+
+def read_batches(file: Union[str, IO], buffer_size: int = BUFFER_SIZE, encoding: str = ENCODING) -> Iterator[List[str]]:
+    """
+    Reads a file (a path, or a file object, text or binary) in blocks of up to `buffer_size` bytes,
+    yielding the complete lines of each block without their newlines ('\\n' or '\\r\\n'). A text
+    file object is read through its underlying binary buffer, so it should not have been read from before.
+    """
+    if isinstance(file, str):
+        with open_file(file, 'rb') as infh:
+            yield from read_batches(infh, buffer_size, encoding)
+        return
+
+    if isinstance(file, io.TextIOBase):
+        file = file.buffer
+    read = getattr(file, 'read1', file.read)
+
+    def decode(pieces: List[bytes]) -> str:
+        text = b''.join(pieces).decode(encoding)
+        return text.replace('\r\n', '\n') if '\r' in text else text
+
+    # the pieces of an incomplete line, which may span many blocks
+    rest = []
+    while True:
+        block = read(buffer_size)
+        if not block:
+            break
+        end = block.rfind(b'\n') + 1
+        if not end:
+            rest.append(block)
+            continue
+        rest.append(block[:end])
+        lines = decode(rest).split('\n')
+        lines.pop()
+        rest = [block[end:]] if end < len(block) else []
+        yield lines
+    if rest:
+        line = decode(rest)
+        yield [line[:-1] if line.endswith('\r') else line]
+
+
+def read_lines(file: Union[str, IO], buffer_size: int = BUFFER_SIZE, encoding: str = ENCODING) -> Iterator[str]:
+    """
+    The lines of a file, without their newlines, read as by `read_batches()`.
+    """
+    for lines in read_batches(file, buffer_size, encoding):
+        yield from lines
+
+
+def write_lines(outfh: IO, lines: Iterable[str], flush: bool = True) -> None:
+    """
+    Writes `lines` to a text file, each followed by a newline, in one call.
+    """
+    lines = list(lines)
+    if lines:
+        outfh.write('\n'.join(lines) + '\n')
+    if flush:
+        outfh.flush()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+"""
+Recognizes URLs by their shape and their top-level domain.
+
+Rather than spelling out every top-level domain, URL_PATTERN captures the candidate one in its
+`tld` group, which is then looked up in the set of domains listed in tlds.txt. If it is not
+listed, the match is retried without it, as a regex listing the domains would backtrack, so that
+"foo.com.docx" still begins with the URL "foo.com". Masking patterns get the same lookup for any
+`tld` group they capture (see mask_terms.py), and source_factors.factors.URLFactor uses `is_url()`.
+"""
+
+import functools
+import os
+import re
+
+from typing import FrozenSet, Match, Optional
+
+TLD_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tlds.txt')
+
+URL_PATTERN = r'(http:\/\/www\.|https:\/\/www\.|http:\/\/|https:\/\/|ftp:\/\/)?[A-Za-z0-9]+([\-\.]{1}[A-Za-z0-9]+)*\.(?P<tld>[a-z]+)\b(:[0-9]{1,5})?(\/[^\(^\)]*)?'
+
+URL_REGEX = re.compile(URL_PATTERN)
+
+
+@functools.lru_cache(maxsize=None)
+def load_tlds(file: str = TLD_FILE) -> FrozenSet[str]:
+    with open(file, encoding='UTF-8') as infh:
+        return frozenset(line.strip() for line in infh if line.strip() and not line.startswith('#'))
+
+
+def is_tld(suffix: str) -> bool:
+    return suffix in load_tlds()
+
+
+def match_url(token: str) -> Optional[Match]:
+    """
+    Matches the longest URL at the beginning of `token` whose top-level domain is known.
+    """
+    match = URL_REGEX.match(token)
+    while match is not None and not is_tld(match.group('tld')):
+        # a shorter host may still end in a known domain
+        match = URL_REGEX.match(token, 0, match.start('tld'))
+    return match
+
+
+def is_url(token: str) -> bool:
+    """
+    Whether `token` begins with a URL.
+    """
+    return match_url(token) is not None
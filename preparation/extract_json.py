@@ -5,15 +5,18 @@
 Author: Matt Post
 """
 
-import json
+import os
 import sys
 import argparse
 
+# the repository root, so that the masking package can be imported when run as a script
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from masking import jsonio, textio
+
 def main(args):
 
-    for lineno, line in enumerate(sys.stdin, 1):
-        jobj = json.loads(line)
-        print(jobj[args.field], flush=True)
+    for lines in textio.read_batches(sys.stdin):
+        textio.write_lines(sys.stdout, [str(jsonio.loads(line)[args.field]) for line in lines])
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='JSON wrapper')
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Runs a chain of JSON pipeline stages in a single process.
+
+A shell pipeline such as the README's `pre.sh` runs each stage as its own process, which parses
+and prints the JSON object of every line. Here, the stages are listed in a JSON file instead:
+
+    [
+      {"stage": "wrap", "raw": true, "input_field": "raw_text"},
+      {"stage": "mask", "pattern_files": ["patterns.txt"], "add_index": true},
+      {"stage": "wrap", "input_field": "text", "output_field": "tok_text", "command": "tokenizer/moses_tokenizer"},
+      {"stage": "subword", "subword_type": "bpe", "subword_model": "subword.model"},
+      {"stage": "factors", "factors": ["subword", "email", "number", "url"]}
+    ]
+
+and each line is parsed once, passed through the stages as a dict, and printed once:
+
+    python3 pipeline.py pre.json < input > output
+
+The output is the same as that of the corresponding scripts chained together. Stages take the
+options of their script, named as the script's argument (e.g., `add_index` for --add-index):
+
+    wrap        wrap_in_json
+    mask        mask_terms.py --json
+    unmask      mask_terms.py --json --unmask
+    prepare     prepare.py (also named casing, subword, and merge, which is prepare.py --undo)
+    factors     source_factors.compute --json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+
+from collections.abc import Mapping
+from functools import partial
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import prepare
+import subword
+
+# the repository root, so that the masking package can be imported when run as a script
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from masking import jsonio, textio
+
+
+class Stage:
+    """
+    A step of the pipeline. Takes JSON objects, as dicts, and yields them updated, in order.
+    """
+
+    # how the script writes its JSON output; only the last stage's output is printed
+    ensure_ascii = False
+
+    def read(self, lines: Iterable[str]) -> Iterator[Dict]:
+        """
+        Parses the input lines, when this is the first stage.
+        """
+        return (jsonio.loads(line) for line in lines)
+
+    def process(self, jobj: Dict) -> Dict:
+        return jobj
+
+    def __call__(self, jobjs: Iterable[Dict]) -> Iterator[Dict]:
+        for jobj in jobjs:
+            yield self.process(jobj)
+
+    def close(self) -> None:
+        pass
+
+
+class WrapStage(Stage):
+    """
+    wrap_in_json: copies `input_field` to `output_field` and `text`, or sets them to the output of
+    `command` on the input field. The command is started once and must answer each input line with
+    an output line; the lines of a batch are written to it while its answers are read.
+    """
+
+    def __init__(self,
+                 input_field: str,
+                 output_field: Optional[str] = None,
+                 command: Optional[str] = None,
+                 raw: bool = False) -> None:
+        self.input_field = input_field
+        self.output_field = output_field
+        self.raw = raw
+        self.command_process = None
+        if command is not None and output_field is not None:
+            self.command_process = subprocess.Popen(command.split(), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                                    stderr=subprocess.DEVNULL)
+
+    def read(self, lines: Iterable[str]) -> Iterator[Dict]:
+        for line in lines:
+            try:
+                jobj = jsonio.loads(line)
+            except ValueError:
+                if not self.raw:
+                    raise
+                jobj = None
+            if self.raw and not isinstance(jobj, Mapping):
+                # magically create a JSON object with the input text as the input field
+                jobj = {self.input_field: line.rstrip()}
+            yield jobj
+
+    def wrap(self, jobj: Dict) -> Dict:
+        if self.raw and self.input_field not in jobj:
+            jobj[self.input_field] = jobj['text']
+        return jobj
+
+    def process(self, jobj: Dict) -> Dict:
+        jobj = self.wrap(jobj)
+        if self.output_field is not None:
+            jobj[self.output_field] = jobj[self.input_field]
+            jobj['text'] = jobj[self.output_field]
+        else:
+            jobj['text'] = jobj[self.input_field]
+        return jobj
+
+    def __call__(self, jobjs: Iterable[Dict]) -> Iterator[Dict]:
+        if self.command_process is None:
+            yield from super().__call__(jobjs)
+            return
+
+        jobjs = [self.wrap(jobj) for jobj in jobjs]
+        errors = []
+
+        def write():
+            try:
+                self.command_process.stdin.write(b''.join((jobj[self.input_field] + '\n').encode('utf-8') for jobj in jobjs))
+                self.command_process.stdin.flush()
+            except Exception as e:
+                errors.append(e)
+
+        writer = threading.Thread(target=write, daemon=True)
+        writer.start()
+        for jobj in jobjs:
+            jobj[self.output_field] = jobj['text'] = self.command_process.stdout.readline().decode('utf-8').rstrip()
+        writer.join()
+        if errors:
+            raise errors[0]
+        yield from jobjs
+
+    def close(self) -> None:
+        if self.command_process is not None:
+            self.command_process.stdin.close()
+            self.command_process.stdout.close()
+            self.command_process.wait()
+
+
+class MaskStage(Stage):
+    """
+    mask_terms.py --json: masks the `text` field and records the masks.
+    """
+
+    def __init__(self,
+                 pattern_files: Optional[List[str]] = None,
+                 dict_files: Optional[List[str]] = None,
+                 masker: Optional[str] = None,
+                 add_index: bool = False,
+                 pattern_label: Optional[str] = None,
+                 dict_label: Optional[str] = None,
+                 single_pass: bool = False,
+                 pattern_timeout: Optional[float] = None,
+                 line_timeout: Optional[float] = None,
+                 constrain: bool = False,
+                 prob: float = 1.0) -> None:
+        from masking.mask_terms import TermMasker
+        if pattern_files is None:
+            pattern_files = []
+        if dict_files is None:
+            dict_files = []
+        if masker is not None:
+            self.masker = TermMasker.load(masker, add_index=add_index, single_pass=single_pass,
+                                          pattern_timeout=pattern_timeout, line_timeout=line_timeout)
+        else:
+            self.masker = TermMasker(pattern_files, dict_files, add_index=add_index, plabel_override=pattern_label,
+                                     dlabel_override=dict_label, single_pass=single_pass,
+                                     pattern_timeout=pattern_timeout, line_timeout=line_timeout)
+        self.constrain = constrain
+        self.prob = prob
+
+    def process(self, jobj: Dict) -> Dict:
+        if '\t' in jobj['text']:
+            raise Exception('Bitext (a tab in the text field) can only be masked by mask_terms.py')
+
+        self.masker.reset_counts()
+        masked_source, _, masks = self.masker.mask(jobj['text'], None, self.prob)
+        jobj['masked_text'] = jobj['text'] = masked_source
+        jobj['masks'] = masks
+
+        if self.constrain:
+            jobj['constraints'] = [mask['maskstr'] for mask in masks]
+        return jobj
+
+
+class UnmaskStage(MaskStage):
+    """
+    mask_terms.py --json --unmask: puts the masked text back into the translation in `text`.
+    """
+
+    ensure_ascii = True
+
+    def __call__(self, jobjs: Iterable[Dict]) -> Iterator[Dict]:
+        jobjs = list(jobjs)
+        unmasked = self.masker.unmask_batch([(jobj['text'], jobj['masks']) for jobj in jobjs])
+        for jobj, unmasked_text in zip(jobjs, unmasked):
+            jobj['unmasked_translation'] = jobj['text'] = unmasked_text
+            yield jobj
+
+
+class PrepareStage(Stage):
+    """
+    prepare.py: recasing and subword splitting or, with `undo`, merging.
+    """
+
+    def __init__(self,
+                 subword_type: str = 'none',
+                 subword_model: Optional[str] = None,
+                 subword_glossary: Optional[List[str]] = None,
+                 subword_sample: bool = False,
+                 casing: str = 'original',
+                 undo: bool = False,
+                 input_field: str = 'text',
+                 constraints: Optional[List[str]] = None) -> None:
+        if subword_glossary is None:
+            subword_glossary = []
+        if constraints is None:
+            constraints = []
+        self.subwordenizer = subword.get_subwordenizer(subword_type, subword_model, subword_glossary, subword_sample)
+        self.options = dict(subword_type=subword_type, casing=casing, undo=undo, input_field=input_field, constraints=constraints)
+
+    def process(self, jobj: Dict) -> Dict:
+        return prepare.prepare(jobj, self.subwordenizer, **self.options)
+
+
+class FactorsStage(Stage):
+    """
+    source_factors.compute --json: adds source factors.
+    """
+
+    def __init__(self, factors: List[str], cache_size: int = 100000, cache_vocab: Optional[str] = None) -> None:
+        from source_factors.compute import FactorComputer
+        self.computer = FactorComputer(factors, cache_size, cache_vocab)
+
+    def process(self, jobj: Dict) -> Dict:
+        return self.computer.compute_json(jobj)
+
+
+STAGES = {
+    'wrap': WrapStage,
+    'mask': MaskStage,
+    'unmask': UnmaskStage,
+    'prepare': PrepareStage,
+    'casing': PrepareStage,
+    'subword': PrepareStage,
+    'merge': partial(PrepareStage, undo=True),
+    'factors': FactorsStage,
+}
+
+
+class Pipeline:
+    def __init__(self, stages: List[Stage]) -> None:
+        if not stages:
+            raise Exception('A pipeline needs at least one stage')
+        self.stages = stages
+
+    @classmethod
+    def from_config(cls, config: List[Dict]) -> 'Pipeline':
+        """
+        Builds the stages from their descriptions: dicts with the name of the stage under `stage`
+        and its options.
+        """
+        stages = []
+        for options in config:
+            options = dict(options)
+            name = options.pop('stage')
+            if name not in STAGES:
+                raise Exception('Unknown stage "{}"; expected one of {}'.format(name, ', '.join(STAGES)))
+            stages.append(STAGES[name](**options))
+        return cls(stages)
+
+    @classmethod
+    def from_file(cls, path: str) -> 'Pipeline':
+        with open(path, encoding='utf-8') as infh:
+            return cls.from_config(json.load(infh))
+
+    def run(self, lines: Iterable[str]) -> List[str]:
+        """
+        Runs a batch of lines through all stages, returning the output lines.
+        """
+        jobjs = self.stages[0].read(lines)
+        for stage in self.stages:
+            jobjs = stage(jobjs)
+        ensure_ascii = self.stages[-1].ensure_ascii
+        return [jsonio.dumps(jobj, ensure_ascii=ensure_ascii) for jobj in jobjs]
+
+    def close(self) -> None:
+        for stage in self.stages:
+            stage.close()
+
+
+def main(args):
+    pipeline = Pipeline.from_file(args.config)
+    try:
+        for lines in textio.read_batches(sys.stdin):
+            textio.write_lines(sys.stdout, pipeline.run(lines))
+    finally:
+        pipeline.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs a pipeline of JSON stages in one process.')
+    parser.add_argument('config', help='JSON file with the list of stages.')
+    args = parser.parse_args()
+    main(args)
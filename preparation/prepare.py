@@ -13,39 +13,67 @@
 import sys
 import argparse
 
+from typing import Dict, List, Optional
+
 import subword
 
+# the repository root, so that the masking package can be imported when run as a script
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from masking import jsonio, textio
+
+def prepare(jobj: Dict,
+            subwordenizer: subword.Subwordenizer,
+            subword_type: str = 'none',
+            casing: str = 'original',
+            undo: bool = False,
+            input_field: str = 'text',
+            constraints: Optional[List[str]] = None) -> Dict:
+    """
+    Applies the pre-processing (or, with `undo`, the post-processing) to a JSON object, in place.
+    The arguments are those of the command line.
+    """
+    jobj['text'] = jobj[input_field]
+
+    if casing.startswith('lower'):
+        jobj['recased_text'] = jobj['text'] = jobj['text'].lower()
+    elif casing == 'true':
+        raise Exception('Truecasing not supported')
+
+    if subword_type != 'none':
+        if undo:
+            jobj['merged_translation'] = jobj['text'] = subwordenizer.merge(jobj['text'])
+        else:
+            jobj['subword_text'] = jobj['text'] = subwordenizer.segment(jobj['text'])
+            jobj['subword_method'] = subword_type
+
+    if constraints:
+        jobj['constraints'] = constraints
+
+    return jobj
+
+
 def main(args):
     # sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
     # sys.stdin = os.fdopen(sys.stdin.fileno(), 'r', 0)
 
     subwordenizer = subword.get_subwordenizer(args.subword_type, args.subword_model, args.subword_glossary, args.subword_sample)
 
-    for lineno, line in enumerate(sys.stdin, 1):
-        try:
-            jobj = json.loads(line)
-        except json.decoder.JSONDecodeError as e:
-            print('Failed to parse JSON object from line {}: {}'.format(lineno, line.rstrip()))
-            sys.exit(1)
-
-        jobj['text'] = jobj[args.input_field]
-
-        if args.casing.startswith('lower'):
-            jobj['recased_text'] = jobj['text'] = jobj['text'].lower()
-        elif args.casing == 'true':
-            raise Exception('Truecasing not supported')
-
-        if args.subword_type != 'none':
-            if args.undo:
-                jobj['merged_translation'] = jobj['text'] = subwordenizer.merge(jobj['text'])
-            else:
-                jobj['subword_text'] = jobj['text'] = subwordenizer.segment(jobj['text'])
-                jobj['subword_method'] = args.subword_type
-
-        if args.constraints:
-            jobj['constraints'] = constraints
-
-        print(json.dumps(jobj, ensure_ascii=False), flush=True)
+    lineno = 0
+    for lines in textio.read_batches(sys.stdin):
+        output = []
+        for line in lines:
+            lineno += 1
+            try:
+                jobj = jsonio.loads(line)
+            except json.decoder.JSONDecodeError as e:
+                textio.write_lines(sys.stdout, output)
+                print('Failed to parse JSON object from line {}: {}'.format(lineno, line.rstrip()))
+                sys.exit(1)
+
+            jobj = prepare(jobj, subwordenizer, args.subword_type, args.casing, args.undo, args.input_field, args.constraints)
+            output.append(jsonio.dumps(jobj))
+
+        textio.write_lines(sys.stdout, output)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from preparation import pipeline
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, os.pardir)
+PREPARATION = os.path.join(ROOT, "preparation")
+PATTERNS = os.path.join(ROOT, "masking", "patterns.txt")
+
+LINES = ["Je suis sur l'internet chez http://mjpost.github.io/",
+         "Écrivez à a@b.com avant le 12 mai , voir foo.com.docx",
+         "",
+         "L'essai coûte 3,50 € l'unité"]
+
+# a stand-in for the Moses tokenizer, which answers each line as it is read
+TOKENIZER = ("import sys\n"
+             "for line in sys.stdin:\n"
+             "    print(line.strip().replace(\"'\", \"' \"), flush=True)\n")
+
+
+def run(command, input_text, cwd=ROOT):
+    return subprocess.run(command, input=input_text, stdout=subprocess.PIPE, check=True, cwd=cwd,
+                          universal_newlines=True, encoding='utf-8').stdout
+
+
+def test_pipeline_matches_scripts(tmp_path):
+    tokenizer = tmp_path / "tokenizer.py"
+    tokenizer.write_text(TOKENIZER, encoding='utf-8')
+    tokenize = "{} {}".format(sys.executable, tokenizer)
+
+    # the README's pre.sh, with BPE replaced by recasing, followed by factors
+    config = [
+        {"stage": "wrap", "raw": True, "input_field": "raw_text"},
+        {"stage": "mask", "pattern_files": [PATTERNS], "add_index": True},
+        {"stage": "wrap", "input_field": "text", "output_field": "tok_text", "command": tokenize},
+        {"stage": "subword", "subword_type": "none", "casing": "lower"},
+        {"stage": "factors", "factors": ["case", "url", "number", "mask"]},
+    ]
+    config_file = tmp_path / "pre.json"
+    config_file.write_text(json.dumps(config), encoding='utf-8')
+
+    text = ''.join(line + '\n' for line in LINES)
+    for command in [[sys.executable, os.path.join(PREPARATION, "wrap_in_json"), "-r", "raw_text"],
+                    [sys.executable, os.path.join(ROOT, "masking", "mask_terms.py"), "--json", "--pattern-files", PATTERNS, "--add-index"],
+                    [sys.executable, os.path.join(PREPARATION, "wrap_in_json"), "text", "tok_text", tokenize],
+                    [sys.executable, os.path.join(PREPARATION, "prepare.py"), "--subword-type", "none", "--casing", "lower"],
+                    [sys.executable, "-m", "source_factors.compute", "--json", "case", "url", "number", "mask"]]:
+        text = run(command, text)
+    assert len(text.splitlines()) == len(LINES)
+
+    assert run([sys.executable, os.path.join(PREPARATION, "pipeline.py"), str(config_file)], ''.join(line + '\n' for line in LINES)) == text
+
+    in_process = pipeline.Pipeline.from_file(str(config_file))
+    try:
+        assert in_process.run(LINES) == text.splitlines()
+    finally:
+        in_process.close()
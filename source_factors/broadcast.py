@@ -8,10 +8,20 @@
 ***Make sure*** that the subword feature is the first column or file.
 """
 import argparse
+import itertools
 import sys
-from typing import Iterable, List, Generator
+from functools import partial
+from typing import Iterable, List, Generator, Tuple
+
+import numpy
+
+from masking import textio
+from .utils import smart_open
 
 UNK = '<unk>'
+SEGMENT_BREAK = '\x01'
+# lines broadcast at once, unless STDIN is interactive
+BATCH_SIZE = 1000
 
 def broadcast(subword_factors: str,
               input_factors: List[str]) -> List[str]:
@@ -42,22 +52,90 @@ def broadcast(subword_factors: str,
     :return: A list of factored strings
     """
 
-    num_factors = len(input_factors)
     input_factors = [factor.rstrip().split() for factor in input_factors]
-    output_factors = [[] for f in range(num_factors)]
-    if num_factors > 0:
-        input_len = len(input_factors[0])
-        token_i = 0
-        for subword_factor in subword_factors.split():
-            for i in range(num_factors):
-                output_factors[i].append(input_factors[i][token_i] if token_i < input_len else UNK)
+    output_factors = [' '.join(factor) for factor in broadcast_tokens(subword_factors.split(), input_factors)]
 
-            if subword_factor in ['E', 'O']:
-                token_i += 1
+    return [subword_factors] + output_factors
 
-    output_factors = [' '.join(factor) for factor in output_factors]
 
-    return [subword_factors] + output_factors
+def broadcast_tokens(subword_factors: List[str],
+                     input_factors: List[List[str]]) -> List[List[str]]:
+    """
+    Like `broadcast()`, but on already-split factors, returning the broadcast factors
+    (without the subword factors) as lists of tokens.
+
+    :param subword_factors: The BIEO factors of the subwords.
+    :param input_factors: Any number of input factors, one value per word.
+    :return: The input factors, one value per subword.
+    """
+    if not input_factors:
+        return []
+
+    # the word each subword belongs to, shared by all factors
+    word_indices = []
+    token_i = 0
+    for subword_factor in subword_factors:
+        word_indices.append(token_i)
+        if subword_factor == 'E' or subword_factor == 'O':
+            token_i += 1
+
+    input_len = len(input_factors[0])
+    output_factors = [[factor[i] if i < input_len else UNK for i in word_indices] for factor in input_factors]
+
+    return output_factors
+
+
+def split_batch(segments: List[str], dtype=object) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Splits a batch of segments into tokens with a single `split()`, keeping a SEGMENT_BREAK
+    token after each segment.
+
+    :return: The tokens, as an array of `dtype`, and the indices of the segment breaks among them.
+    """
+    tokens = numpy.array(' {} '.format(SEGMENT_BREAK).join(segments).split() + [SEGMENT_BREAK], dtype=dtype)
+    return tokens, numpy.flatnonzero(tokens == SEGMENT_BREAK)
+
+
+def broadcast_batch(subword_factors: List[str],
+                    input_factors: List[List[str]]) -> List[List[str]]:
+    """
+    Does what `broadcast()` does for a batch of segments at once.
+
+    The subword factors of the whole batch are turned into a single array of word indices,
+    with one cumulative sum over the word ends (E and O), and each input factor is then
+    gathered through it. A subword beyond the end of a factor's words gets UNK.
+
+    :param subword_factors: The subword factors of each segment.
+    :param input_factors: The input factors of each segment, as strings.
+    :return: For each segment, a list of factored strings, the subword factors first.
+    """
+    if not subword_factors:
+        return []
+
+    labels, label_breaks = split_batch(subword_factors, dtype=str)
+    is_break = labels == SEGMENT_BREAK
+    segment_ids = numpy.cumsum(is_break) - is_break
+    label_starts = numpy.concatenate(([0], label_breaks[:-1] + 1))
+
+    # the index of each subword's word in its segment is the number of word ends before it
+    ends = ((labels == 'E') | (labels == 'O')).astype(numpy.int64)
+    ends_before = numpy.cumsum(ends) - ends
+    word_indices = ends_before - ends_before[label_starts][segment_ids]
+
+    outputs = [[segment] for segment in subword_factors]
+    for factor in zip(*input_factors):
+        words, word_breaks = split_batch(factor)
+        words = numpy.append(words, UNK)
+        word_starts = numpy.concatenate(([0], word_breaks[:-1] + 1))
+        num_words = word_breaks - word_starts
+
+        positions = numpy.where(word_indices < num_words[segment_ids], word_starts[segment_ids] + word_indices, len(words) - 1)
+        positions[is_break] = word_breaks[-1]
+        broadcast_factor = ' '.join(words[positions].tolist()).split(SEGMENT_BREAK)
+        for output, segment in zip(outputs, broadcast_factor):
+            output.append(segment.strip())
+
+    return outputs
 
 
 def split_stream(stream: Iterable[str] = sys.stdin) -> Generator[List[str], None, None]:
@@ -74,12 +152,33 @@ def split_stream(stream: Iterable[str] = sys.stdin) -> Generator[List[str], None
 
 
 def main(args):
-    input_stream = split_stream(sys.stdin) if args.inputs is None else zip(*args.inputs)
-    for lineno, (subword_tokenstr, *factors) in enumerate(input_stream, 1):
-
-        broadcast_factors = broadcast(subword_tokenstr.rstrip(), factors)
-
-        print('\t'.join(broadcast_factors), file=args.output, flush=True)
+    input_stream = split_stream(textio.read_lines(sys.stdin)) if args.inputs is None else zip(*map(textio.read_lines, args.inputs))
+    batch_size = args.batch_size
+    if batch_size is None:
+        # a pipe or terminal may be waiting for each line's output before sending the next
+        batch_size = BATCH_SIZE if args.inputs is not None or args.binary is not None or sys.stdin.seekable() else 1
+    writer = None
+    while True:
+        batch = list(itertools.islice(input_stream, batch_size))
+        if not batch:
+            break
+
+        subword_factors = [subword_tokenstr.rstrip() for subword_tokenstr, *_ in batch]
+        broadcast_factors = broadcast_batch(subword_factors, [factors for _, *factors in batch])
+        if args.binary is not None:
+            if writer is None:
+                from .factors import FACTORS
+                from .shards import FactorShardWriter
+                names = args.names or ['subword'] + [str(i) for i in range(1, len(broadcast_factors[0]))]
+                vocabularies = [FACTORS[name].vocabulary if name in FACTORS else None for name in names]
+                writer = FactorShardWriter(args.binary, names, vocabularies, shard_size=args.shard_size)
+            for factors in broadcast_factors:
+                writer.add(factors)
+        else:
+            textio.write_lines(args.output, ('\t'.join(factors) for factors in broadcast_factors))
+
+    if writer is not None:
+        writer.close()
 
 
 if __name__ == '__main__':
@@ -87,12 +186,30 @@ def main(args):
     params.add_argument('--inputs', '-i',
                         nargs='+',
                         default=None,
-                        type=argparse.FileType('r'),
-                        help='Paths to factor files. The first is the BPE factors. Default: STDIN.')
+                        type=smart_open,
+                        help='Paths to factor files (plain, .gz, .xz or .zst). The first is the BPE factors. Default: STDIN.')
     params.add_argument('--output', '-o',
-                        type=argparse.FileType('w'),
-                        default=sys.stdout,
+                        type=partial(smart_open, mode='w'),
+                        default='-',
                         help='Output file to write to. Default: STDOUT.')
+    params.add_argument('--batch-size', '-b',
+                        type=int,
+                        default=None,
+                        help='Number of lines to broadcast at once; with 1, each line is written as soon as it is read. '
+                        'Default: 1 when reading a pipe or terminal on STDIN and writing text, {} otherwise.'.format(BATCH_SIZE))
+    params.add_argument('--binary',
+                        metavar='PREFIX',
+                        default=None,
+                        help='Write integer-coded factors to PREFIX.json and PREFIX.NNN.bin shards (see shards.py) instead of text.')
+    params.add_argument('--names',
+                        nargs='+',
+                        default=None,
+                        help='Names of the factors, with --binary; known factors (e.g., case) get a fixed vocabulary. Default: subword 1 2 ...')
+    params.add_argument('--shard-size',
+                        type=int,
+                        default=1000000,
+                        help='Lines per shard, with --binary. Default: %(default)s.')
     args = params.parse_args()
 
     main(args)
+    args.output.close()
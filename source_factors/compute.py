@@ -6,79 +6,337 @@
 factors, which are broadcast across the subwords.
 """
 import argparse
-import json
+import itertools
+import multiprocessing
+import os
 import sys
 
-from typing import Iterable, List, Generator
+from collections import Counter, defaultdict
+from functools import partial
+from typing import Dict, Iterable, Iterator, List, Generator, Optional, Tuple
 
+from masking import jsonio, textio
 from .factors import *
-from .broadcast import broadcast
+from .broadcast import broadcast_batch, broadcast_tokens
+from .shards import FactorShardWriter
+from .utils import smart_open
 
-def main(args):
+def get_factor(name: str) -> Factor:
+    if name not in FACTORS:
+        raise Exception('No such factor "{}"'.format(name))
+    return FACTORS[name]()
+
+
+class FactorComputer:
+    """
+    Computes a list of factors over JSON objects in a single pass.
+
+    Each field is split into tokens once and shared by all factors computed over it,
+    and the values are broadcast over the subwords as lists; strings are only built for the output.
+    """
+    def __init__(self,
+                 factor_names: List[str],
+                 cache_size: int = 100000,
+                 cache_vocab: Optional[str] = None) -> None:
+        """
+        :param factor_names: The factors to compute.
+        :param cache_size: The number of tokens to cache token factor values for, or 0 for no cache.
+        :param cache_vocab: A vocabulary file to seed the caches with.
+        """
+        self.factor_names = factor_names
+        self.factors = [get_factor(name) for name in factor_names]
+        self.cache_size = cache_size
+        self.cache_vocab = cache_vocab
+        self.caches = {}  # type: Dict[Tuple[str, ...], TokenFactorCache]
+
+    def get_cache(self, names: Tuple[str, ...]) -> TokenFactorCache:
+        """
+        Returns the cache for the named token factors, which are computed on the same field.
+        """
+        if names not in self.caches:
+            cache = TokenFactorCache([self.factors[self.factor_names.index(name)] for name in names], self.cache_size)
+            if self.cache_vocab is not None:
+                cache.seed(self.cache_vocab)
+            self.caches[names] = cache
+        return self.caches[names]
+
+    def cache_info(self) -> Dict[str, int]:
+        """
+        The total hits, misses and size of the caches.
+        """
+        info = Counter()
+        for cache in self.caches.values():
+            info.update(cache.info())
+        return dict(info)
+
+    def compute_tokens(self, jobj: Dict) -> Dict[str, List[str]]:
+        """
+        :return: A dictionary from factor name to the factor's list of values.
+        """
+        by_field = defaultdict(list)
+        for name, factor in zip(self.factor_names, self.factors):
+            by_field[factor.field(jobj)].append((name, factor))
+
+        results = {}
+        for field, factors in by_field.items():
+            tokens = jobj[field].split()
+            token_names = tuple(name for name, factor in factors if isinstance(factor, TokenFactor))
+            if token_names and self.cache_size > 0:
+                values = list(map(self.get_cache(token_names).lookup, tokens))
+                for i, name in enumerate(token_names):
+                    results[name] = [token_values[i] for token_values in values]
+            for name, factor in factors:
+                if not isinstance(factor, TokenFactor):
+                    results[name] = factor.compute_tokens(tokens)
+                elif name not in results:
+                    results[name] = list(map(factor.value, tokens))
+
+        return results
+
+    def compute_json(self, jobj: Dict) -> Dict:
+        """
+        Adds the factor names and the factors to the JSON object.
+        If subwords are among the factors, the others are broadcast over them and the factors are a list
+        of strings, with the subword factor first; otherwise they are a dictionary from name to string.
+        """
+        results = self.compute_tokens(jobj)
 
-    factor_list = []
-    for factor in args.factors:
-        if factor == 'case':
-            factor_list.append(CaseFactor())
-        elif factor == 'subword':
-            factor_list.append(SubwordFactor())
-        elif factor == 'mask':
-            factor_list.append(MaskFactor())
-        elif factor == 'url':
-            factor_list.append(URLFactor())
-        elif factor == 'number':
-            factor_list.append(NumberFactor())
-        elif factor == 'email':
-            factor_list.append(EmailFactor())
+        jobj['factor_names'] = self.factor_names
+        if 'subword' in results:
+            names = [name for name in self.factor_names if name != 'subword']
+            broadcast_factors = broadcast_tokens(results['subword'], [results[name] for name in names])
+            jobj['factors'] = [' '.join(factor) for factor in [results['subword']] + broadcast_factors]
         else:
-            raise Exception('No such factor "{}"'.format(factor))
+            jobj['factors'] = {name: ' '.join(results[name]) for name in self.factor_names}
+
+        return jobj
+
+    def compute_lines(self,
+                      lines: List[str],
+                      subword_lines: Optional[List[str]] = None) -> List[List[str]]:
+        """
+        Computes the factors on lines of tokenized text and, if the corresponding lines of subwords
+        are given, broadcasts them over the subwords. The subword factor is computed on the subwords.
+
+        :return: For each factor, its string for each line.
+        """
+        if subword_lines is None and 'subword' in self.factor_names:
+            raise Exception('The subword factor needs a subword stream')
+
+        results = []
+        for i, line in enumerate(lines):
+            jobj = {'text': line, 'tok_text': line}
+            if subword_lines is not None:
+                jobj['subword_text'] = subword_lines[i]
+            results.append(self.compute_tokens(jobj))
+
+        if subword_lines is None:
+            return [[' '.join(line_results[name]) for line_results in results] for name in self.factor_names]
+
+        if 'subword' in self.factor_names:
+            subword_factors = [' '.join(line_results['subword']) for line_results in results]
+        else:
+            subword_factors = [' '.join(SubwordFactor().compute_tokens(line.split())) for line in subword_lines]
+        names = [name for name in self.factor_names if name != 'subword']
+        broadcast_factors = broadcast_batch(subword_factors, [[' '.join(line_results[name]) for name in names] for line_results in results])
+
+        columns = {'subword': subword_factors}
+        for i, name in enumerate(names, 1):
+            columns[name] = [line_factors[i] for line_factors in broadcast_factors]
+        return [columns[name] for name in self.factor_names]
+
+
+# The FactorComputer of each worker process
+worker_computer = None
 
-    factor_names = args.factors
 
-    for lineno, line in enumerate(args.input, 1):
-        if args.json:
-            """
-            This mode is used at inference time.
-            Each factor knows the field it wants and picks it out of the JSON object.
-            """
-            jobj = json.loads(line)
+def init_worker(factor_names: List[str], cache_size: int, cache_vocab: Optional[str]) -> None:
+    global worker_computer
+    worker_computer = FactorComputer(factor_names, cache_size, cache_vocab)
 
-            jobj['factor_names'] = factor_names
-            factor_results = dict(zip(factor_names, [f.compute_json(jobj) for f in factor_list]))
 
-            if 'subword' in factor_names:
-                factors_to_broadcast = [factor_results[f] for f in factor_names if f != 'subword']
-                jobj['factors'] = broadcast(factor_results['subword'], factors_to_broadcast)
+def compute_chunk(chunk: Tuple[List[str], Optional[List[str]]]) -> Tuple[List[List[str]], int, Dict[str, int]]:
+    """
+    :return: The factors of the chunk, with the worker's process id and its cache statistics so far.
+    """
+    return worker_computer.compute_lines(*chunk), os.getpid(), worker_computer.cache_info()
+
+
+def read_chunks(input: Iterable[str],
+                subwords: Optional[Iterable[str]],
+                chunk_size: int) -> Iterator[Tuple[List[str], Optional[List[str]]]]:
+    """
+    Reads the tokenized and (if given) subword streams together, in chunks of `chunk_size` lines.
+    """
+    if subwords is None:
+        lines = ((line, None) for line in input)
+    else:
+        lines = itertools.zip_longest(input, subwords)
+    while True:
+        chunk = list(itertools.islice(lines, chunk_size))
+        if not chunk:
+            break
+        if subwords is not None and any(line is None or subword_line is None for line, subword_line in chunk):
+            raise Exception('The tokenized and subword streams have different numbers of lines')
+        yield ([line.rstrip('\n') for line, _ in chunk],
+               [subword_line.rstrip('\n') for _, subword_line in chunk] if subwords is not None else None)
+
+
+def compute_corpus(args) -> None:
+    """
+    Used at training time to compute all factors in a single pass over the tokenized (and subword) streams.
+    Chunks of lines are spread over `args.workers` processes and the factors of each are written, in order,
+    to a file per factor (`args.output_prefix`.NAME) or to binary shards.
+    """
+    subwords = textio.read_lines(args.subwords) if args.subwords is not None else None
+    chunks = read_chunks(textio.read_lines(args.input), subwords, args.chunk_size)
+    cache_info = {}  # the latest cache statistics of each process
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(args.factors, args.cache_size, args.cache_vocab))
+        results = pool.imap(compute_chunk, chunks)
+    else:
+        pool = None
+        computer = FactorComputer(args.factors, args.cache_size, args.cache_vocab)
+        results = ((computer.compute_lines(*chunk), os.getpid(), computer.cache_info()) for chunk in chunks)
+
+    writer = None
+    outputs = []
+    if args.binary is not None:
+        vocabularies = [FACTORS[name].vocabulary for name in args.factors]
+        writer = FactorShardWriter(args.binary, args.factors, vocabularies, shard_size=args.shard_size)
+    else:
+        outputs = [smart_open('{}.{}'.format(args.output_prefix, name), 'w') for name in args.factors]
+
+    try:
+        for columns, pid, info in results:
+            cache_info[pid] = info
+            if writer is not None:
+                for line_factors in zip(*columns):
+                    writer.add(list(line_factors))
+            else:
+                for outfh, column in zip(outputs, columns):
+                    textio.write_lines(outfh, column, flush=False)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for outfh in outputs:
+            outfh.close()
+
+    if writer is not None:
+        writer.close()
+
+    if args.cache_stats:
+        report_cache_stats(cache_info.values())
+
+
+def report_cache_stats(infos: Iterable[Dict[str, int]]) -> None:
+    total = Counter()
+    for info in infos:
+        total.update(info)
+    lookups = total['hits'] + total['misses']
+    print('Token factor cache: {} hits, {} misses ({:.1%} hit rate), {} tokens cached'.format(
+        total['hits'], total['misses'], total['hits'] / lookups if lookups else 0.0, total['size']), file=sys.stderr)
+
+
+def main(args):
+    if not args.json and (args.output_prefix is not None or args.subwords is not None or len(args.factors) > 1):
+        compute_corpus(args)
+        return
+
+    computer = FactorComputer(args.factors, args.cache_size, args.cache_vocab)
+
+    writer = None
+    if args.binary is not None:
+        factor = computer.factors[0]
+        writer = FactorShardWriter(args.binary, args.factors[:1], [factor.vocabulary], shard_size=args.shard_size)
+
+    for lines in textio.read_batches(args.input):
+        output = []
+        for line in lines:
+            if args.json:
+                """
+                This mode is used at inference time.
+                Each factor knows the field it wants and picks it out of the JSON object.
+                """
+                jobj = computer.compute_json(jsonio.loads(line))
+
+                output.append(jsonio.dumps(jobj))
             else:
-                jobj['factors'] = factor_results
+                """
+                Used at training time.
+                This script is called once for each feature, with the information it needs as raw text.
+                """
+                output.append(' '.join(computer.compute_tokens({'text': line, 'tok_text': line, 'subword_text': line})[args.factors[0]]))
 
-            print(json.dumps(jobj, ensure_ascii=False), file=args.output, flush=True)
+        if writer is not None:
+            for factor_str in output:
+                writer.add([factor_str])
         else:
-            """
-            Used at training time.
-            This script is called once for each feature, with the information it needs as raw text.
-            """
-            factor_str = factor_list[0].compute(line)
-            print(factor_str, file=args.output)
+            textio.write_lines(args.output, output)
+
+    if writer is not None:
+        writer.close()
+
+    if args.cache_stats:
+        report_cache_stats([computer.cache_info()])
 
 
 if __name__ == '__main__':
     params = argparse.ArgumentParser(description='Compute factors over a token stream, then applies optional casing and subword processing.')
     params.add_argument('--input', '-i',
-                        default=sys.stdin,
-                        type=argparse.FileType('r'),
-                        help='File stream to read tokenized data from. Default: STDIN.')
+                        default='-',
+                        type=smart_open,
+                        help='File (plain, .gz, .xz or .zst) to read tokenized data from. Default: STDIN.')
     params.add_argument('--output', '-o',
-                        type=argparse.FileType('w'),
-                        default=sys.stdout,
-                        help='Output file to write to. Default: STDOUT.')
+                        type=partial(smart_open, mode='w'),
+                        default='-',
+                        help='Output file to write to (compressed according to its suffix). Default: STDOUT.')
     params.add_argument('factors',
                         nargs='+',
                         default=[],
                         help="List of factors to compute.")
     params.add_argument('--json', action='store_true',
                         help='Work with JSON input and output (inference mode).')
+    params.add_argument('--binary',
+                        metavar='PREFIX',
+                        default=None,
+                        help='Write integer-coded factors to PREFIX.json and PREFIX.NNN.bin shards (see shards.py) instead of text. Not with --json.')
+    params.add_argument('--shard-size',
+                        type=int,
+                        default=1000000,
+                        help='Lines per shard, with --binary. Default: %(default)s.')
+    params.add_argument('--subwords', '-s',
+                        default=None,
+                        type=smart_open,
+                        help='Training mode: subword stream corresponding to the tokenized input. Word factors are broadcast over it.')
+    params.add_argument('--output-prefix', '-p',
+                        default=None,
+                        help='Training mode: write each factor to PREFIX.NAME. Needed for more than one factor without --binary.')
+    params.add_argument('--workers', '-w',
+                        type=int,
+                        default=1,
+                        help='Training mode: number of processes to compute factors with. Default: %(default)s.')
+    params.add_argument('--chunk-size',
+                        type=int,
+                        default=10000,
+                        help='Training mode: number of lines each process computes at a time. Default: %(default)s.')
+    params.add_argument('--cache-size',
+                        type=int,
+                        default=100000,
+                        help='Number of tokens to cache token factor values for (per process), or 0 for no cache. Default: %(default)s.')
+    params.add_argument('--cache-vocab',
+                        default=None,
+                        help='Vocabulary file, most frequent token first, to seed the token factor cache with.')
+    params.add_argument('--cache-stats',
+                        action='store_true',
+                        help='Print token factor cache hits and misses to STDERR at the end.')
 
     args = params.parse_args()
+    if args.json and args.binary is not None:
+        params.error('--binary only works in training mode, without --json')
+    if not args.json and args.binary is None and args.output_prefix is None and (args.subwords is not None or len(args.factors) > 1):
+        params.error('Computing more than one factor, or broadcasting, needs --output-prefix or --binary')
 
     main(args)
+    args.output.close()
@@ -11,11 +11,10 @@
   __EMAIL,6__
 """
 import argparse
-import gzip
 import re
-import sys
 
 from functools import partial
+from masking import textio
 from .utils import smart_open
 
 token_pattern = re.compile(r'__\w+(,\d+)?__')
@@ -32,20 +31,21 @@ def mask_all(line):
     return ' '.join(['MASK' if is_mask(token) else 'not_mask' for token in line.split()])
 
 def main(args):
-    for line in args.input:
-        print(mask_all(line.rstrip()), file=args.output, flush=True)
+    for lines in textio.read_batches(args.input):
+        textio.write_lines(args.output, [mask_all(line.rstrip()) for line in lines])
 
 
 if __name__ == '__main__':
     params = argparse.ArgumentParser(description='Marks masked words.')
     params.add_argument('--input', '-i',
                         type=smart_open,
-                        default=sys.stdin,
+                        default='-',
                         help='Path to tokenized, cased input file. Default: STDIN.')
     params.add_argument('--output', '-o',
                         type=partial(smart_open, mode='w'),
-                        default=sys.stdout,
+                        default='-',
                         help='Output file to write to. Default: STDOUT.')
     args = params.parse_args()
 
     main(args)
+    args.output.close()
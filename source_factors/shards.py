@@ -0,0 +1,174 @@
+# *-* encoding: utf-8 *-*
+
+"""
+Integer-coded factor files for training corpora.
+
+Factors written under a prefix P are stored as
+
+    P.json              the factor names, their vocabularies and the list of shards
+    P.000.bin, ...      shards of up to `shard_size` lines each
+
+Each shard is a binary artifact (see masking/artifact.py) with an `offsets` section and, for
+each factor, a section with the ids of its values for all lines of the shard, one after the other.
+Line i of a shard covers positions offsets[i] to offsets[i + 1] of every factor's section.
+Shards are memory-mapped when read, so a corpus loads without being parsed.
+
+Id 0 of every vocabulary is UNK. A factor with a fixed vocabulary maps any other value to it;
+otherwise, values are added to its vocabulary as they are seen.
+"""
+
+import array
+import bisect
+import json
+import os
+
+from typing import List, Optional
+
+from masking import artifact
+from .broadcast import UNK
+
+MAGIC = b'SSFACTOR'
+DEFAULT_SHARD_SIZE = 1000000
+MAX_SHARD_TOKENS = 2 ** 32 - 1
+
+
+def typecode(vocab_size: int) -> str:
+    """
+    The smallest unsigned array type code that holds ids for a vocabulary of the given size.
+    """
+    if vocab_size <= 2 ** 8:
+        return 'B'
+    elif vocab_size <= 2 ** 16:
+        return 'H'
+    return 'I'
+
+
+class FactorShardWriter:
+    def __init__(self,
+                 prefix: str,
+                 factor_names: List[str],
+                 vocabularies: Optional[List[Optional[List[str]]]] = None,
+                 shard_size: int = DEFAULT_SHARD_SIZE) -> None:
+        """
+        :param prefix: The prefix of the files to write.
+        :param factor_names: The names of the factors on each line.
+        :param vocabularies: For each factor, its fixed vocabulary, or None to collect it from the data.
+        :param shard_size: The number of lines per shard.
+        """
+        self.prefix = prefix
+        self.factor_names = list(factor_names)
+        if vocabularies is None:
+            vocabularies = [None] * len(self.factor_names)
+        self.fixed = [vocabulary is not None for vocabulary in vocabularies]
+        self.vocabularies = [[UNK] + [value for value in vocabulary or [] if value != UNK] for vocabulary in vocabularies]
+        self.ids = [{value: i for i, value in enumerate(vocabulary)} for vocabulary in self.vocabularies]
+        self.shard_size = shard_size
+        self.shards = []
+        self.new_shard()
+
+    def new_shard(self) -> None:
+        self.offsets = array.array('I', [0])
+        self.values = [array.array(typecode(len(vocabulary))) for vocabulary in self.vocabularies]
+
+    def add(self, factors: List[str]) -> None:
+        """
+        Adds a line, given as one string of space-separated values per factor.
+        """
+        values = [factor.split() for factor in factors]
+        if len(values) != len(self.factor_names):
+            raise Exception('Expected {} factors, got {}'.format(len(self.factor_names), len(values)))
+        length = len(values[0]) if values else 0
+        if any(len(factor_values) != length for factor_values in values):
+            raise Exception('Factors have different lengths: {}'.format(' '.join(str(len(factor_values)) for factor_values in values)))
+
+        # a line too long for the current shard starts a new one, unless the shard is still empty
+        if len(self.offsets) > 1 and self.offsets[-1] + length > MAX_SHARD_TOKENS:
+            self.write_shard()
+
+        for i, factor_values in enumerate(values):
+            ids = self.ids[i]
+            if not self.fixed[i]:
+                vocabulary = self.vocabularies[i]
+                for value in factor_values:
+                    if value not in ids:
+                        ids[value] = len(vocabulary)
+                        vocabulary.append(value)
+                if typecode(len(vocabulary)) != self.values[i].typecode:
+                    self.values[i] = array.array(typecode(len(vocabulary)), self.values[i])
+            self.values[i].extend([ids.get(value, 0) for value in factor_values])
+        self.offsets.append(self.offsets[-1] + length)
+
+        if len(self.offsets) > self.shard_size:
+            self.write_shard()
+
+    def write_shard(self) -> None:
+        path = '{}.{:03d}.bin'.format(self.prefix, len(self.shards))
+        sections = {'offsets': self.offsets}
+        for i, values in enumerate(self.values):
+            sections['factor{}'.format(i)] = values
+        metadata = {'factor_names': self.factor_names, 'vocabularies': self.vocabularies}
+        artifact.write_artifact(path, metadata, sections, magic=MAGIC)
+
+        self.shards.append({'path': os.path.basename(path), 'lines': len(self.offsets) - 1, 'tokens': self.offsets[-1]})
+        self.new_shard()
+
+    def close(self) -> None:
+        """
+        Writes the last shard and the index.
+        """
+        if len(self.offsets) > 1 or not self.shards:
+            self.write_shard()
+        with open(self.prefix + '.json', 'w', encoding='utf-8') as outfh:
+            json.dump({'factor_names': self.factor_names,
+                       'vocabularies': self.vocabularies,
+                       'lines': sum(shard['lines'] for shard in self.shards),
+                       'shards': self.shards}, outfh, ensure_ascii=False, indent=2)
+
+    def __enter__(self) -> 'FactorShardWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+
+
+class FactorShards:
+    """
+    Reads factors written by FactorShardWriter. Indexing gives the factor ids of a line, as one
+    memoryview per factor.
+    """
+
+    def __init__(self, prefix: str) -> None:
+        with open(prefix + '.json', encoding='utf-8') as infh:
+            index = json.load(infh)
+        self.factor_names = index['factor_names']
+        self.vocabularies = index['vocabularies']
+
+        directory = os.path.dirname(prefix)
+        self.shards = []
+        self.shard_starts = []
+        start = 0
+        for shard in index['shards']:
+            _, sections = artifact.read_artifact(os.path.join(directory, shard['path']), magic=MAGIC)
+            self.shards.append(sections)
+            self.shard_starts.append(start)
+            start += shard['lines']
+        self.num_lines = start
+
+    def __len__(self) -> int:
+        return self.num_lines
+
+    def __getitem__(self, line: int) -> List[memoryview]:
+        if not 0 <= line < self.num_lines:
+            raise IndexError('line {} out of range'.format(line))
+        shard = bisect.bisect_right(self.shard_starts, line) - 1
+        sections = self.shards[shard]
+        offsets = sections['offsets']
+        i = line - self.shard_starts[shard]
+        return [sections['factor{}'.format(f)][offsets[i]:offsets[i + 1]] for f in range(len(self.factor_names))]
+
+    def decode(self, line: int) -> List[str]:
+        """
+        Returns the factors of a line as strings of space-separated values.
+        """
+        return [' '.join(vocabulary[i] for i in ids) for vocabulary, ids in zip(self.vocabularies, self[line])]
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import pytest
+
+from source_factors import compute, shards
+from source_factors.factors import FACTORS, URLFactor
+
+UNK = '<unk>'
+
+JSON_OBJECTS = [
+    {"text": "The boy ate the waffles .", "tok_text": "The boy ate the waffles .", "subword_text": "The boy ate the waff@@ les ."},
+    {"text": "Mail __EMAIL_1__ a@b.com or see foo.com.docx , 12,000 UNITS",
+     "tok_text": "Mail __EMAIL_1__ a@b.com or see foo.com.docx , 12,000 UNITS",
+     "subword_text": "Mail __EMAIL_1__ a@@ @@ b.com or see foo.com.@@ docx , 12@@ ,000 UN@@ IT@@ S"},
+    {"text": "Ein kleines Haus", "tok_text": "Ein kleines Haus", "subword_text": "▁Ein ▁klein es ▁Haus"},
+    # more subword words than tokens
+    {"text": "too few", "tok_text": "too few", "subword_text": "too few sub@@ words here"},
+    {"text": "", "tok_text": "", "subword_text": ""},
+    {"text": "__URL_1__ and -3.5", "raw_text": "__URL_1__ and -3.5", "subword_text": "__URL_1__ and -3.@@ 5"},
+]
+
+FACTOR_LISTS = [["subword", "case", "mask", "url", "number", "email"], ["case", "number"], ["subword"], ["url", "subword"]]
+
+
+def reference_broadcast(subword_factors, input_factors):
+    """
+    The original, per-line broadcast().
+    """
+    num_factors = len(input_factors)
+    input_factors = [factor.rstrip().split() for factor in input_factors]
+    output_factors = [[] for f in range(num_factors)]
+    if num_factors > 0:
+        input_len = len(input_factors[0])
+        token_i = 0
+        for subword_factor in subword_factors.split():
+            for i in range(num_factors):
+                output_factors[i].append(input_factors[i][token_i] if token_i < input_len else UNK)
+            if subword_factor in ['E', 'O']:
+                token_i += 1
+    return [subword_factors] + [' '.join(factor) for factor in output_factors]
+
+
+def reference_json(factor_names, jobj):
+    """
+    The original, per-line --json computation: each factor on the string of its field, then broadcast.
+    """
+    jobj = copy.deepcopy(jobj)
+    factor_list = [FACTORS[name]() for name in factor_names]
+    jobj['factor_names'] = factor_names
+    factor_results = dict(zip(factor_names, [f.compute_json(jobj) for f in factor_list]))
+    if 'subword' in factor_names:
+        factors_to_broadcast = [factor_results[f] for f in factor_names if f != 'subword']
+        jobj['factors'] = reference_broadcast(factor_results['subword'], factors_to_broadcast)
+    else:
+        jobj['factors'] = factor_results
+    return jobj
+
+
+def test_url_factor():
+    assert URLFactor().compute("foo.com.docx example.comma http://foo.com/a x.co.uk report.docx 12") == "Y n Y Y n n"
+
+
+@pytest.mark.parametrize("factor_names", FACTOR_LISTS)
+@pytest.mark.parametrize("cache_size", [0, 4])
+def test_compute_json(factor_names, cache_size):
+    computer = compute.FactorComputer(factor_names, cache_size=cache_size)
+    for jobj in JSON_OBJECTS:
+        assert computer.compute_json(copy.deepcopy(jobj)) == reference_json(factor_names, jobj)
+
+
+def test_shard_rotation(tmp_path, monkeypatch):
+    monkeypatch.setattr(shards, "MAX_SHARD_TOKENS", 3)
+    prefix = str(tmp_path / "corpus")
+    lines = [["O O O O", "f g h i"], ["O O O", "a b c"], ["O", "d"], ["B E", "e e"], ["O", "j"]]
+    with shards.FactorShardWriter(prefix, ["subword", "word"], [None, None]) as writer:
+        for factors in lines:
+            writer.add(factors)
+
+    # a full or over-long line starts a shard, but never leaves an empty one behind
+    assert [shard["lines"] for shard in writer.shards] == [1, 1, 2, 1]
+    reader = shards.FactorShards(prefix)
+    assert [reader.decode(i) for i in range(len(reader))] == lines
+
+
+def test_broadcast_batch():
+    from source_factors.broadcast import broadcast_batch
+    subword_factors, input_factors = [], []
+    for jobj in JSON_OBJECTS:
+        subword_factors.append(FACTORS["subword"]().compute(jobj["subword_text"]))
+        field = jobj.get("tok_text", jobj.get("raw_text"))
+        input_factors.append([FACTORS["case"]().compute(field), FACTORS["number"]().compute(field)])
+    # more words than subword words, and no words at all
+    subword_factors += ["O B E", "O O"]
+    input_factors += [["a b c d", "1 2 3 4"], ["", ""]]
+
+    expected = [reference_broadcast(subwords, factors) for subwords, factors in zip(subword_factors, input_factors)]
+    assert broadcast_batch(subword_factors, input_factors) == expected
+    assert broadcast_batch(subword_factors[:1], input_factors[:1]) == expected[:1]
+
+
+def reference_corpus(factor_names, lines, subword_lines):
+    """
+    The original training-time computation: each factor on each line by itself, then broadcast over the subwords.
+    """
+    columns = {name: [] for name in factor_names}
+    for line, subword_line in zip(lines, subword_lines):
+        subwords = FACTORS["subword"]().compute(subword_line)
+        names = [name for name in factor_names if name != "subword"]
+        broadcast_factors = reference_broadcast(subwords, [FACTORS[name]().compute(line) for name in names])
+        for name, factor in zip(["subword"] + names, broadcast_factors):
+            if name in columns:
+                columns[name].append(factor)
+    return [columns[name] for name in factor_names]
+
+
+@pytest.mark.parametrize("fixed", [True, False])
+def test_factor_shards(fixed, tmp_path):
+    factor_names = FACTOR_LISTS[0]
+    lines = [jobj.get("tok_text", jobj.get("raw_text")) for jobj in JSON_OBJECTS]
+    columns = reference_corpus(factor_names, lines, [jobj["subword_text"] for jobj in JSON_OBJECTS])
+
+    prefix = str(tmp_path / "corpus")
+    vocabularies = [FACTORS[name].vocabulary if fixed else None for name in factor_names]
+    with shards.FactorShardWriter(prefix, factor_names, vocabularies, shard_size=2) as writer:
+        for line_factors in zip(*columns):
+            writer.add(list(line_factors))
+
+    reader = shards.FactorShards(prefix)
+    assert len(reader.shards) == 3
+    assert [reader.decode(i) for i in range(len(reader))] == [list(line_factors) for line_factors in zip(*columns)]
+
+
+@pytest.mark.parametrize("factor_names", [FACTOR_LISTS[0], ["case", "number"]])
+@pytest.mark.parametrize("workers", [1, 2])
+@pytest.mark.parametrize("binary", [False, True])
+def test_compute_corpus(factor_names, workers, binary, tmp_path):
+    import argparse
+    lines = [jobj.get("tok_text", jobj.get("raw_text")) for jobj in JSON_OBJECTS] * 3
+    subword_lines = [jobj["subword_text"] for jobj in JSON_OBJECTS] * 3
+    (tmp_path / "corpus.tok").write_text(''.join(line + '\n' for line in lines), encoding='utf-8')
+    (tmp_path / "corpus.bpe").write_text(''.join(line + '\n' for line in subword_lines), encoding='utf-8')
+
+    # without the subword factor, the factors are not broadcast
+    subwords = str(tmp_path / "corpus.bpe") if "subword" in factor_names else None
+    prefix = str(tmp_path / "corpus.factors")
+    args = argparse.Namespace(input=str(tmp_path / "corpus.tok"), subwords=subwords, factors=factor_names,
+                              output_prefix=None if binary else prefix, binary=prefix if binary else None,
+                              shard_size=4, workers=workers, chunk_size=5, cache_size=100, cache_vocab=None, cache_stats=False)
+    compute.compute_corpus(args)
+
+    if subwords is None:
+        expected = [[FACTORS[name]().compute(line) for line in lines] for name in factor_names]
+    else:
+        expected = reference_corpus(factor_names, lines, subword_lines)
+    if binary:
+        reader = shards.FactorShards(prefix)
+        assert [reader.decode(i) for i in range(len(reader))] == [list(line_factors) for line_factors in zip(*expected)]
+    else:
+        for name, column in zip(factor_names, expected):
+            with open('{}.{}'.format(prefix, name), encoding='utf-8') as infh:
+                assert infh.read().split('\n')[:-1] == column
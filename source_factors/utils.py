@@ -1,5 +1,8 @@
+from masking import textio
+
+
 def smart_open(filename, mode = 'rt'):
-    if filename.endswith('.gz'):
-        return gzip.open(filename, mode=mode, encoding='utf-8')
-    else:
-        return open(filename, mode=mode, encoding='utf-8')
+    """
+    Opens a plain or compressed (.gz, .xz, .zst) file, or '-' for STDIN / STDOUT (see masking/textio.py).
+    """
+    return textio.open_file(filename, mode=mode, encoding='utf-8')